@@ -0,0 +1,82 @@
+"""
+Compares the environment that the CLI evaluates queries in, chained
+with nested ``OrElse`` and with ``CompositeEnv``, on what a query does
+for every row: replacing the data with a document, binding a name, and
+looking up built-in functions and JSONPath expressions.
+
+Usage::
+
+    python -m benchmarks.env_chain [--num-rows 100000] [--repeat 3]
+
+"""
+import argparse
+import time
+from functools import partial
+
+from commcare_export.commcare_minilinq import CommCareHqEnv
+from commcare_export.env import (
+    BuiltInEnv,
+    CompositeEnv,
+    EmitterEnv,
+    JsonPathEnv,
+    OrElse,
+)
+from commcare_export.writers import JValueTableWriter
+
+
+def make_envs():
+    builtin_env = BuiltInEnv({'commcarehq_base_url': 'https://example.com'})
+    hq_env = CommCareHqEnv(None)
+    json_env = JsonPathEnv({})
+    emitter_env = EmitterEnv(JValueTableWriter())
+    nested_static_env = OrElse(builtin_env, hq_env)
+    nested = OrElse(
+        OrElse(nested_static_env, json_env),
+        emitter_env,
+    )
+    composite_static_env = builtin_env | hq_env
+    composite = composite_static_env | json_env | emitter_env
+    assert isinstance(composite, CompositeEnv)
+    return [
+        ('OrElse', nested, nested_static_env),
+        ('CompositeEnv', composite, composite_static_env),
+    ]
+
+
+def run(env, static_env, docs):
+    for doc in docs:
+        row_env = env.replace(doc).bind('case', doc['form']['case'])
+        row_env.lookup('str2num')
+        row_env.lookup('api_data')
+        list(row_env.lookup('form.name'))
+        list(row_env.lookup('case.name'))
+        list(row_env.lookup_skipping(static_env, 'form.name'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    docs = [{
+        'id': str(i),
+        'form': {'name': f'Name {i}', 'case': {'name': f'Case {i}'}},
+    } for i in range(args.num_rows)]
+
+    for label, env, static_env in make_envs():
+        elapsed = min(
+            _time(partial(run, env, static_env, docs))
+            for _ in range(args.repeat)
+        )
+        print(f'{label:<15} {args.num_rows / elapsed:>10.0f} rows/s')
+
+
+def _time(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
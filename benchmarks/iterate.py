@@ -0,0 +1,74 @@
+"""
+Measures how long ``CommCareHqClient`` takes to fetch all forms from a
+local stand-in for the CommCare HQ API, with each of its performance
+options.
+
+Usage::
+
+    python -m benchmarks.iterate [--num-docs 5000] [--latency 0.05]
+
+"""
+import argparse
+import time
+
+from commcare_export.checkpoint import CheckpointManagerWithDetails
+from commcare_export.commcare_hq_client import (
+    AUTH_MODE_APIKEY,
+    CommCareHqClient,
+)
+from commcare_export.commcare_minilinq import (
+    AdaptivePaging,
+    CommCareHqEnv,
+    PaginationMode,
+)
+from tests.hq_server import HqApiStub
+
+OPTIONS = {
+    'default': ({}, {}),
+    'prefetch': ({'prefetch_pages': 2}, {}),
+    'stream': ({'stream_pages': True}, {}),
+    'shards': ({}, {'shards': 4}),
+    'adaptive': ({}, {'adaptive_paging': AdaptivePaging(target_seconds=1)}),
+}
+
+
+class NullCheckpointManager(CheckpointManagerWithDetails):
+
+    def __init__(self):
+        super().__init__(None, None, PaginationMode.date_indexed)
+
+    def set_checkpoint(self, *args, **kwargs):
+        pass
+
+
+def run(stub, batch_size, client_options, env_options):
+    client = CommCareHqClient(
+        stub.url, stub.project, 'user', 'key', AUTH_MODE_APIKEY,
+        **client_options,
+    )
+    env = CommCareHqEnv(client, page_size=batch_size, **env_options)
+    start = time.perf_counter()
+    count = sum(1 for _ in env.api_data('form', NullCheckpointManager()))
+    return time.perf_counter() - start, count, client.transfer_stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-docs', type=int, default=5000)
+    parser.add_argument('--doc-size', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    with HqApiStub(
+        num_docs=args.num_docs, doc_size=args.doc_size, latency=args.latency
+    ) as stub:
+        for name, (client_options, env_options) in OPTIONS.items():
+            elapsed, count, stats = run(
+                stub, args.batch_size, client_options, env_options
+            )
+            print(f'{name:>10}: {count} forms in {elapsed:.2f}s ({stats})')
+
+
+if __name__ == '__main__':
+    main()
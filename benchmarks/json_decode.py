@@ -0,0 +1,77 @@
+"""
+Compares the JSON backends at decoding API pages of synthetic forms,
+with questions, case blocks and IDs and phone numbers of many digits.
+
+Usage::
+
+    python -m benchmarks.json_decode [--batch-size 1000] [--repeat 20]
+
+"""
+import argparse
+import json
+import timeit
+
+from commcare_export import json_backend
+
+
+def make_form(i):
+    return {
+        'id': f'form-{i}',
+        'indexed_on': '2024-01-01T15:36:22.000000Z',
+        'received_on': '2024-01-01T15:36:20.000000Z',
+        'app_id': 'a1b2c3d4e5f6a7b8c9d0e1f2a3b4c5d6',
+        'form': {
+            '@xmlns': 'http://openrosa.org/formdesigner/ABCDEF',
+            '@name': 'Registration',
+            'name': f'Name {i}',
+            'age': str(i % 90),
+            'phone': f'+2547{i:017d}',
+            'national_id': f'{i:020d}',
+            'height': 1.5 + i % 50 / 100,
+            'visited': i % 2 == 0,
+            'case': {
+                '@case_id': f'case-{i}',
+                'update': {'status': 'open', 'village': f'Village {i % 7}'},
+            },
+            'meta': {
+                'userID': f'user-{i % 13}',
+                'timeStart': '2024-01-01T15:30:00.000000Z',
+                'timeEnd': '2024-01-01T15:36:00.000000Z',
+            },
+        },
+    }
+
+
+def build_page(batch_size):
+    return json.dumps({
+        'meta': {'limit': batch_size, 'next': None, 'total_count': batch_size},
+        'objects': [make_form(i) for i in range(batch_size)],
+    }).encode('utf-8')
+
+
+def time_loads(backend, page, repeat):
+    return min(timeit.repeat(
+        lambda: backend.loads(page), number=repeat, repeat=3
+    )) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    page = build_page(args.batch_size)
+    print(f'Page of {args.batch_size} objects, {len(page)} bytes')
+    baseline = None
+    for backend in reversed(json_backend.get_available_backends()):
+        seconds = time_loads(backend, page, args.repeat)
+        baseline = baseline or seconds
+        print(
+            f'{backend.name:>12}: {seconds * 1000:8.2f} ms/page '
+            f'({baseline / seconds:.1f}x)'
+        )
+
+
+if __name__ == '__main__':
+    main()
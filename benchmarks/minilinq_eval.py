@@ -0,0 +1,120 @@
+"""
+Compares evaluating the queries of the Excel fixtures in ``tests/`` by
+walking the MiniLinq tree with ``eval`` and by calling the function
+returned by ``compile``, on synthetic form data.
+
+Usage::
+
+    python -m benchmarks.minilinq_eval [--num-docs 2000] [--repeat 3]
+
+"""
+import argparse
+import glob
+import time
+import warnings
+
+import openpyxl
+
+from commcare_export.env import BuiltInEnv, EmitterEnv, JsonPathEnv
+from commcare_export.excel_query import get_queries_from_excel
+from commcare_export.writers import TableWriter
+
+
+class CountingWriter(TableWriter):
+
+    def __init__(self):
+        self.rows = 0
+
+    def write_table(self, table):
+        for _ in table.rows:
+            self.rows += 1
+
+
+def make_docs(num_docs):
+    return [{
+        'id': f'doc-{i}',
+        'name': f'Name {i}',
+        'indexed_on': f'2024-01-01T00:{i % 60:02}:00',
+        'received_on': f'2024-01-01T00:{i % 60:02}:00',
+        'form': {
+            '@name': 'Registration',
+            'case': {'@case_id': f'case-{i}', 'update': {'age': str(i)}},
+            'question': 'yes' if i % 2 else 'no',
+            'multi': 'a b c',
+            'repeat': [{'item': j} for j in range(3)],
+        },
+        'properties': {'case_type': 'person', 'owner_id': 'owner'},
+    } for i in range(num_docs)]
+
+
+def get_fixture_queries():
+    queries = {}
+    for path in sorted(glob.glob('tests/0*.xlsx')):
+        try:
+            query = get_queries_from_excel(openpyxl.load_workbook(path))
+            rows, _ = run(query, make_docs(1), compiled=False)
+        except Exception:
+            # Some fixtures are incomplete or invalid on purpose
+            continue
+        if rows:
+            queries[path] = query
+    return queries
+
+
+def get_envs(docs):
+    writer = CountingWriter()
+    builtin_env = BuiltInEnv({
+        'api_data': lambda *args: docs,
+        'get_checkpoint_manager': lambda *args: None,
+        'commcarehq_base_url': 'https://www.commcarehq.org',
+        'get_location_info': lambda *args: None,
+        'get_location_ancestor': lambda *args: None,
+    })
+    env = builtin_env | JsonPathEnv({}) | EmitterEnv(writer)
+    return builtin_env, env, writer
+
+
+def run(query, docs, compiled):
+    builtin_env, env, writer = get_envs(docs)
+    start = time.perf_counter()
+    with env:
+        if compiled:
+            result = query.compile(builtin_env)(env)
+        else:
+            result = query.eval(env)
+        if result is not None:
+            list(result)
+    return writer.rows, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-docs', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # openpyxl warns about extensions used by the fixtures
+    warnings.simplefilter('ignore', UserWarning)
+    docs = make_docs(args.num_docs)
+    totals = {False: [0, 0], True: [0, 0]}
+    for path, query in get_fixture_queries().items():
+        results = {}
+        for compiled in [False, True]:
+            rows, elapsed = min(
+                (run(query, docs, compiled) for _ in range(args.repeat)),
+                key=lambda result: result[1],
+            )
+            results[compiled] = rows / elapsed
+            totals[compiled][0] += rows
+            totals[compiled][1] += elapsed
+        print(
+            f'{path:<45} eval: {results[False]:>9.0f} rows/s   '
+            f'compiled: {results[True]:>9.0f} rows/s'
+        )
+    for compiled, (rows, elapsed) in totals.items():
+        name = 'compiled' if compiled else 'eval'
+        print(f'Total {name}: {rows / elapsed:.0f} rows/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Measures the time taken to parse a large MiniLinq query from its JSON
+form with ``MiniLinq.from_jvalue``, and the memory that the parsed query
+takes, for a query like one generated from a workbook with many sheets
+with many mapped columns.
+
+Usage::
+
+    python -m benchmarks.minilinq_parse [--sheets 150] [--columns 200]
+
+"""
+import argparse
+import time
+import tracemalloc
+
+from commcare_export.excel_query import compile_field
+from commcare_export.minilinq import (
+    Apply,
+    Bind,
+    Emit,
+    List,
+    Literal,
+    Map,
+    MiniLinq,
+    Reference,
+)
+
+
+def make_query(num_sheets, num_columns):
+    mappings = {
+        f'column{i}': {'yes': 'Yes', 'no': 'No'}
+        for i in range(0, num_columns, 4)
+    }
+    # Compiling fields parses their JSONPath, which is slow, so the
+    # sheets share their fields
+    fields = [
+        compile_field(
+            f'column{i}',
+            f'form.group{i % 10}.question{i}',
+            alternate_source_fields=(
+                [f'form.old_question{i}'] if i % 3 == 0 else None
+            ),
+            mappings=mappings,
+        ) for i in range(num_columns)
+    ]
+    sheets = []
+    for sheet in range(num_sheets):
+        sheets.append(
+            Bind(
+                'checkpoint_manager',
+                Apply(
+                    Reference('get_checkpoint_manager'), Literal('form'),
+                    Literal([f'sheet{sheet}'])
+                ),
+                Emit(
+                    table=f'sheet{sheet}',
+                    headings=[
+                        Literal(f'column{i}') for i in range(num_columns)
+                    ],
+                    source=Map(
+                        source=Apply(
+                            Reference('api_data'), Literal('form'),
+                            Reference('checkpoint_manager')
+                        ),
+                        body=List(fields),
+                    ),
+                ),
+            )
+        )
+    return List(sheets).to_jvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sheets', type=int, default=150)
+    parser.add_argument('--columns', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    jvalue = make_query(args.sheets, args.columns)
+
+    elapsed = min(
+        _time(lambda: MiniLinq.from_jvalue(jvalue))
+        for _ in range(args.repeat)
+    )
+    tracemalloc.start()
+    query = MiniLinq.from_jvalue(jvalue)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'Nodes:   {_count_nodes(query)}')
+    print(f'Parsing: {elapsed:.3f}s')
+    print(f'Memory:  {size / 1024 / 1024:.1f} MB')
+
+
+def _time(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def _count_nodes(jvalue_or_node):
+    count = 0
+    stack = [jvalue_or_node.to_jvalue()]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            count += len(value.keys() & MiniLinq._node_classes.keys())
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+    return count
+
+
+if __name__ == '__main__':
+    main()
@@ -4,27 +4,60 @@ import io
 import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import dateutil.parser
 import requests
 import sqlalchemy
 
-from commcare_export import builtin_queries, excel_query, writers
+from commcare_export import (
+    builtin_queries,
+    excel_query,
+    json_backend,
+    writers,
+)
 from commcare_export.checkpoint import CheckpointManagerProvider
 from commcare_export.commcare_hq_client import (
+    DEFAULT_POOL_SIZE,
+    DEFAULT_TIMEOUT,
     LATEST_KNOWN_VERSION,
     CommCareHqClient,
     ResourceRepeatException,
 )
-from commcare_export.commcare_minilinq import CommCareHqEnv
-from commcare_export.env import BuiltInEnv, EmitterEnv, JsonPathEnv
+from commcare_export.commcare_minilinq import (
+    DEFAULT_MAX_PAGE_SIZE,
+    DEFAULT_MIN_PAGE_SIZE,
+    DEFAULT_TARGET_PAGE_BYTES,
+    DEFAULT_TARGET_PAGE_SECONDS,
+    AdaptivePaging,
+    CommCareHqEnv,
+)
+from commcare_export.env import (
+    JSONPATH_CACHE,
+    BuiltInEnv,
+    EmitterEnv,
+    JsonPathEnv,
+)
 from commcare_export.exceptions import (
     DataExportException,
     MissingQueryFileException,
 )
 from commcare_export.location_info_provider import LocationInfoProvider
-from commcare_export.minilinq import List, MiniLinq
+from commcare_export.minilinq import List, MiniLinq, get_references
 from commcare_export.misc import default_to_json
-from commcare_export.repeatable_iterator import RepeatableIterator
+from commcare_export.optimizer import optimize
+from commcare_export.profiler import profile_query
+from commcare_export.rate_limit import get_shared_token_bucket
+from commcare_export.repeatable_iterator import (
+    DEFAULT_MAX_ITEMS_IN_MEMORY,
+    RepeatableIterator,
+)
+from commcare_export.response_cache import (
+    MODE_READ_THROUGH,
+    MODE_REPLAY,
+    ResponseCache,
+    ResponseCacheMiss,
+)
+from commcare_export.response_cache import MODES as RESPONSE_CACHE_MODES
 from commcare_export.utils import get_checkpoint_manager
 from commcare_export.version import __version__
 import logging
@@ -64,6 +97,38 @@ CLI_ARGS = [
     ),
     Argument('query', required=False, help='JSON or Excel query file'),
     Argument('dump-query', default=False, action='store_true'),
+    Argument(
+        'optimized',
+        default=False,
+        action='store_true',
+        help='Run an optimized query, which gives the same results but '
+        'is evaluated differently, e.g. expressions that only depend on '
+        'literals are evaluated once, and filters are sent to CommCare HQ. '
+        'With --dump-query, dump the optimized query instead.'
+    ),
+    Argument(
+        'compile-query',
+        default=False,
+        action='store_true',
+        help='Compile the query to Python functions, and evaluate the rows '
+        'of each table in batches, instead of walking the query for every '
+        'document. Experimental: it gives the same results, but is not '
+        'reliably faster yet.'
+    ),
+    Argument(
+        'profile-query',
+        default=False,
+        action='store_true',
+        help='Record the number of calls, the time taken and the number '
+        'of rows of every expression of the query, and print them as a '
+        'tree when the export is done.'
+    ),
+    Argument(
+        'profile-query-json',
+        default=None,
+        help='Write the profile recorded by --profile-query as JSON to '
+        'this file. Implies --profile-query.'
+    ),
     Argument(
         'commcare-hq',
         default='prod',
@@ -131,6 +196,151 @@ CLI_ARGS = [
         default=200,
         help="Number of records to process per batch."
     ),
+    Argument(
+        'adaptive-batch-size',
+        default=False,
+        action='store_true',
+        help="Adapt the number of records requested per page of each "
+        "resource, starting at --batch-size, so that pages take about "
+        "--target-page-seconds to fetch and are no larger than "
+        "--target-page-mb."
+    ),
+    Argument(
+        'min-batch-size',
+        default=DEFAULT_MIN_PAGE_SIZE,
+        type=int,
+        help="The smallest batch size used with --adaptive-batch-size."
+    ),
+    Argument(
+        'max-batch-size',
+        default=DEFAULT_MAX_PAGE_SIZE,
+        type=int,
+        help="The largest batch size used with --adaptive-batch-size."
+    ),
+    Argument(
+        'target-page-seconds',
+        default=DEFAULT_TARGET_PAGE_SECONDS,
+        type=float,
+        help="The time that a page should take to fetch with "
+        "--adaptive-batch-size."
+    ),
+    Argument(
+        'target-page-mb',
+        default=DEFAULT_TARGET_PAGE_BYTES / (1024 * 1024),
+        type=float,
+        help="The largest size of a page in megabytes with "
+        "--adaptive-batch-size."
+    ),
+    Argument(
+        'cache-api-results',
+        default=False,
+        action='store_true',
+        help="Keep the documents fetched from CommCare HQ for each data "
+        "source, so that queries that iterate over a data source more "
+        "than once do not fetch it again."
+    ),
+    Argument(
+        'cache-max-items-in-memory',
+        default=DEFAULT_MAX_ITEMS_IN_MEMORY,
+        type=int,
+        help="The number of documents per data source that "
+        "--cache-api-results keeps in memory. Further documents are kept "
+        "in a temporary file."
+    ),
+    Argument(
+        'request-timeout',
+        default=DEFAULT_TIMEOUT,
+        type=float,
+        help="The number of seconds to wait for CommCare HQ to respond, or "
+        "to send more data, before retrying a request."
+    ),
+    Argument(
+        'accept-encoding',
+        default=None,
+        help="The compression to ask CommCare HQ to use, as the value of "
+        "an Accept-Encoding header. Defaults to every supported "
+        "compression: gzip and deflate, and brotli and zstd if their "
+        "libraries are installed. Use 'identity' for no compression."
+    ),
+    Argument(
+        'max-requests-per-second',
+        default=None,
+        type=float,
+        help="Limit the average number of requests made to CommCare HQ per "
+        "second. The limit is lowered automatically if CommCare HQ asks "
+        "for requests to be slowed down."
+    ),
+    Argument(
+        'request-burst',
+        default=None,
+        type=int,
+        help="The number of requests that may be made at once, before "
+        "--max-requests-per-second applies."
+    ),
+    Argument(
+        'prefetch-pages',
+        default=0,
+        type=int,
+        help="Fetch up to this many pages of data from CommCare HQ in the "
+        "background while the current page is being processed. Defaults "
+        "to 0, which fetches each page only when it is needed."
+    ),
+    Argument(
+        'stream-pages',
+        default=False,
+        action='store_true',
+        help="Decode each page of data from CommCare HQ as it is received, "
+        "instead of reading the whole page into memory. Reduces memory "
+        "usage with a large --batch-size. Cannot be used with "
+        "--prefetch-pages."
+    ),
+    Argument(
+        'response-cache',
+        metavar='DIR',
+        default=None,
+        help="Directory in which to cache the responses of CommCare HQ, so "
+        "that the export can be run again without fetching the same data."
+    ),
+    Argument(
+        'response-cache-mode',
+        default=MODE_READ_THROUGH,
+        choices=RESPONSE_CACHE_MODES,
+        help="'record' always fetches data and caches it, 'replay' only "
+        "uses cached data, and 'read-through' fetches data that is not "
+        "cached yet. Defaults to 'read-through'."
+    ),
+    Argument(
+        'response-cache-max-size',
+        default=None,
+        type=int,
+        help="The maximum size of the response cache in megabytes. The "
+        "least recently used responses are removed to stay below it."
+    ),
+    Argument(
+        'date-shards',
+        default=1,
+        type=int,
+        help="Split the date range of form and case data into this many "
+        "shards, and fetch them from CommCare HQ in parallel. Useful for "
+        "the first export of a large project, or with --start-over."
+    ),
+    Argument(
+        'max-concurrent-requests',
+        default=1,
+        type=int,
+        help="The maximum number of requests to make to CommCare HQ at the "
+        "same time when fetching independent resources, like locations and "
+        "location types."
+    ),
+    Argument(
+        'parallel-queries',
+        default=1,
+        type=int,
+        help="The number of independent queries, like the data sources of "
+        "an Excel query and the users and locations queries, to run at the "
+        "same time, each with its own database connection. Only used with "
+        "--output-format sql."
+    ),
     Argument(
         'checkpoint-key',
         help="Use this key for all checkpoints instead of the query file MD5 "
@@ -245,6 +455,9 @@ def main(argv):
 
     args = parser.parse_args(argv)
 
+    if args.stream_pages and args.prefetch_pages:
+        parser.error('--stream-pages cannot be used with --prefetch-pages')
+
     if args.output_format and args.output:
         errors = []
         errors.extend(validate_output_filename(args.output_format, args.output))
@@ -332,7 +545,7 @@ def _get_query_from_file(
             )
         else:
             with io.open(query_arg, encoding='utf-8') as fh:
-                return MiniLinq.from_jvalue(json.loads(fh.read()))
+                return MiniLinq.from_jvalue(json_backend.loads(fh.read()))
 
 
 def get_queries(args, writer, lp, column_enforcer=None):
@@ -396,6 +609,17 @@ def get_date_params(args):
     return since, until
 
 
+def _get_response_cache(args):
+    if not args.response_cache:
+        return None
+    max_size = None
+    if args.response_cache_max_size is not None:
+        max_size = args.response_cache_max_size * 1024 * 1024
+    return ResponseCache(
+        args.response_cache, args.response_cache_mode, max_size
+    )
+
+
 def _get_api_client(args, commcarehq_base_url):
     return CommCareHqClient(
         url=commcarehq_base_url,
@@ -403,7 +627,52 @@ def _get_api_client(args, commcarehq_base_url):
         username=args.username,
         password=args.password,
         auth_mode=args.auth_mode,
-        version=args.api_version
+        version=args.api_version,
+        prefetch_pages=args.prefetch_pages,
+        stream_pages=args.stream_pages,
+        response_cache=_get_response_cache(args),
+        timeout=args.request_timeout,
+        rate_limiter=_get_rate_limiter(args, commcarehq_base_url),
+        # Enough connections for every thread that may make requests
+        pool_size=max(
+            DEFAULT_POOL_SIZE,
+            (args.date_shards + 1) * args.parallel_queries,
+            args.max_concurrent_requests,
+        ),
+        accept_encoding=args.accept_encoding,
+    )
+
+
+def _write_profile(args, profile):
+    print(profile.format(), file=sys.stderr)
+    if args.profile_query_json:
+        with open(args.profile_query_json, 'w') as f:
+            json.dump(profile.to_jvalue(), f, indent=4)
+
+
+def _dump_value(value):
+    # Optimized queries refer to built-in functions directly
+    if callable(value):
+        return f'<function {getattr(value, "__name__", repr(value))}>'
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _get_rate_limiter(args, commcarehq_base_url):
+    if not args.max_requests_per_second:
+        return None
+    return get_shared_token_bucket(
+        commcarehq_base_url, args.max_requests_per_second, args.request_burst
+    )
+
+
+def _get_adaptive_paging(args):
+    if not args.adaptive_batch_size:
+        return None
+    return AdaptivePaging(
+        min_page_size=args.min_batch_size,
+        max_page_size=args.max_batch_size,
+        target_seconds=args.target_page_seconds,
+        target_bytes=int(args.target_page_mb * 1024 * 1024),
     )
 
 
@@ -433,10 +702,53 @@ def force_lazy_result(lazy_result):
                 force_lazy_result(nested_result)
 
 
-def evaluate_query(env, query):
+def get_independent_queries(query):
+    """
+    Returns the queries of the nested top-level ``List`` of ``query``,
+    like the one built by ``get_queries``. Each of them uses its own
+    checkpoint manager and writes its own tables.
+    """
+    if isinstance(query, List):
+        return [
+            independent_query for item in query.items
+            for independent_query in get_independent_queries(item)
+        ]
+    return [query]
+
+
+def evaluate_queries_in_parallel(
+    get_envs, queries, max_workers, compile_query=False
+):
+    """
+    Evaluates each of ``queries`` like ``evaluate_query``, up to
+    ``max_workers`` at a time in threads. ``get_envs`` is called for
+    each query, and returns a new environment, e.g. with a writer of
+    its own, and the static environment that is its leftmost part.
+    Returns the first non-zero exit status, or 0.
+    """
+
+    def evaluate(query):
+        env, static_env = get_envs()
+        return evaluate_query(env, query, static_env, compile_query)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        exit_statuses = list(executor.map(evaluate, queries))
+    return next((status for status in exit_statuses if status), 0)
+
+
+def evaluate_query(env, query, static_env=None, compile_query=False):
+    """
+    Evaluates ``query`` in ``env``. If ``compile_query`` is set, the
+    query is compiled first, and names in ``static_env``, the leftmost
+    part of ``env``, are resolved when compiling. See
+    ``MiniLinq.compile``.
+    """
     with env:
         try:
-            lazy_result = query.eval(env)
+            if compile_query:
+                lazy_result = query.compile(static_env)(env)
+            else:
+                lazy_result = query.eval(env)
             force_lazy_result(lazy_result)
             return 0
         except requests.exceptions.RequestException as err:
@@ -447,6 +759,11 @@ def evaluate_query(env, query):
                 return EXIT_STATUS_ERROR
             else:
                 raise
+        except ResponseCacheMiss as err:
+            logger.error(
+                f'Stopping because a response is not cached: {err}'
+            )
+            return EXIT_STATUS_ERROR
         except ResourceRepeatException as err:
             logger.error(
                 'Stopping because the export is stuck.\n'
@@ -477,11 +794,16 @@ def main_with_args(args):
         )
         return EXIT_STATUS_ERROR
 
-    if not args.username:
+    # Credentials are not used when replaying cached responses
+    replaying = args.response_cache and (
+        args.response_cache_mode == MODE_REPLAY
+    )
+
+    if not args.username and not replaying:
         logger.warn("Username not provided")
         args.username = input('Please provide a username: ')
 
-    if not args.password:
+    if not args.password and not replaying:
         logger.warn("Password not provided")
         # Windows getpass does not accept unicode
         args.password = getpass.getpass()
@@ -493,16 +815,27 @@ def main_with_args(args):
     commcarehq_base_url = commcare_hq_aliases.get(
         args.commcare_hq, args.commcare_hq
     )
+    parallel = args.parallel_queries > 1 and args.output_format == 'sql'
     api_client = _get_api_client(args, commcarehq_base_url)
     lp = LocationInfoProvider(api_client, page_size=args.batch_size)
+    if args.locations or args.with_organization:
+        if args.max_concurrent_requests > 1:
+            lp.fetch_concurrently(args.max_concurrent_requests)
+        elif parallel:
+            # Queries evaluated in parallel only read the location info,
+            # so it is fetched before they start
+            lp.fetch()
     try:
         query = get_queries(args, writer, lp, column_enforcer)
     except DataExportException as err:
         logger.error(err.message)
         return EXIT_STATUS_ERROR
 
+    if args.optimized:
+        query = optimize(query)
+
     if args.dump_query:
-        print(json.dumps(query.to_jvalue(), indent=4))
+        print(json.dumps(query.to_jvalue(), indent=4, default=_dump_value))
         return EXIT_STATUS_SUCCESS
 
     checkpoint_manager = None
@@ -519,25 +852,85 @@ def main_with_args(args):
     elif since:
         logger.debug('Starting from %s', args.since)
 
-    cm = CheckpointManagerProvider(checkpoint_manager, since, args.start_over)
-    static_env = {
-        'commcarehq_base_url': commcarehq_base_url,
-        'get_checkpoint_manager': cm.get_checkpoint_manager,
-        'get_location_info': lp.get_location_info,
-        'get_location_ancestor': lp.get_location_ancestor
-    }
-    env = (
-        BuiltInEnv(static_env)
-        | CommCareHqEnv(api_client, until=until, page_size=args.batch_size)
-        | JsonPathEnv({})
-        | EmitterEnv(writer)
-    )
+    adaptive_paging = _get_adaptive_paging(args)
 
-    exit_status = evaluate_query(env, query)
+    def get_builtin_env(api_client, lp, checkpoint_manager):
+        cm = CheckpointManagerProvider(
+            checkpoint_manager, since, args.start_over
+        )
+        static_env = {
+            'commcarehq_base_url': commcarehq_base_url,
+            'get_checkpoint_manager': cm.get_checkpoint_manager,
+            'get_location_info': lp.get_location_info,
+            'get_location_ancestor': lp.get_location_ancestor
+        }
+        return BuiltInEnv(static_env) | CommCareHqEnv(
+            api_client,
+            until=until,
+            page_size=args.batch_size,
+            shards=args.date_shards,
+            adaptive_paging=adaptive_paging,
+            cache_results=args.cache_api_results,
+            max_items_in_memory=args.cache_max_items_in_memory,
+        )
+
+    JSONPATH_CACHE.prewarm(get_references(query))
+
+    profile = None
+    if args.profile_query or args.profile_query_json:
+        query, profile = profile_query(query)
+
+    if parallel:
+        # The writer was only needed to build the queries. Each query
+        # gets its own writer, API client and checkpoint manager, and
+        # location info, unless it was fetched already.
+        writer.engine.dispose()
+
+        def get_envs():
+            query_client = _get_api_client(args, commcarehq_base_url)
+            query_client.transfer_stats = api_client.transfer_stats
+            query_lp = lp
+            if not (args.locations or args.with_organization):
+                query_lp = LocationInfoProvider(
+                    query_client, page_size=args.batch_size
+                )
+            query_checkpoint_manager = None
+            if checkpoint_manager:
+                query_checkpoint_manager = get_checkpoint_manager(args)
+            builtin_env = get_builtin_env(
+                query_client, query_lp, query_checkpoint_manager
+            )
+            query_writer = _get_writer(
+                args.output_format, args.output, args.strict_types
+            )
+            env = builtin_env | JsonPathEnv({}) | EmitterEnv(query_writer)
+            return env, builtin_env
+
+        exit_status = evaluate_queries_in_parallel(
+            get_envs,
+            get_independent_queries(query),
+            args.parallel_queries,
+            args.compile_query,
+        )
+    else:
+        if args.parallel_queries > 1:
+            logger.warning(
+                'Ignoring --parallel-queries, which is only supported with '
+                '--output-format sql'
+            )
+        builtin_env = get_builtin_env(api_client, lp, checkpoint_manager)
+        env = builtin_env | JsonPathEnv({}) | EmitterEnv(writer)
+        exit_status = evaluate_query(
+            env, query, builtin_env, args.compile_query
+        )
+    logger.info('Received from CommCare HQ: %s', api_client.transfer_stats)
+    logger.debug('JSONPath cache: %s', JSONPATH_CACHE.stats())
+    if profile:
+        _write_profile(args, profile)
 
     if args.output_format == 'json':
         print(
-            json.dumps(
+            json_backend.dumps(
                 list(writer.tables.values()),
                 indent=4,
                 default=default_to_json
@@ -1,15 +1,24 @@
 
+import asyncio
 import copy
 import logging
 import sys
+import threading
+import time
+import weakref
 from math import ceil
 from urllib.parse import urlencode
 
 import backoff
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import AuthBase, HTTPDigestAuth
+from urllib3.util.request import ACCEPT_ENCODING
 
 import commcare_export
+from commcare_export import json_backend
+from commcare_export.json_stream import CHUNK_SIZE, StreamedPage
+from commcare_export.misc import iterate_in_background
 from commcare_export.repeatable_iterator import RepeatableIterator
 
 AUTH_MODE_PASSWORD = 'password'
@@ -18,6 +27,9 @@ AUTH_MODE_APIKEY = 'apikey'
 
 LATEST_KNOWN_VERSION = '0.5'
 RESOURCE_REPEAT_LIMIT = 10
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+DEFAULT_TIMEOUT = 60
+DEFAULT_POOL_SIZE = 10
 
 logger = logging.getLogger(__name__)
 
@@ -65,6 +77,22 @@ class ResourceRepeatException(Exception):
 class CommCareHqClient:
     """
     A connection to CommCareHQ for a particular version, project, and user.
+
+    Pass a ``ResponseCache`` as ``response_cache`` to record responses,
+    or to replay them instead of fetching them again.
+
+    ``timeout`` is the number of seconds to wait for the server to
+    respond, or to send more data.
+
+    If a ``TokenBucket`` is given as ``rate_limiter``, it is consulted
+    before every request, and told when the server asks to retry later.
+
+    ``pool_size`` is the number of connections to the server that are
+    kept alive for reuse, and should be at least the number of threads
+    making requests. ``accept_encoding`` defaults to every compression
+    that can be decoded: gzip and deflate, and brotli and zstd when
+    their libraries are installed. The number of bytes received, before
+    and after decompression, is counted in ``transfer_stats``.
     """
 
     def __init__(
@@ -75,12 +103,30 @@ class CommCareHqClient:
         password,
         auth_mode=AUTH_MODE_PASSWORD,
         version=LATEST_KNOWN_VERSION,
+        prefetch_pages=0,
+        stream_pages=False,
+        response_cache=None,
+        timeout=DEFAULT_TIMEOUT,
+        rate_limiter=None,
+        pool_size=DEFAULT_POOL_SIZE,
+        accept_encoding=None,
     ):
         self.version = version
         self.url = url
         self.project = project
         self.__auth = self._get_auth(username, password, auth_mode)
         self.__session = None
+        self.prefetch_pages = prefetch_pages
+        self.stream_pages = stream_pages
+        self.response_cache = response_cache
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.pool_size = pool_size
+        self.accept_encoding = accept_encoding or ACCEPT_ENCODING
+        self.transfer_stats = TransferStats()
+        # The size of the last response read by each thread, and the
+        # time taken by the request that got it
+        self._last_response = threading.local()
 
     @staticmethod
     def _get_auth(username, password, mode):
@@ -95,8 +141,16 @@ class CommCareHqClient:
     def session(self):
         if self.__session == None:
             self.__session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=self.pool_size,
+                pool_maxsize=self.pool_size,
+            )
+            self.__session.mount('https://', adapter)
+            self.__session.mount('http://', adapter)
             self.__session.headers.update({
-                'User-Agent': f'commcare-export/{commcare_export.__version__}'
+                'User-Agent': f'commcare-export/{commcare_export.__version__}',
+                'Accept-Encoding': self.accept_encoding,
+                'Connection': 'keep-alive',
             })
         return self.__session
 
@@ -109,6 +163,9 @@ class CommCareHqClient:
     def api_url(self):
         return f'{self.url}/a/{self.project}/api/v{self.version}'
 
+    def _get_resource_url(self, resource):
+        return f'{self.api_url}/{resource}/'
+
     @staticmethod
     def _should_raise_for_status(response):
         return "Retry-After" not in response.headers
@@ -123,6 +180,61 @@ class CommCareHqClient:
         particular use case in the hands of a trusted user; would likely
         want this to work like (or via) slumber.
         """
+        if self.response_cache:
+            # Keyed by URL, so that projects can share a cache
+            resource_url = self._get_resource_url(resource)
+            query = _params_to_url(params or {})
+            start = time.monotonic()
+            content = self.response_cache.get(resource_url, query)
+            self._last_response.elapsed = time.monotonic() - start
+            if content is None:
+                content = self._get_content(resource, params)
+                self.response_cache.put(resource_url, query, content)
+        else:
+            content = self._get_content(resource, params)
+        self._last_response.num_bytes = len(content)
+        return json_backend.loads(content)
+
+    def get_streamed(self, resource, params=None, stats=None):
+        """
+        Like ``get``, but returns a ``StreamedPage`` that decodes the
+        response as it is read.
+
+        If a ``PageStats`` is given as ``stats``, the time spent
+        fetching the response, and its size, are added to it. Time
+        spent waiting to retry a failed request is not.
+        """
+        stats = stats or PageStats()
+        if self.response_cache:
+            resource_url = self._get_resource_url(resource)
+            query = _params_to_url(params or {})
+            start = time.monotonic()
+            chunks = self.response_cache.get_chunks(resource_url, query)
+            if chunks is not None:
+                stats.elapsed += time.monotonic() - start
+                return StreamedPage(
+                    stats.measure(chunks), close=chunks.close
+                )
+
+        response = self._get_response(resource, params, stream=True)
+        stats.elapsed += self._last_response.elapsed
+        chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+        if self.response_cache:
+            chunks = self.response_cache.tee(resource_url, query, chunks)
+
+        def close():
+            self.transfer_stats.add(response, stats.num_bytes)
+            response.close()
+
+        return StreamedPage(stats.measure(chunks), close=close)
+
+    def _get_content(self, resource, params):
+        response = self._get_response(resource, params)
+        content = response.content
+        self.transfer_stats.add(response, len(content))
+        return content
+
+    def _get_response(self, resource, params=None, stream=False):
         @backoff.on_predicate(
             backoff.runtime,
             predicate=lambda r: r.status_code == 429,
@@ -140,10 +252,24 @@ class CommCareHqClient:
         )
         def _get(resource, params=None):
             logger.debug("Fetching '%s' batch: %s", resource, params)
-            resource_url = f'{self.api_url}/{resource}/'
+            resource_url = self._get_resource_url(resource)
+            kwargs = {'stream': True} if stream else {}
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            start = time.monotonic()
             response = self.session.get(
-                resource_url, params=params, auth=self.__auth, timeout=60
+                resource_url,
+                params=params,
+                auth=self.__auth,
+                timeout=self.timeout,
+                **kwargs,
             )
+            # Only the last, successful, request is timed
+            self._last_response.elapsed = time.monotonic() - start
+            if self.rate_limiter and response.status_code == 429:
+                self.rate_limiter.penalize(
+                    float(response.headers.get("Retry-After", 1.0))
+                )
             if self._should_raise_for_status(response):
                 try:
                     response.raise_for_status()
@@ -164,8 +290,7 @@ class CommCareHqClient:
 
             return response
 
-        response = _get(resource, params)
-        return response.json()
+        return _get(resource, params)
 
     def iterate(
         self,
@@ -177,77 +302,323 @@ class CommCareHqClient:
         """
         Assumes the endpoint is a list endpoint, and iterates over it
         making a lot of assumptions that it is like a tastypie endpoint.
+
+        If the client was created with ``prefetch_pages``, pages are
+        fetched in a background thread, up to that many pages ahead of
+        the consumer. Checkpoints are still set by the consumer, after
+        it has been given every object in the page.
+
+        If the client was created with ``stream_pages``, each page is
+        decoded as it is read, and objects are yielded one at a time.
+        Pages are not prefetched in this mode.
         """
-        unknown_count = -1
         params = dict(params or {})
 
         def iterate_resource(resource=resource, params=params):
-            more_to_fetch = True
-            last_batch_ids = set()
-            total_count = unknown_count
-            fetched = 0
-            repeat_counter = 0
-            last_params = None
-
-            while more_to_fetch:
-                if params == last_params:
-                    repeat_counter += 1
-                else:
-                    repeat_counter = 0
-                if repeat_counter >= RESOURCE_REPEAT_LIMIT:
-                    raise ResourceRepeatException(
-                        f"Requested resource '{resource}' {repeat_counter} "
-                        "times with same parameters"
-                    )
-
-                batch = self.get(resource, params)
-                last_params = copy.copy(params)
-                batch_meta = batch['meta']
-                if total_count == unknown_count or fetched >= total_count:
-                    if batch_meta.get('total_count'):
-                        total_count = int(batch_meta['total_count'])
-                    else:
-                        total_count = unknown_count
-                    fetched = 0
-
-                batch_objects = batch['objects']
-                fetched += len(batch_objects)
-                logger.debug('Received %s of %s', fetched, total_count)
-                if not batch_objects:
-                    more_to_fetch = False
-                else:
-                    got_new_data = False
-                    for obj in batch_objects:
-                        if obj['id'] not in last_batch_ids:
-                            yield obj
-                            got_new_data = True
-
-                    if batch_meta.get('next'):
-                        last_batch_ids = {obj['id'] for obj in batch_objects}
-                        params = paginator.next_page_params_from_batch(batch)
-                        if not params:
-                            more_to_fetch = False
-                    else:
-                        more_to_fetch = False
-
-                    limit = batch_meta.get('limit')
-                    if more_to_fetch:
-                        # Handle the case where API is 'non-counting'
-                        # and repeats the last batch
-                        repeated_last_page_of_non_counting_resource = (
-                            not got_new_data and total_count == unknown_count
-                            and (limit and len(batch_objects) < limit)
-                        )
-                        more_to_fetch = not repeated_last_page_of_non_counting_resource
-
-                    paginator.set_checkpoint(
-                        checkpoint_manager,
-                        batch,
-                        not more_to_fetch
-                    )
+            batches = self._iterate_batches(resource, paginator, params)
+            if self.prefetch_pages:
+                batches = iterate_in_background(batches, self.prefetch_pages)
+
+            for batch, new_objects, is_final in batches:
+                yield from new_objects
+                paginator.set_checkpoint(checkpoint_manager, batch, is_final)
+
+        def iterate_streamed_resource(resource=resource, params=params):
+            return self._iterate_streamed(
+                resource, paginator, params, checkpoint_manager
+            )
 
+        if self.stream_pages:
+            return RepeatableIterator(iterate_streamed_resource)
         return RepeatableIterator(iterate_resource)
 
+    def _iterate_batches(self, resource, paginator, params):
+        """
+        Yields a tuple for each non-empty page of ``resource``: the
+        page, the objects that were not in the previous page, and
+        whether this is the last page.
+        """
+        pages = _PageLoop(resource, params)
+        while pages.more_to_fetch:
+            self._last_response.num_bytes = None
+            batch = self.get(resource, pages.next_params())
+            pages.received_meta(batch['meta'])
+
+            batch_objects = batch['objects']
+            paginator.record_page(
+                self._last_response.elapsed,
+                self._last_response.num_bytes,
+                len(batch_objects),
+            )
+            new_objects = [obj for obj in batch_objects if pages.is_new(obj)]
+            if pages.finish_page(
+                paginator,
+                batch,
+                [obj['id'] for obj in batch_objects],
+                got_new_data=bool(new_objects),
+            ):
+                yield batch, new_objects, not pages.more_to_fetch
+
+    def _iterate_streamed(
+        self, resource, paginator, params, checkpoint_manager
+    ):
+        """
+        Yields the objects of ``resource`` as each page is decoded.
+        Only the last object of a page is kept, for the paginator to
+        determine the next page and the checkpoint.
+        """
+        pages = _PageLoop(resource, params)
+        while pages.more_to_fetch:
+            stats = PageStats()
+            page = self.get_streamed(resource, pages.next_params(), stats)
+            with page:
+                pages.received_meta(page.meta)
+
+                batch_ids = []
+                last_obj = None
+                got_new_data = False
+                for obj in page.objects():
+                    batch_ids.append(obj['id'])
+                    last_obj = obj
+                    if pages.is_new(obj):
+                        got_new_data = True
+                        yield obj
+
+            paginator.record_page(
+                stats.elapsed, stats.num_bytes, len(batch_ids)
+            )
+
+            batch = {
+                'meta': page.meta,
+                'objects': [] if last_obj is None else [last_obj],
+            }
+            if pages.finish_page(paginator, batch, batch_ids, got_new_data):
+                paginator.set_checkpoint(
+                    checkpoint_manager, batch, not pages.more_to_fetch
+                )
+
+
+class TransferStats:
+    """
+    The number of responses received, and their size on the wire and
+    after decompression.
+    """
+
+    def __init__(self):
+        self.responses = 0
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, response, decoded_bytes):
+        wire_bytes = _get_wire_bytes(response, decoded_bytes)
+        with self._lock:
+            self.responses += 1
+            self.wire_bytes += wire_bytes
+            self.decoded_bytes += decoded_bytes
+
+    def __str__(self):
+        ratio = self.decoded_bytes / self.wire_bytes if self.wire_bytes else 1
+        return (
+            f'{self.responses} responses, {self.wire_bytes} bytes received, '
+            f'{self.decoded_bytes} bytes decoded ({ratio:.1f}x)'
+        )
+
+
+def _get_wire_bytes(response, decoded_bytes):
+    try:
+        # The number of bytes read from the socket, before decompression
+        return response.raw.tell()
+    except AttributeError:
+        return decoded_bytes
+
+
+class PageStats:
+    """
+    The time spent fetching a page, and its size in bytes.
+    """
+
+    def __init__(self):
+        self.elapsed = 0.0
+        self.num_bytes = 0
+
+    def measure(self, chunks):
+        """
+        Yields ``chunks``, adding the time spent reading them, but not
+        the time spent by the consumer, to ``elapsed``.
+        """
+        chunks = iter(chunks)
+        while True:
+            start = time.monotonic()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                self.elapsed += time.monotonic() - start
+                return
+            self.elapsed += time.monotonic() - start
+            self.num_bytes += len(chunk)
+            yield chunk
+
+
+class _PageLoop:
+    """
+    Bookkeeping for paging through a list endpoint: it detects repeated
+    requests, skips objects repeated from the previous page, and
+    decides whether there is another page to fetch.
+    """
+
+    unknown_count = -1
+
+    def __init__(self, resource, params):
+        self.resource = resource
+        self.params = params
+        self.more_to_fetch = True
+        self.last_batch_ids = set()
+        self.total_count = self.unknown_count
+        self.fetched = 0
+        self.repeat_counter = 0
+        self.last_params = None
+
+    def next_params(self):
+        if self.params == self.last_params:
+            self.repeat_counter += 1
+        else:
+            self.repeat_counter = 0
+        if self.repeat_counter >= RESOURCE_REPEAT_LIMIT:
+            raise ResourceRepeatException(
+                f"Requested resource '{self.resource}' {self.repeat_counter} "
+                "times with same parameters"
+            )
+        self.last_params = copy.copy(self.params)
+        return self.params
+
+    def received_meta(self, batch_meta):
+        if (
+            self.total_count == self.unknown_count
+            or self.fetched >= self.total_count
+        ):
+            if batch_meta.get('total_count'):
+                self.total_count = int(batch_meta['total_count'])
+            else:
+                self.total_count = self.unknown_count
+            self.fetched = 0
+
+    def is_new(self, obj):
+        return obj['id'] not in self.last_batch_ids
+
+    def finish_page(self, paginator, batch, batch_ids, got_new_data):
+        """
+        Returns False if the page was empty.
+        """
+        self.fetched += len(batch_ids)
+        logger.debug('Received %s of %s', self.fetched, self.total_count)
+        if not batch_ids:
+            self.more_to_fetch = False
+            return False
+
+        batch_meta = batch['meta']
+        if batch_meta.get('next'):
+            self.last_batch_ids = set(batch_ids)
+            self.params = paginator.next_page_params_from_batch(batch)
+            if not self.params:
+                self.more_to_fetch = False
+        else:
+            self.more_to_fetch = False
+
+        limit = batch_meta.get('limit')
+        if self.more_to_fetch:
+            # Handle the case where API is 'non-counting'
+            # and repeats the last batch
+            repeated_last_page_of_non_counting_resource = (
+                not got_new_data and self.total_count == self.unknown_count
+                and (limit and len(batch_ids) < limit)
+            )
+            self.more_to_fetch = not repeated_last_page_of_non_counting_resource
+        return True
+
+
+class AsyncCommCareHqClient:
+    """
+    An asyncio interface to a ``CommCareHqClient``, with the same
+    ``get`` and ``iterate`` contract, that allows at most
+    ``max_concurrent_requests`` requests to be in flight at once.
+
+    Requests are made by the wrapped client in worker threads, so they
+    keep its behaviour on 429 responses and its exponential backoff.
+
+    e.g. ::
+
+        async def fetch_all(async_client, paginators):
+            return await asyncio.gather(*[
+                async_client.get_all(resource, paginator)
+                for resource, paginator in paginators.items()
+            ])
+
+    """
+
+    def __init__(
+        self,
+        client,
+        max_concurrent_requests=DEFAULT_MAX_CONCURRENT_REQUESTS,
+    ):
+        self.client = client
+        self.max_concurrent_requests = max_concurrent_requests
+        self._semaphores: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
+
+    @property
+    def semaphore(self):
+        # asyncio primitives belong to an event loop
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(
+                self.max_concurrent_requests
+            )
+        return self._semaphores[loop]
+
+    async def get(self, resource, params=None):
+        async with self.semaphore:
+            return await asyncio.to_thread(self.client.get, resource, params)
+
+    async def iterate(
+        self,
+        resource,
+        paginator,
+        params=None,
+        checkpoint_manager=None,
+    ):
+        """
+        An async generator of the objects of ``resource``. See
+        ``CommCareHqClient.iterate``.
+        """
+        batches = self.client._iterate_batches(
+            resource, paginator, dict(params or {})
+        )
+        while True:
+            async with self.semaphore:
+                next_batch = await asyncio.to_thread(next, batches, None)
+            if next_batch is None:
+                break
+
+            batch, new_objects, is_final = next_batch
+            for obj in new_objects:
+                yield obj
+            paginator.set_checkpoint(checkpoint_manager, batch, is_final)
+
+    async def get_all(
+        self,
+        resource,
+        paginator,
+        params=None,
+        checkpoint_manager=None,
+    ):
+        return [
+            obj async for obj in self.iterate(
+                resource, paginator, params, checkpoint_manager
+            )
+        ]
+
 
 class MockCommCareHqClient:
     """
@@ -276,6 +647,7 @@ class MockCommCareHqClient:
                 for (params, result) in resource_results
             } for (resource, resource_results) in mock_data.items()
         }
+        self.transfer_stats = TransferStats()
 
     def iterate(
         self, resource, paginator, params=None, checkpoint_manager=None
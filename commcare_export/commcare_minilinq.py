@@ -6,15 +6,25 @@ API directly.
 """
 import json
 import logging
+import threading
 from enum import Enum
-from typing import Any
+from typing import Any, Union
 from urllib.parse import parse_qs, urlparse
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 from dateutil.parser import ParserError, parse
 
 from commcare_export.env import CannotBind, CannotReplace, DictEnv
-from commcare_export.misc import unwrap
+from commcare_export.misc import (
+    BackgroundIterator,
+    SpillingBackgroundIterator,
+    unwrap,
+)
+from commcare_export.repeatable_iterator import (
+    DEFAULT_MAX_ITEMS_IN_MEMORY,
+    CachingRepeatableIterator,
+    RepeatableIterator,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +42,17 @@ SUPPORTED_RESOURCES = {
 DEFAULT_PAGE_SIZE = 1000
 DEFAULT_UCR_PAGE_SIZE = 10000
 
+# Resources whose `indexed_on` date range can be split into shards that
+# are fetched in parallel
+SHARDABLE_RESOURCES = {'form', 'case'}
+# The number of pages each shard may fetch ahead of the consumer
+SHARD_BUFFER_PAGES = 5
+
+DEFAULT_MIN_PAGE_SIZE = 50
+DEFAULT_MAX_PAGE_SIZE = 5000
+DEFAULT_TARGET_PAGE_SECONDS = 10
+DEFAULT_TARGET_PAGE_BYTES = 20 * 1024 * 1024
+
 
 class PaginationMode(Enum):
     date_indexed = "date_indexed"
@@ -120,6 +141,7 @@ def get_paginator(
     resource,
     page_size=None,
     pagination_mode=PaginationMode.date_indexed,
+    adaptive_paging=None,
 ):
     paginators: dict[PaginationMode, dict[str, Any]] = {
         PaginationMode.date_indexed: {
@@ -143,19 +165,154 @@ def get_paginator(
             'ucr': UCRPaginator(page_size),
         },
     }
-    return paginators[pagination_mode].get(resource, SimplePaginator(page_size))
+    paginator = paginators[pagination_mode].get(
+        resource, SimplePaginator(page_size)
+    )
+    if adaptive_paging:
+        paginator.adaptive_page_size = adaptive_paging.get_page_size(
+            resource, paginator.page_size
+        )
+    return paginator
+
+
+class AdaptivePaging:
+    """
+    Settings for adapting the page size of each resource to the time
+    that pages take to fetch and to their size. Each resource has its
+    own ``AdaptivePageSize``, which is shared by all of its paginators.
+    """
+
+    def __init__(
+        self,
+        min_page_size=DEFAULT_MIN_PAGE_SIZE,
+        max_page_size=DEFAULT_MAX_PAGE_SIZE,
+        target_seconds=DEFAULT_TARGET_PAGE_SECONDS,
+        target_bytes=DEFAULT_TARGET_PAGE_BYTES,
+    ):
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self._page_sizes = {}
+        self._lock = threading.Lock()
+
+    def get_page_size(self, resource, initial_page_size):
+        with self._lock:
+            if resource not in self._page_sizes:
+                self._page_sizes[resource] = AdaptivePageSize(
+                    resource, initial_page_size, self
+                )
+            return self._page_sizes[resource]
+
+
+class AdaptivePageSize:
+    """
+    The page size of one resource. After each page it moves towards
+    the number of objects that could be fetched in the target time, and
+    in the target number of bytes, given the time and bytes per object
+    of that page.
+
+    The page size changes by at most ``MAX_STEP`` times per page, and is
+    not changed by less than ``MIN_CHANGE`` of itself, so that a single
+    slow page does not swing it, and it does not change on every page.
+    """
+
+    MAX_STEP = 2
+    MIN_CHANGE = 0.2
+
+    def __init__(self, resource, page_size, settings):
+        self.resource = resource
+        self.settings = settings
+        self.page_size = self._clamp(int(page_size))
+        self._lock = threading.Lock()
+
+    def record_page(self, elapsed, num_bytes, num_objects):
+        """
+        :param elapsed: Seconds taken to fetch the page
+        :param num_bytes: Size of the response, or ``None`` if unknown
+        :param num_objects: Number of objects in the page
+        """
+        if not num_objects:
+            return
+        targets = []
+        if elapsed:
+            targets.append(
+                self.settings.target_seconds * num_objects / elapsed
+            )
+        if num_bytes:
+            targets.append(
+                self.settings.target_bytes * num_objects / num_bytes
+            )
+        if not targets:
+            return
+
+        with self._lock:
+            target = min(
+                max(min(targets), self.page_size / self.MAX_STEP),
+                self.page_size * self.MAX_STEP,
+            )
+            new_page_size = self._clamp(int(target))
+            if (
+                abs(new_page_size - self.page_size)
+                < self.page_size * self.MIN_CHANGE
+            ):
+                return
+            logger.info(
+                'Changing the page size of "%s" from %s to %s. The last '
+                'page of %s objects took %.2fs and was %s bytes.',
+                self.resource,
+                self.page_size,
+                new_page_size,
+                num_objects,
+                elapsed,
+                num_bytes if num_bytes is not None else 'an unknown number of',
+            )
+            self.page_size = new_page_size
+
+    def _clamp(self, page_size):
+        return max(
+            self.settings.min_page_size,
+            min(page_size, self.settings.max_page_size),
+        )
 
 
 class CommCareHqEnv(DictEnv):
     """
     An environment providing primitives for pulling from the
     CommCareHq API.
+
+    If ``shards`` is greater than 1, date-indexed form and case data is
+    fetched as that many contiguous ``indexed_on`` date ranges in
+    parallel. See ``ShardedApiData``.
+
+    If ``adaptive_paging`` is given, the page size of each resource
+    starts at ``page_size`` and is adapted as pages are fetched. See
+    ``AdaptivePaging``.
+
+    If ``cache_results`` is True, the documents returned by ``api_data``
+    are cached as they are fetched, so that iterating over them again
+    does not fetch them again. Up to ``max_items_in_memory`` documents
+    per call are kept in memory, and the rest in a temporary file. See
+    ``CachingRepeatableIterator``.
     """
 
-    def __init__(self, commcare_hq_client, page_size=None, until=None):
+    def __init__(
+        self,
+        commcare_hq_client,
+        page_size=None,
+        until=None,
+        shards=1,
+        adaptive_paging=None,
+        cache_results=False,
+        max_items_in_memory=DEFAULT_MAX_ITEMS_IN_MEMORY,
+    ):
         self.commcare_hq_client = commcare_hq_client
         self.until = until
         self.page_size = page_size
+        self.shards = shards
+        self.adaptive_paging = adaptive_paging
+        self.cache_results = cache_results
+        self.max_items_in_memory = max_items_in_memory
         super(CommCareHqEnv, self).__init__({'api_data': self.api_data})
 
     @unwrap('checkpoint_manager')
@@ -169,20 +326,54 @@ class CommCareHqEnv(DictEnv):
         if resource not in SUPPORTED_RESOURCES:
             raise ValueError(f'Unknown API resource "{resource}')
 
+        if (
+            self.shards > 1
+            and resource in SHARDABLE_RESOURCES
+            and checkpoint_manager.pagination_mode
+            == PaginationMode.date_indexed
+        ):
+            sharded = ShardedApiData(
+                self.commcare_hq_client,
+                resource,
+                checkpoint_manager,
+                payload,
+                include_referenced_items,
+                page_size=self.page_size,
+                until=self.until,
+                shards=self.shards,
+                adaptive_paging=self.adaptive_paging,
+            )
+            return self._cached(RepeatableIterator(sharded.iterate))
+
         paginator = get_paginator(
-            resource, self.page_size, checkpoint_manager.pagination_mode
+            resource,
+            self.page_size,
+            checkpoint_manager.pagination_mode,
+            self.adaptive_paging,
         )
         paginator.init(payload, include_referenced_items, self.until)
         initial_params = paginator.next_page_params_since(
             checkpoint_manager.since_param
         )
-        return self.commcare_hq_client.iterate(
-            resource,
-            paginator,
-            params=initial_params,
-            checkpoint_manager=checkpoint_manager
+        return self._cached(
+            self.commcare_hq_client.iterate(
+                resource,
+                paginator,
+                params=initial_params,
+                checkpoint_manager=checkpoint_manager
+            )
+        )
+
+    def _cached(self, results):
+        if not self.cache_results:
+            return results
+        return CachingRepeatableIterator(
+            lambda: iter(results), self.max_items_in_memory
         )
 
+    supports_bind = False
+    supports_replace = False
+
     def bind(self, name, value):
         raise CannotBind()
 
@@ -190,6 +381,195 @@ class CommCareHqEnv(DictEnv):
         raise CannotReplace()
 
 
+class ShardedApiData:
+    """
+    Splits the ``indexed_on`` range of a date-indexed resource into
+    contiguous shards, and paginates each shard with its own
+    ``DatePaginator`` in a background thread.
+
+    Objects are yielded in shard order. While the consumer gets the
+    objects of the first shard, the other shards keep fetching: objects
+    that they fetch beyond ``SHARD_BUFFER_PAGES`` pages are kept in a
+    temporary file. Each shard records its
+    checkpoints instead of setting them, and they are set when the
+    consumer reaches them, so a checkpoint never moves past data in an
+    earlier shard that has not been consumed yet. Only the last shard
+    can set a final checkpoint. If it has no data, the last checkpoint
+    of an earlier shard is set again as final, once every shard is
+    done.
+    """
+
+    def __init__(
+        self,
+        commcare_hq_client,
+        resource,
+        checkpoint_manager,
+        payload=None,
+        include_referenced_items=None,
+        page_size=None,
+        until=None,
+        shards=2,
+        adaptive_paging=None,
+    ):
+        self.commcare_hq_client = commcare_hq_client
+        self.resource = resource
+        self.checkpoint_manager = checkpoint_manager
+        self.payload = payload
+        self.include_referenced_items = include_referenced_items
+        self.page_size = page_size or DEFAULT_PAGE_SIZE
+        self.until = until
+        self.shards = shards
+        self.adaptive_paging = adaptive_paging
+
+    def iterate(self):
+        ranges = self.get_ranges()
+        if not ranges:
+            return
+
+        shard_iterators: list[Union[
+            BackgroundIterator, SpillingBackgroundIterator
+        ]] = []
+        try:
+            for i, (start, end) in enumerate(ranges):
+                is_last_shard = i == len(ranges) - 1
+                shard = self._iterate_shard(start, end, is_last_shard)
+                max_buffered = int(self.page_size) * SHARD_BUFFER_PAGES
+                if i == 0:
+                    shard_iterators.append(
+                        BackgroundIterator(shard, max_buffered)
+                    )
+                else:
+                    # Later shards keep fetching while the consumer is
+                    # still busy with earlier ones
+                    shard_iterators.append(
+                        SpillingBackgroundIterator(shard, max_buffered)
+                    )
+            last_checkpoint = None
+            for shard_iterator in shard_iterators:
+                for item in shard_iterator:
+                    if isinstance(item, _Checkpoint):
+                        item.set(self.checkpoint_manager)
+                        last_checkpoint = item
+                    else:
+                        yield item
+            if last_checkpoint and not last_checkpoint.is_final:
+                last_checkpoint.set(self.checkpoint_manager, is_final=True)
+        finally:
+            for shard_iterator in shard_iterators:
+                shard_iterator.close()
+
+    def get_ranges(self):
+        """
+        Returns a list of ``(start, end)`` tuples. The end of the last
+        range is ``self.until``, which may be ``None``.
+        """
+        start = self.checkpoint_manager.since_param or self._get_first_date()
+        if start is None:
+            return []
+        start = _to_naive_utc(start)
+        until = _to_naive_utc(self.until) if self.until else None
+        end = until or datetime.utcnow()
+        if end <= start:
+            return [(start, until)]
+
+        shard_length = (end - start) / self.shards
+        starts = [start + shard_length * i for i in range(self.shards)]
+        ends = [
+            # `indexed_on_end` is inclusive
+            next_start - timedelta(microseconds=1)
+            for next_start in starts[1:]
+        ] + [until]
+        return list(zip(starts, ends))
+
+    def _get_first_date(self):
+        paginator = get_paginator(self.resource, 1)
+        paginator.init(self.payload, self.include_referenced_items)
+        batch = self.commcare_hq_client.get(
+            self.resource, paginator.next_page_params_since()
+        )
+        return paginator.get_since_date(batch) if batch else None
+
+    def _iterate_shard(self, start, end, is_last_shard):
+        paginator = get_paginator(
+            self.resource,
+            self.page_size,
+            adaptive_paging=self.adaptive_paging,
+        )
+        paginator.init(self.payload, self.include_referenced_items, end)
+        checkpoint_manager = _ShardCheckpointManager(
+            self.checkpoint_manager, is_last_shard
+        )
+        logger.info(
+            'Fetching %s shard from %s until %s', self.resource, start, end
+        )
+        objects = self.commcare_hq_client.iterate(
+            self.resource,
+            paginator,
+            params=paginator.next_page_params_since(start),
+            checkpoint_manager=checkpoint_manager,
+        )
+        for obj in objects:
+            yield from checkpoint_manager.pop_checkpoints()
+            yield obj
+        yield from checkpoint_manager.pop_checkpoints()
+
+
+def _to_naive_utc(date):
+    # e.g. `--since` with a UTC offset. Dates from CommCare HQ are naive,
+    # in UTC.
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+class _Checkpoint:
+
+    def __init__(
+        self, checkpoint_time, is_final=False, doc_id=None, cursor=None
+    ):
+        self.checkpoint_time = checkpoint_time
+        self.is_final = is_final
+        self.doc_id = doc_id
+        self.cursor = cursor
+
+    def set(self, checkpoint_manager, is_final=None):
+        checkpoint_manager.set_checkpoint(
+            self.checkpoint_time,
+            self.is_final if is_final is None else is_final,
+            doc_id=self.doc_id,
+            cursor=self.cursor,
+        )
+
+
+class _ShardCheckpointManager:
+    """
+    Records the checkpoints set by a shard's paginator so that they can
+    be passed to the consumer in order with the shard's objects.
+    """
+
+    def __init__(self, checkpoint_manager, is_last_shard):
+        self.since_param = checkpoint_manager.since_param
+        self.pagination_mode = checkpoint_manager.pagination_mode
+        self.is_last_shard = is_last_shard
+        self.checkpoints = []
+
+    def set_checkpoint(
+        self, checkpoint_time, is_final=False, doc_id=None, cursor=None
+    ):
+        self.checkpoints.append(
+            _Checkpoint(
+                checkpoint_time,
+                is_final and self.is_last_shard,
+                doc_id=doc_id,
+                cursor=cursor,
+            )
+        )
+
+    def pop_checkpoints(self):
+        checkpoints, self.checkpoints = self.checkpoints, []
+        return checkpoints
+
+
 class SimplePaginator:
     """
     Paginate based on the 'next' URL provided in the API response.
@@ -199,6 +579,13 @@ class SimplePaginator:
         page_size = page_size if page_size else 1000
         self.page_size = page_size
         self.params = params
+        self.adaptive_page_size = None
+
+    @property
+    def limit(self):
+        if self.adaptive_page_size:
+            return self.adaptive_page_size.page_size
+        return self.page_size
 
     def init(self, payload=None, include_referenced_items=None, until=None):
         self.payload = dict(payload or {})  # Do not mutate passed-in dicts
@@ -206,8 +593,11 @@ class SimplePaginator:
         self.until = until
 
     def next_page_params_since(self, since=None):
-        params = self.payload
-        params['limit'] = self.page_size
+        # A copy per page: with prefetching, the params of the next page
+        # are made in another thread while ``set_checkpoint`` reads the
+        # payload
+        params = dict(self.payload)
+        params['limit'] = self.limit
 
         if (since or self.until) and self.params:
             params.update(self.params(since, self.until))
@@ -222,7 +612,16 @@ class SimplePaginator:
 
     def next_page_params_from_batch(self, batch):
         if batch['meta']['next']:
-            return parse_qs(urlparse(batch['meta']['next']).query)
+            params = parse_qs(urlparse(batch['meta']['next']).query)
+            if self.adaptive_page_size and 'limit' in params:
+                params['limit'] = [str(self.limit)]
+            return params
+
+    def record_page(self, elapsed, num_bytes, num_objects):
+        if self.adaptive_page_size:
+            self.adaptive_page_size.record_page(
+                elapsed, num_bytes, num_objects
+            )
 
     def set_checkpoint(self, *args, **kwargs):
         pass
@@ -316,9 +715,9 @@ class UCRPaginator(SimplePaginator):
             return self.payload | params
 
     def next_page_params_since(self, since=None):
-        params = self.payload
+        params = dict(self.payload)
         params['cursor'] = since
-        params["limit"] = self.page_size
+        params["limit"] = self.limit
         return params
 
     def set_checkpoint(self, checkpoint_manager, batch, is_final):
@@ -3,12 +3,15 @@ import json
 import logging
 import operator
 import sys
+import threading
 import uuid
+from collections import OrderedDict
+from collections.abc import Mapping
 from typing import Any, Dict, Union, overload
 
 import pytz
 
-from commcare_export.jsonpath_utils import split_leftmost
+from commcare_export.jsonpath_utils import compile_find, split_leftmost
 from commcare_export.misc import unwrap, unwrap_val
 from commcare_export.repeatable_iterator import RepeatableIterator
 from jsonpath_ng import jsonpath
@@ -16,7 +19,92 @@ from jsonpath_ng.parser import parse as parse_jsonpath
 
 logger = logging.getLogger(__name__)
 
-JSONPATH_CACHE: dict[str, Any] = {}
+# Currently hardcoded because it is a global is jsonpath-ng
+# Probably not widely used, but will require refactor if so
+jsonpath.auto_id_field = "id"
+
+# Bound to restrict the lookups of a ``JsonPathEnv`` to paths from `$`
+ROOT_ONLY = '__root_only'
+
+_NOT_SET = object()
+
+# The number of parsed JSONPath expressions to keep. Queries with
+# mappings look up a path for every mapped value, so the number of
+# distinct paths is unbounded.
+DEFAULT_JSONPATH_CACHE_SIZE = 10000
+
+
+class JsonPathCache:
+    """
+    Parsed JSONPath expressions, and the quicker functions that find
+    their data if they are simple (see ``compile_find``), for the
+    ``maxsize`` most recently used JSONPath strings.
+    """
+
+    def __init__(self, maxsize=DEFAULT_JSONPATH_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, jsonpath_string):
+        """
+        Returns the parsed expression for ``jsonpath_string`` and the
+        result of ``compile_find`` for it.
+        """
+        with self._lock:
+            entry = self._entries.get(jsonpath_string)
+            if entry is not None:
+                self._entries.move_to_end(jsonpath_string)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        jsonpath_expr = parse_jsonpath(jsonpath_string)
+        entry = (jsonpath_expr, compile_find(jsonpath_expr))
+        with self._lock:
+            self._entries[jsonpath_string] = entry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def prewarm(self, jsonpath_strings):
+        """
+        Parses ``jsonpath_strings`` that are not cached yet, e.g. those
+        of the references of a query, before it is evaluated. Strings
+        that are not JSONPath expressions, like the names of some
+        built-in functions, are skipped.
+        """
+        for jsonpath_string in jsonpath_strings:
+            with self._lock:
+                cached = jsonpath_string in self._entries
+            if cached:
+                continue
+            try:
+                self.get(jsonpath_string)
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+JSONPATH_CACHE = JsonPathCache()
 
 
 class CannotBind(Exception):
@@ -44,6 +132,12 @@ class Env:
     and customization.
     """
 
+    # Whether ``bind`` and ``replace`` can succeed. ``CompositeEnv``
+    # does not call them for environments that always raise
+    # ``CannotBind`` or ``CannotReplace``.
+    supports_bind = True
+    supports_replace = True
+
     #
     # Interface
     #
@@ -64,6 +158,13 @@ class Env:
         """
         raise NotImplementedError()
 
+    def lookup_skipping(self, static_env: 'Env', key: str) -> Any:
+        """
+        Like ``lookup``, but ``static_env``, a part of this environment
+        that is known not to contain ``key``, is not searched.
+        """
+        return self.lookup(key)
+
     def replace(self, data: Dict[str, Any]) -> 'Env':
         """
         Completely replace the environment with new data (somewhat like
@@ -75,6 +176,14 @@ class Env:
         """
         raise NotImplementedError()
 
+    def known_names(self):
+        """
+        Returns the names that ``lookup`` can find, if it raises
+        ``NotFound`` for any other name, or None if it may find any
+        name.
+        """
+        return None
+
     # Minor impurity of the idea of a binding env: also allow `Emit` to
     # directly call into the environment. It is up to the env whether to
     # store it, write it immediately, or do something clever with
@@ -95,7 +204,7 @@ class Env:
     # Fluent interface to combinators
     #
     def __or__(self, other):
-        return OrElse(self, other)
+        return CompositeEnv([self, other])
 
 
 #
@@ -110,6 +219,10 @@ class OrElse(Env):
     as the two envs might have entirely different mechanisms (for
     example a magic environment for special operators vs a JsonPathEnv
     that always returns a list and operates only on simple data)
+
+    ``a | b`` creates a ``CompositeEnv`` instead, which is quicker to
+    use. ``OrElse`` is kept for code outside this package that creates
+    it directly.
     """
 
     def __init__(self, left, right):
@@ -128,6 +241,14 @@ class OrElse(Env):
         except NotFound:
             return self.right.lookup(name)
 
+    def lookup_skipping(self, static_env, name):
+        if self.left is static_env:
+            return self.right.lookup(name)
+        try:
+            return self.left.lookup_skipping(static_env, name)
+        except NotFound:
+            return self.right.lookup(name)
+
     def replace(self, data):
         # A bit sketchy...
         try:
@@ -158,11 +279,225 @@ class OrElse(Env):
             self.right.__exit__(exc_type, exc_val, exc_tb)
 
 
+class CompositeEnv(Env):
+    """
+    An environment that chains together ``envs`` like nested ``OrElse``
+    environments do, but flattened: which of them can find which names,
+    and which of them bind and replace, is worked out once, so that
+    looking up a name does not try every environment in turn, and
+    binding a name only creates one new environment.
+
+    ``a | b`` creates a ``CompositeEnv``, of the environments of ``a``
+    and ``b`` if they are ``CompositeEnv`` too.
+    """
+
+    def __init__(self, envs):
+        self.envs: list[Env] = []
+        # Composite environments that the first environments of this
+        # one are, with how many there are, for ``lookup_skipping``
+        self._prefixes: list[tuple[Env, int]] = []
+        for env in envs:
+            if not self.envs:
+                if isinstance(env, CompositeEnv):
+                    self._prefixes.extend(env._prefixes)
+                self._prefixes.append((env, len(_get_envs(env))))
+            self.envs.extend(_get_envs(env))
+        self._index_envs()
+
+    def _index_envs(self):
+        # The position of the first environment that may find any name.
+        # Names of the environments before it are looked up in
+        # ``_owners``, the positions of the environments that have them.
+        self._open = len(self.envs)
+        self._owners: dict[str, list[int]] = {}
+        for i, env in enumerate(self.envs):
+            names = env.known_names()
+            if names is None:
+                self._open = i
+                break
+            for name in names:
+                self._owners.setdefault(name, []).append(i)
+        self._bind_index = next((
+            i for i, env in enumerate(self.envs) if env.supports_bind
+        ), len(self.envs))
+        self._replace_index = next((
+            i for i, env in enumerate(self.envs) if env.supports_replace
+        ), len(self.envs))
+
+    def _with_env(self, i, env):
+        """
+        Returns a copy of this environment, with ``env`` instead of its
+        ``i``th environment.
+        """
+        composite = CompositeEnv.__new__(CompositeEnv)
+        composite.envs = self.envs[:]
+        composite.envs[i] = env
+        composite._prefixes = [
+            (prefix, length) for prefix, length in self._prefixes
+            if length <= i
+        ]
+        if i >= self._open and env.known_names() is None:
+            composite._open = self._open
+            composite._owners = self._owners
+            composite._bind_index = self._bind_index
+            composite._replace_index = self._replace_index
+        else:
+            composite._index_envs()
+        return composite
+
+    def bind(self, name, value):
+        for i in range(self._bind_index, len(self.envs)):
+            env = self.envs[i]
+            if not env.supports_bind:
+                continue
+            try:
+                return self._with_env(i, env.bind(name, value))
+            except CannotBind:
+                pass
+        raise CannotBind()
+
+    def replace(self, data):
+        for i in range(self._replace_index, len(self.envs)):
+            env = self.envs[i]
+            if not env.supports_replace:
+                continue
+            try:
+                return self._with_env(i, env.replace(data))
+            except CannotReplace:
+                pass
+        raise CannotReplace()
+
+    def lookup(self, name):
+        return self._lookup_from(0, name)
+
+    def lookup_skipping(self, static_env, name):
+        for prefix, length in self._prefixes:
+            if prefix is static_env:
+                return self._lookup_from(length, name)
+        return self._lookup_from(0, name)
+
+    def _lookup_from(self, start, name):
+        try:
+            owners = self._owners.get(name, ())
+        except TypeError:
+            # e.g. a parsed JSONPath expression
+            owners = ()
+        for i in owners:
+            if i >= start:
+                return self.envs[i].lookup(name)
+        for env in self.envs[max(start, self._open):]:
+            try:
+                return env.lookup(name)
+            except NotFound:
+                pass
+        raise NotFound(unwrap_val(name))
+
+    def emit_table(self, table_spec):
+        for env in self.envs:
+            try:
+                return env.emit_table(table_spec)
+            except CannotEmit:
+                pass
+        raise CannotEmit()
+
+    def has_emitted_tables(self):
+        return any([env.has_emitted_tables() for env in self.envs])
+
+    def __enter__(self):
+        for env in self.envs:
+            env.__enter__()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._exit(self.envs, exc_type, exc_val, exc_tb)
+
+    def _exit(self, envs, exc_type, exc_val, exc_tb):
+        # Like nested ``OrElse``: every environment is exited, even if
+        # exiting one before it raised
+        if envs:
+            try:
+                envs[0].__exit__(exc_type, exc_val, exc_tb)
+            finally:
+                self._exit(envs[1:], exc_type, exc_val, exc_tb)
+
+
+def _get_envs(env):
+    if isinstance(env, CompositeEnv):
+        return env.envs
+    return [env]
+
+
 #
 # Concrete environment classes
 #
 
 
+class ChainedBindings(Mapping[str, Any]):
+    """
+    The bindings of ``parent``, a dict or ``ChainedBindings``, with
+    those of ``bound`` added, without copying ``parent``. So binding a
+    name once per row, like a named ``Map`` does, takes the same time
+    however many names are bound already.
+    """
+
+    __slots__ = ('parent', 'bound', '_dict')
+
+    def __init__(self, parent, bound):
+        self.parent = parent
+        self.bound = bound
+        self._dict = None
+
+    def __getitem__(self, key):
+        # A ChainedBindings, until the loop reaches the dict at the root
+        bindings: Mapping[str, Any] = self
+        while isinstance(bindings, ChainedBindings):
+            if key in bindings.bound:
+                return bindings.bound[key]
+            bindings = bindings.parent
+        return bindings[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self.to_dict())
+
+    def to_dict(self):
+        """
+        Returns the bindings as a dict, which is created the first time
+        it is needed.
+        """
+        if self._dict is None:
+            chain = []
+            bindings: Mapping[str, Any] = self
+            while isinstance(bindings, ChainedBindings):
+                chain.append(bindings.bound)
+                bindings = bindings.parent
+            self._dict = dict(bindings)
+            for bound in reversed(chain):
+                self._dict.update(bound)
+        return self._dict
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.to_dict()!r})'
+
+
+def _chain_bindings(bindings, bound):
+    if isinstance(bindings, (dict, ChainedBindings)):
+        return ChainedBindings(bindings, bound)
+    # e.g. a datum that replaced the bindings, which cannot be bound to,
+    # as before
+    new_bindings = dict(bindings)
+    new_bindings.update(bound)
+    return new_bindings
+
+
 class DictEnv(Env):
     """
     A simple dictionary environment; more-or-less boring!
@@ -172,7 +507,7 @@ class DictEnv(Env):
         self.d = d or {}
 
     def bind(self, name, value):
-        return DictEnv(dict(list(self.d.items()) + [(name, value)]))
+        return DictEnv(_chain_bindings(self.d, {name: value}))
 
     def lookup(self, name):
         try:
@@ -180,6 +515,9 @@ class DictEnv(Env):
         except KeyError:
             raise NotFound(unwrap_val(name))
 
+    def known_names(self):
+        return self.d.keys()
+
     def replace(self, data):
         if isinstance(data, dict):
             return DictEnv(data)
@@ -193,32 +531,33 @@ class JsonPathEnv(Env):
     supporting dereferencing an JsonPath expression. Note that it never
     fails a lookup, but always returns an empty  list.
 
-    It also interns all parsed expressions
+    It also caches all parsed expressions, see ``JSONPATH_CACHE``.
     """
 
-    def __init__(self, bindings=None):
-        self.__bindings = bindings or {}
-        self.__restrict_to_root = bool(
-            jsonpath.Fields("__root_only").find(self.__bindings)
-        )
-
-        # Currently hardcoded because it is a global is jsonpath-ng
-        # Probably not widely used, but will require refactor if so
-        jsonpath.auto_id_field = "id"
+    def __init__(self, bindings=None, restrict_to_root=None):
+        """
+        Lookups are restricted to paths from the root, `$`, if
+        ``__root_only`` is bound. ``restrict_to_root`` is whether it is,
+        if it is already known, e.g. when binding a name.
+        """
+        if not isinstance(bindings, ChainedBindings):
+            bindings = bindings or {}
+        self.__bindings = bindings
+        if restrict_to_root is None:
+            restrict_to_root = _binds_root_only(bindings)
+        self.__restrict_to_root = restrict_to_root
 
     def parse(self, jsonpath_string):
-        if jsonpath_string not in JSONPATH_CACHE:
-            JSONPATH_CACHE[jsonpath_string] = parse_jsonpath(jsonpath_string)
-        return JSONPATH_CACHE[jsonpath_string]
+        return JSONPATH_CACHE.get(jsonpath_string)[0]
 
     def lookup(
         self,
         name: Union[str, jsonpath.JSONPath]
     ) -> RepeatableIterator:
         if isinstance(name, str):
-            jsonpath_expr = self.parse(name)
+            jsonpath_expr, find = JSONPATH_CACHE.get(name)
         elif isinstance(name, jsonpath.JSONPath):
-            jsonpath_expr = name
+            jsonpath_expr, find = name, None
         else:
             raise NotFound(unwrap_val(name))
 
@@ -228,8 +567,15 @@ class JsonPathEnv(Env):
             if not isinstance(expr, jsonpath.Root):
                 return RepeatableIterator(lambda: iter(()))
 
-        def iterator(jsonpath_expr=jsonpath_expr):  # Capture closure
-            for datum in jsonpath_expr.find(self.__bindings):
+        bindings = self.__bindings
+        if find is None:
+            find = jsonpath_expr.find
+            # ``find`` may return the bindings themselves, e.g. for `$`
+            if isinstance(bindings, ChainedBindings):
+                bindings = bindings.to_dict()
+
+        def iterator(find=find):  # Capture closure
+            for datum in find(bindings):
                 # HACK: The auto id from jsonpath_ng is good, but we
                 # lose it when we do .value here, so just slap it on if
                 # not present
@@ -248,22 +594,34 @@ class JsonPathEnv(Env):
         ...
 
     def bind(self, *args):
-        new_bindings = dict(self.__bindings)
         if isinstance(args[0], dict):
-            new_bindings.update(args[0])
-            return self.__class__(new_bindings)
-
+            bound = dict(args[0])
         elif isinstance(args[0], str):
-            new_bindings[args[0]] = args[1]
-            return self.__class__(new_bindings)
-
+            bound = {args[0]: args[1]}
         else:
             raise ValueError('Bad args to Env.bind')
+        return self.__class__(
+            _chain_bindings(self.__bindings, bound),
+            self.__restrict_to_root or ROOT_ONLY in bound,
+        )
 
     def replace(self, data):
         return self.__class__(data)
 
 
+def _binds_root_only(bindings):
+    # Like ``jsonpath.Fields(ROOT_ONLY).find(bindings)``, without
+    # creating datums
+    if isinstance(bindings, jsonpath.DatumInContext):
+        bindings = bindings.value
+    if isinstance(bindings, dict):
+        return ROOT_ONLY in bindings
+    try:
+        return bindings.get(ROOT_ONLY, _NOT_SET) is not _NOT_SET
+    except (TypeError, AttributeError):
+        return False
+
+
 #
 # Actual concrete environments, basically with built-in functions.
 #
@@ -330,6 +688,14 @@ def str2date(val):
     return date.replace(microsecond=0, tzinfo=None)
 
 
+def equals(val, other):
+    return unwrap_val(val) == unwrap_val(other)
+
+
+def not_equals(val, other):
+    return not equals(val, other)
+
+
 @unwrap('val')
 def bool2int(val):
     return int(str2bool(val))
@@ -537,6 +903,8 @@ class BuiltInEnv(DictEnv):
             '>=': operator.__ge__,
             '<': operator.__lt__,
             '<=': operator.__le__,
+            '==': equals,
+            '!=': not_equals,
             'len': len,
             'bool': bool,
             'str2bool': str2bool,
@@ -563,6 +931,9 @@ class BuiltInEnv(DictEnv):
         })
         super(BuiltInEnv, self).__init__(d)
 
+    supports_bind = False
+    supports_replace = False
+
     def bind(self, name, value):
         raise CannotBind()
 
@@ -582,6 +953,9 @@ class EmitterEnv(Env):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.writer.__exit__(exc_type, exc_val, exc_tb)
 
+    supports_bind = False
+    supports_replace = False
+
     def bind(self, name, value):
         raise CannotBind()
 
@@ -591,6 +965,9 @@ class EmitterEnv(Env):
     def lookup(self, key):
         raise NotFound()
 
+    def known_names(self):
+        return ()
+
     def emit_table(self, table_spec):
         self.emitted = True
         table_spec.rows = self._unwrap_row_vals(table_spec.rows)
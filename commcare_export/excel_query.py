@@ -572,19 +572,12 @@ def parse_workbook(workbook, column_enforcer=None, value_or_root=False):
 
 def compile_queries(parsed_sheets, missing_value, combine_emits):
     # group sheets by source
-    sheets_by_source: list[Any] = []
+    sheets_by_source: dict[Any, list[Any]] = {}
     for sheet in parsed_sheets:
-        # Not easy to implement hashing on MiniLinq objects so can't use
-        # a dict
-        for source, sheets in sheets_by_source:
-            if sheet.source == source:
-                sheets.append(sheet)
-                break
-        else:
-            sheets_by_source.append((sheet.source, [sheet]))
+        sheets_by_source.setdefault(sheet.source, []).append(sheet)
 
     queries = []
-    for source, sheets in sheets_by_source:
+    for source, sheets in sheets_by_source.items():
         if len(sheets) > 1:
             if combine_emits:
                 queries.append(
@@ -0,0 +1,159 @@
+"""
+A pluggable JSON backend. The fastest installed backend is used by
+default. Set the ``COMMCARE_EXPORT_JSON_BACKEND`` environment variable,
+or call ``set_backend()``, to choose one.
+"""
+import importlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# In order of preference
+BACKENDS = ['orjson', 'simplejson', 'json']
+
+
+class JsonBackend:
+
+    name = 'json'
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj, indent=None, default=None):
+        return json.dumps(obj, indent=indent, default=default)
+
+
+class SimplejsonBackend(JsonBackend):
+
+    name = 'simplejson'
+
+    def __init__(self):
+        self._simplejson = importlib.import_module('simplejson')
+        # Since simplejson 3.19 NaN and Infinity must be allowed
+        # explicitly, as they are by the standard library
+        try:
+            self._simplejson.loads('NaN', allow_nan=True)
+            self._kwargs = {'allow_nan': True}
+        except TypeError:
+            self._kwargs = {}
+
+    def loads(self, data):
+        return self._simplejson.loads(data, **self._kwargs)
+
+    def dumps(self, obj, indent=None, default=None):
+        return self._simplejson.dumps(obj, indent=indent, default=default)
+
+
+class OrjsonBackend(JsonBackend):
+    """
+    orjson does not support integers larger than 64 bits, or NaN and
+    Infinity, which the standard library accepts. Some versions decode
+    large integers as floats instead of failing. Documents that orjson
+    cannot decode, or that contain a number that might be too large for
+    it, are decoded by the standard library instead.
+
+    orjson only indents by two spaces, and does not put spaces after
+    separators, so indented output is encoded by the standard library,
+    to keep it unchanged. So are objects that orjson cannot encode.
+    orjson encodes NaN and Infinity as null.
+    """
+
+    name = 'orjson'
+
+    # Maps digits to b'0', the bytes that can come before a number
+    # value to b'[', and other bytes to b' ', removing whitespace and
+    # minus signs, so that an integer value of 19 digits or more, which
+    # may not fit in 64 bits, becomes a run of b'0' after a b'['. Runs of
+    # digits in strings, like IDs, don't match unless they look like a
+    # value, e.g. in ``"id: 1234567890123456789"``. This is much faster
+    # than a regular expression.
+    _number_table = bytes(
+        ord('0') if chr(i).isdigit() and i < 128 else
+        ord('[') if chr(i) in ':,[' else ord(' ') for i in range(256)
+    )
+    _number_delete = b' \t\r\n-'
+    _long_integer = b'[' + b'0' * 19
+
+    def __init__(self):
+        self._orjson = importlib.import_module('orjson')
+
+    def loads(self, data):
+        data_bytes = data.encode('utf-8') if isinstance(data, str) else data
+        if self._has_long_integer(data_bytes):
+            return json.loads(data)
+        try:
+            return self._orjson.loads(data)
+        except self._orjson.JSONDecodeError:
+            return json.loads(data)
+
+    def _has_long_integer(self, data):
+        numbers = data.translate(self._number_table, self._number_delete)
+        return (
+            self._long_integer in numbers
+            or numbers.startswith(self._long_integer[1:])
+        )
+
+    def dumps(self, obj, indent=None, default=None):
+        if indent is None:
+            try:
+                return self._orjson.dumps(
+                    obj,
+                    default=default,
+                    # Like the standard library, which uses ``default``
+                    option=self._orjson.OPT_PASSTHROUGH_DATETIME,
+                ).decode('utf-8')
+            except TypeError:
+                pass
+        return super().dumps(obj, indent=indent, default=default)
+
+
+_backend_classes = {
+    'orjson': OrjsonBackend,
+    'simplejson': SimplejsonBackend,
+    'json': JsonBackend,
+}
+
+
+def get_available_backends():
+    available = []
+    for name in BACKENDS:
+        try:
+            available.append(_backend_classes[name]())
+        except ImportError:
+            pass
+    return available
+
+
+def _select_backend():
+    name = os.environ.get('COMMCARE_EXPORT_JSON_BACKEND')
+    if name:
+        try:
+            return _backend_classes[name]()
+        except (KeyError, ImportError):
+            logger.warning(
+                f'JSON backend "{name}" is not available. Using the fastest '
+                'available backend instead.'
+            )
+    return get_available_backends()[0]
+
+
+_backend = _select_backend()
+
+
+def get_backend():
+    return _backend
+
+
+def set_backend(name):
+    global _backend
+    _backend = _backend_classes[name]()
+
+
+def loads(data):
+    return _backend.loads(data)
+
+
+def dumps(obj, indent=None, default=None):
+    return _backend.dumps(obj, indent=indent, default=default)
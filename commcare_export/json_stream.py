@@ -0,0 +1,171 @@
+"""
+Incremental decoding of pages from CommCare HQ list endpoints, so that
+only one document of a page needs to be held in memory at a time.
+"""
+import codecs
+import json
+
+CHUNK_SIZE = 64 * 1024
+
+
+class StreamedPage:
+    """
+    A page of a tastypie-like list endpoint, i.e. a JSON object with
+    "meta" and "objects" members, decoded from an iterable of byte
+    chunks as it is read.
+
+    Accessing ``meta`` reads the response up to the end of "meta".
+    ``objects()`` yields the elements of "objects" one at a time. If
+    "objects" comes before "meta" in the response, the objects have to
+    be held in memory until "meta" has been read.
+    """
+
+    def __init__(self, chunks, close=None):
+        self._reader = _JsonReader(chunks)
+        self._close = close
+        self._meta = None
+        self._buffered_objects = None
+        self._first_member = True
+        self._finished = False
+        self._reader.expect('{')
+
+    @property
+    def meta(self):
+        while self._meta is None and not self._finished:
+            key = self._next_key()
+            if key == 'objects':
+                self._buffered_objects = list(self._reader.iter_array())
+            elif key is not None:
+                self._read_member(key)
+        return self._meta
+
+    def objects(self):
+        if self._buffered_objects is not None:
+            objects, self._buffered_objects = self._buffered_objects, []
+            yield from objects
+        while not self._finished:
+            key = self._next_key()
+            if key == 'objects':
+                yield from self._reader.iter_array()
+            elif key is not None:
+                self._read_member(key)
+
+    def close(self):
+        if self._close:
+            self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _next_key(self):
+        if self._reader.peek() == '}':
+            self._reader.expect('}')
+            # Read the rest of the stream, so that it can be reused
+            self._reader.read_to_end()
+            self._finished = True
+            return None
+        if not self._first_member:
+            self._reader.expect(',')
+        self._first_member = False
+        key = self._reader.decode_value()
+        self._reader.expect(':')
+        return key
+
+    def _read_member(self, key):
+        value = self._reader.decode_value()
+        if key == 'meta':
+            self._meta = value
+
+
+class _JsonReader:
+    """
+    Decodes JSON values one at a time from an iterable of byte chunks.
+    """
+
+    def __init__(self, chunks, decoder=None):
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = decoder or json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._exhausted = False
+
+    def peek(self):
+        """
+        Skips whitespace, and returns the next character, or '' at the
+        end of the stream.
+        """
+        while True:
+            while (
+                self._pos < len(self._buffer)
+                and self._buffer[self._pos].isspace()
+            ):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read_more():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(
+                f'Expected {char!r} at position {self._pos}, found {found!r}'
+            )
+        self._pos += 1
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._read_more():
+                    raise
+                continue
+            # A number at the end of the buffer might continue in the
+            # next chunk
+            if end < len(self._buffer) or not self._read_more():
+                self._pos = end
+                return value
+
+    def iter_array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.expect(']')
+            return
+        while True:
+            yield self.decode_value()
+            if self.peek() == ',':
+                self.expect(',')
+            else:
+                self.expect(']')
+                return
+
+    def read_to_end(self):
+        while self._read_more():
+            self._pos = len(self._buffer)
+
+    def _read_more(self):
+        """
+        Reads at least as much again as the undecoded part of the
+        buffer, so that a value that spans many chunks is not decoded
+        again for every chunk. Returns False at the end of the stream.
+        """
+        if self._exhausted:
+            return False
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        wanted = max(len(self._buffer) * 2, 1)
+        while len(self._buffer) < wanted:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                self._buffer += self._text_decoder.decode(b'', final=True)
+                self._exhausted = True
+                break
+            self._buffer += self._text_decoder.decode(chunk)
+        return True
@@ -12,3 +12,79 @@ def split_leftmost(jsonpath_expr):
         )
     else:
         return jsonpath_expr, jsonpath.This()
+
+
+def compile_find(jsonpath_expr):
+    """
+    Returns a function that returns the same as ``jsonpath_expr.find``,
+    but quicker, for a path of single fields and indices, like
+    ``form.meta.userID`` or ``$.form.case[0]``, which matches at most
+    one datum below the data. Returns None for any other path, e.g. one
+    with a wildcard, a filter or an auto id field.
+    """
+    steps = _get_steps(jsonpath_expr)
+    if steps is None:
+        return None
+    from_root = bool(steps) and isinstance(steps[0], jsonpath.Root)
+    if from_root:
+        root, steps = steps[0], steps[1:]
+    steps = [step for step in steps if not isinstance(step, jsonpath.This)]
+    # A path without steps, like `$`, matches the data that it is
+    # looked up in itself
+    if not steps or not all(_is_simple_step(step) for step in steps):
+        return None
+    steps = [
+        (step.fields[0], None, step) if isinstance(step, jsonpath.Fields)
+        else (None, step.index, step)
+        for step in steps
+    ]
+
+    def find(data):
+        datum = jsonpath.DatumInContext.wrap(data)
+        if from_root:
+            [datum] = root.find(datum)
+        for field, index, path in steps:
+            value = datum.value
+            if field is not None:
+                try:
+                    value = value.get(field, _NOT_SET)
+                except (TypeError, AttributeError):
+                    return []
+                if value is _NOT_SET:
+                    return []
+            elif value and len(value) > index:
+                value = value[index]
+            else:
+                return []
+            datum = jsonpath.DatumInContext(value, path=path, context=datum)
+        return [datum]
+
+    return find
+
+
+_NOT_SET = object()
+
+
+def _get_steps(jsonpath_expr):
+    if isinstance(jsonpath_expr, jsonpath.Child):
+        left = _get_steps(jsonpath_expr.left)
+        right = _get_steps(jsonpath_expr.right)
+        if left is None or right is None:
+            return None
+        return left + right
+    if type(jsonpath_expr) in (
+        jsonpath.Fields, jsonpath.Index, jsonpath.Root, jsonpath.This
+    ):
+        return [jsonpath_expr]
+    return None
+
+
+def _is_simple_step(step):
+    if isinstance(step, jsonpath.Fields):
+        # ``*`` matches every field, and the auto id field matches an
+        # ``AutoIdForDatum`` even where there is no such field
+        return (
+            len(step.fields) == 1 and step.fields[0] != '*'
+            and step.fields[0] != jsonpath.auto_id_field
+        )
+    return isinstance(step, jsonpath.Index)
@@ -1,6 +1,8 @@
 
+import asyncio
 import logging
 
+from commcare_export.commcare_hq_client import AsyncCommCareHqClient
 from commcare_export.commcare_minilinq import SimplePaginator
 from commcare_export.misc import unwrap_val
 
@@ -42,13 +44,59 @@ class LocationInfoProvider:
                 return location_hierarchy[location_type_code]
         return None
 
-    def get_location_types(self):
-        paginator = SimplePaginator('location_type', self._page_size)
+    def fetch(self):
+        """
+        Fetches location types and locations now, instead of when they
+        are first used, e.g. before the provider is shared by threads.
+        """
+        self._location_types = self.get_location_types()
+        self._location_hierarchy = self.get_location_hierarchy()
+
+    def fetch_concurrently(self, max_concurrent_requests):
+        """
+        Fetches location types and locations at the same time, instead
+        of one after the other when they are first used.
+        """
+        async_client = AsyncCommCareHqClient(
+            self._api_client, max_concurrent_requests
+        )
+
+        async def fetch(resource):
+            paginator = self._get_paginator(resource)
+            return await async_client.get_all(
+                resource, paginator, {'limit': self._page_size}
+            )
+
+        async def fetch_all():
+            return await asyncio.gather(
+                fetch('location_type'), fetch('location')
+            )
+
+        location_type_rows, location_rows = asyncio.run(fetch_all())
+        self._location_types = self._get_location_types(location_type_rows)
+        self._location_hierarchy = self._get_location_hierarchy(
+            location_rows
+        )
+
+    def _get_paginator(self, resource):
+        paginator = SimplePaginator(resource, self._page_size)
         paginator.init(None, False, None)
+        return paginator
+
+    def _iterate(self, resource):
+        return self._api_client.iterate(
+            resource,
+            self._get_paginator(resource),
+            {'limit': self._page_size},
+        )
+
+    def get_location_types(self):
+        return self._get_location_types(self._iterate('location_type'))
+
+    @staticmethod
+    def _get_location_types(rows):
         location_type_dict = {}
-        for row in self._api_client.iterate(
-            'location_type', paginator, {'limit': self._page_size}
-        ):
+        for row in rows:
             location_type_dict[row['resource_uri']] = row
         return location_type_dict
 
@@ -59,14 +107,12 @@ class LocationInfoProvider:
         return self._location_hierarchy
 
     def get_location_hierarchy(self):
-        paginator = SimplePaginator('location', self._page_size)
-        paginator.init(None, False, None)
+        return self._get_location_hierarchy(self._iterate('location'))
 
+    def _get_location_hierarchy(self, rows):
         # Extract every location, its type and its parent
         location_data = {}
-        for row in self._api_client.iterate(
-            'location', paginator, {'limit': self._page_size}
-        ):
+        for row in rows:
             location_data[row['resource_uri']] = {
                 'location_id': row['location_id'],
                 'location_type': row['location_type'],
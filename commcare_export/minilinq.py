@@ -1,25 +1,81 @@
 import logging
-from typing import Any, Dict
+from collections.abc import Iterator
+from itertools import islice
+from typing import Any, Callable, Dict
 from typing import List as ListType
 from typing import Optional
 
-from commcare_export.env import Env
+from commcare_export.env import Env, NotFound
 from commcare_export.misc import unwrap, unwrap_val
 from commcare_export.repeatable_iterator import RepeatableIterator
 from commcare_export.specs import TableSpec
 
 logger = logging.getLogger(__name__)
 
+# The number of documents for which the rows of a table are evaluated at
+# a time. Larger batches, e.g. a whole page of 1000 documents from the
+# API, keep more intermediate results alive and were measured to be
+# slower.
+BATCH_SIZE = 100
+
 
 class MiniLinq:
     """
     The abstract base class for MiniLinqs, and also the factory/registry
     for dispatching parsing, etc.
+
+    Nodes have ``__slots__``, because large queries have hundreds of
+    thousands of them, and must not be changed after they are created:
+    their hash is computed once, from ``_hash_key``, and cached.
     """
 
+    __slots__ = ('_hash',)
+    # Unset until ``__hash__`` is first called
+    _hash: int
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = hash(self._hash_key())
+            return self._hash
+
+    def _hash_key(self):
+        return id(self)
+
     def eval(self, env: Env) -> Any:
         raise NotImplementedError()
 
+    def compile(
+        self, static_env: Optional[Env] = None
+    ) -> Callable[[Env], Any]:
+        """
+        Compiles this MiniLinq to a function that takes an environment
+        and returns the same result as ``eval``, without walking the
+        tree again.
+
+        References to names that ``static_env`` can look up are resolved
+        once, now. So ``static_env`` must be the leftmost part of every
+        environment that the function is called with, and must not
+        support binding or replacing, like ``BuiltInEnv``.
+        """
+        return self.eval
+
+    def compile_batch(
+        self, static_env: Optional[Env] = None
+    ) -> Callable[[ListType[Env]], ListType[Any]]:
+        """
+        Like ``compile``, but the function takes a list of environments,
+        e.g. one for each document of a page of results, and returns the
+        list of results for them.
+
+        Nodes that can evaluate an expression for many environments at
+        once, column by column, do so. The others evaluate it for one
+        environment after the other.
+        """
+        compiled = self.compile(static_env)
+        return lambda envs: [compiled(env) for env in envs]
+
     #### Factory methods ####
 
     _node_classes: Dict[str, 'MiniLinq'] = {}
@@ -55,18 +111,20 @@ class MiniLinq:
         elif isinstance(jvalue, dict):
             # Dictionaries are reserved; they must always have exactly
             # one entry and it must be the AST node class
-            if len(jvalue.values()) != 1:
+            if len(jvalue) != 1:
                 raise ValueError(
                     'JValue serialization of AST contains dict with number of slugs != 1'
                 )
-            slug = list(jvalue.keys())[0]
+            [slug] = jvalue
 
-            if slug not in cls._node_classes:
+            try:
+                node_class = cls._node_classes[slug]
+            except KeyError:
                 raise ValueError(
                     f'JValue serialization of AST contains unknown node type: {slug}'
                 )
 
-            return cls._node_classes[slug].from_jvalue(jvalue)
+            return node_class.from_jvalue(jvalue)
 
     def to_jvalue(self):
         raise NotImplementedError()
@@ -79,6 +137,8 @@ class Reference(MiniLinq):
     keys.
     """
 
+    __slots__ = ('ref', 'nested')
+
     def __init__(self, ref):
         self.ref = ref  #parse_jsonpath(ref) #ref
         self.nested = isinstance(self.ref, MiniLinq)
@@ -89,9 +149,43 @@ class Reference(MiniLinq):
             return env.lookup(ref)
         return env.lookup(self.ref)
 
+    def compile(self, static_env=None):
+        if self.nested:
+            compiled_ref = _compile(self.ref, static_env)
+            return lambda env: env.lookup(compiled_ref(env))
+
+        ref = self.ref
+        if static_env is None:
+            return lambda env: env.lookup(ref)
+        try:
+            value = static_env.lookup(ref)
+        except NotFound:
+            return lambda env: env.lookup_skipping(static_env, ref)
+        return lambda env: value
+
+    def compile_batch(self, static_env=None):
+        if self.nested:
+            return super().compile_batch(static_env)
+
+        ref = self.ref
+        if static_env is None:
+            return lambda envs: [env.lookup(ref) for env in envs]
+        try:
+            value = static_env.lookup(ref)
+        except NotFound:
+            return lambda envs: [
+                env.lookup_skipping(static_env, ref) for env in envs
+            ]
+        return lambda envs: [value] * len(envs)
+
     def __eq__(self, other):
         return isinstance(other, Reference) and self.ref == other.ref
 
+    __hash__ = MiniLinq.__hash__
+
+    def _hash_key(self):
+        return (Reference, _freeze(self.ref))
+
     @classmethod
     def from_jvalue(cls, jvalue):
         return cls(MiniLinq.from_jvalue(jvalue['Ref']))
@@ -111,15 +205,30 @@ class Literal(MiniLinq):
     cannot be encoded.
     """
 
+    __slots__ = ('v',)
+
     def __init__(self, v):
         self.v = v
 
     def eval(self, env):
         return self.v
 
+    def compile(self, static_env=None):
+        v = self.v
+        return lambda env: v
+
+    def compile_batch(self, static_env=None):
+        v = self.v
+        return lambda envs: [v] * len(envs)
+
     def __eq__(self, other):
         return isinstance(other, Literal) and self.v == other.v
 
+    __hash__ = MiniLinq.__hash__
+
+    def _hash_key(self):
+        return (Literal, _freeze(self.v))
+
     def __repr__(self):
         return f'{self.__class__.__name__}({self.v!r})'
 
@@ -139,6 +248,8 @@ class Bind(MiniLinq):
     too large to store, so it'll be re-run on each access.
     """
 
+    __slots__ = ('name', 'value', 'body')
+
     def __init__(self, name: str, value: MiniLinq, body: MiniLinq) -> None:
         self.name = name
         self.value = value
@@ -147,11 +258,22 @@ class Bind(MiniLinq):
     def eval(self, env):
         return self.body.eval(env.bind(self.name, self.value.eval(env)))
 
+    def compile(self, static_env=None):
+        name = self.name
+        value = _compile(self.value, static_env)
+        body = _compile(self.body, static_env)
+        return lambda env: body(env.bind(name, value(env)))
+
     def __eq__(self, other):
         return isinstance(
             other, Bind
         ) and self.name == other.name and self.value == other.value and self.body == other.body
 
+    __hash__ = MiniLinq.__hash__
+
+    def _hash_key(self):
+        return (Bind, self.name, self.value, self.body)
+
     def __repr__(self):
         return (
             f'{self.__class__.__name__}'
@@ -184,6 +306,8 @@ class Filter(MiniLinq):
     Just what it sounds like
     """
 
+    __slots__ = ('source', 'name', 'predicate')
+
     def __init__(
         self,
         source: MiniLinq,
@@ -213,12 +337,39 @@ class Filter(MiniLinq):
 
         return RepeatableIterator(iterate)
 
+    def compile(self, static_env=None):
+        name = self.name
+        source = _compile(self.source, static_env)
+        predicate = _compile(self.predicate, static_env)
+
+        def filter_(env):
+            source_result = source(env)
+
+            def iterate():
+                if name:
+                    for item in source_result:
+                        if predicate(env.bind(name, item)):
+                            yield item
+                else:
+                    for item in source_result:
+                        if predicate(env.replace(item)):
+                            yield item
+
+            return RepeatableIterator(iterate)
+
+        return filter_
+
     def __eq__(self, other):
         return (
             isinstance(other, Filter) and self.source == other.source
             and self.name == other.name and self.predicate == other.predicate
         )
 
+    __hash__ = MiniLinq.__hash__
+
+    def _hash_key(self):
+        return (Filter, self.source, self.name, self.predicate)
+
     @classmethod
     def from_jvalue(cls, jvalue):
         fields = jvalue['Filter']
@@ -254,15 +405,42 @@ class List(MiniLinq):
     meta-leval
     """
 
+    __slots__ = ('items',)
+
     def __init__(self, items):
         self.items = items
 
     def eval(self, env):
         return [item.eval(env) for item in self.items]
 
+    def compile(self, static_env=None):
+        items = [_compile(item, static_env) for item in self.items]
+        return lambda env: [item(env) for item in items]
+
+    def compile_batch(self, static_env=None):
+        if _contains(self, Emit):
+            # Emitting tables column by column would change the order in
+            # which rows are written
+            return super().compile_batch(static_env)
+
+        items = [_compile_batch(item, static_env) for item in self.items]
+
+        def list_batch(envs):
+            if not items:
+                return [[] for _ in envs]
+            columns = [item(envs) for item in items]
+            return [list(row) for row in zip(*columns)]
+
+        return list_batch
+
     def __eq__(self, other):
         return isinstance(other, List) and self.items == other.items
 
+    __hash__ = MiniLinq.__hash__
+
+    def _hash_key(self):
+        return (List, _freeze(self.items))
+
     def __repr__(self):
         return f'{self.__class__.__name__}({self.items})'
 
@@ -284,6 +462,8 @@ class Map(MiniLinq):
     enabling references to the rest of the env.
     """
 
+    __slots__ = ('source', 'name', 'body')
+
     def __init__(
         self,
         source: MiniLinq,
@@ -309,12 +489,63 @@ class Map(MiniLinq):
 
         return RepeatableIterator(iterate)
 
+    def compile(self, static_env=None):
+        name = self.name
+        source = _compile(self.source, static_env)
+        body = _compile(self.body, static_env)
+
+        def map_(env):
+            source_result = source(env)
+
+            def iterate():
+                if name:
+                    for item in source_result:
+                        yield body(env.bind(name, item))
+                else:
+                    for item in source_result:
+                        yield body(env.replace(item))
+
+            return RepeatableIterator(iterate)
+
+        return map_
+
+    def compile_batched(self, static_env=None, batch_size=BATCH_SIZE):
+        """
+        Like ``compile``, but the function evaluates ``body`` for
+        ``batch_size`` items of ``source`` at a time, using
+        ``compile_batch``.
+        """
+        name = self.name
+        source = _compile(self.source, static_env)
+        body = _compile_batch(self.body, static_env)
+
+        def map_batched(env):
+            source_result = source(env)
+
+            def iterate():
+                items_iter = iter(source_result)
+                while items := list(islice(items_iter, batch_size)):
+                    if name:
+                        envs = [env.bind(name, item) for item in items]
+                    else:
+                        envs = [env.replace(item) for item in items]
+                    yield from body(envs)
+
+            return RepeatableIterator(iterate)
+
+        return map_batched
+
     def __eq__(self, other):
         return (
             isinstance(other, Map) and self.name == other.name
             and self.source == other.source and self.body == other.body
         )
 
+    __hash__ = MiniLinq.__hash__
+
+    def _hash_key(self):
+        return (Map, self.name, self.source, self.body)
+
     @classmethod
     def from_jvalue(cls, jvalue):
         fields = jvalue['Map']
@@ -347,6 +578,8 @@ class FlatMap(MiniLinq):
     enabling references to the rest of the env.
     """
 
+    __slots__ = ('source', 'name', 'body')
+
     def __init__(
         self,
         source: MiniLinq,
@@ -378,12 +611,37 @@ class FlatMap(MiniLinq):
 
         return RepeatableIterator(iterate)
 
+    def compile(self, static_env=None):
+        name = self.name
+        source = _compile(self.source, static_env)
+        body = _compile(self.body, static_env)
+
+        def flat_map(env):
+            source_result = source(env)
+
+            def iterate():
+                if name:
+                    for item in source_result:
+                        yield from body(env.bind(name, item))
+                else:
+                    for item in source_result:
+                        yield from body(env.replace(item))
+
+            return RepeatableIterator(iterate)
+
+        return flat_map
+
     def __eq__(self, other):
         return (
             isinstance(other, FlatMap) and self.name == other.name
             and self.source == other.source and self.body == other.body
         )
 
+    __hash__ = MiniLinq.__hash__
+
+    def _hash_key(self):
+        return (FlatMap, self.name, self.source, self.body)
+
     @classmethod
     def from_jvalue(cls, jvalue):
         fields = jvalue['FlatMap']
@@ -410,6 +668,8 @@ class Apply(MiniLinq):
     Abstract syntax for function or operator application.
     """
 
+    __slots__ = ('fn', 'args')
+
     def __init__(self, fn, *args):
         self.fn = fn
         self.args = args
@@ -423,20 +683,62 @@ class Apply(MiniLinq):
             if isinstance(result, MiniLinq):
                 return result.eval(env)
         except Exception as e:
-            args = ', '.join([str(unwrap_val(arg)) for arg in args_results])
+            self._add_error_context(e, env, args_results)
+            raise
+        return result
+
+    def compile(self, static_env=None):
+        fn = _compile(self.fn, static_env)
+        args = [_compile(arg, static_env) for arg in self.args]
+
+        def apply(env):
+            fn_result = fn(env)
+            args_results = [arg(env) for arg in args]
+
             try:
-                doc_id = unwrap_val(Reference('id').eval(env))
-            except:
-                doc_id = 'unknown'
+                result = fn_result(*args_results)
+                if isinstance(result, MiniLinq):
+                    return result.eval(env)
+            except Exception as e:
+                self._add_error_context(e, env, args_results)
+                raise
+            return result
+
+        return apply
+
+    def compile_batch(self, static_env=None):
+        fn = _compile_batch(self.fn, static_env)
+        args = [_compile_batch(arg, static_env) for arg in self.args]
+
+        def apply_batch(envs):
+            columns = [fn(envs)] + [arg(envs) for arg in args]
+            results = []
+            for env, fn_result, *args_results in zip(envs, *columns):
+                try:
+                    result = fn_result(*args_results)
+                    if isinstance(result, MiniLinq):
+                        result = result.eval(env)
+                except Exception as e:
+                    self._add_error_context(e, env, args_results)
+                    raise
+                results.append(result)
+            return results
+
+        return apply_batch
+
+    def _add_error_context(self, e, env, args_results):
+        args = ', '.join([str(unwrap_val(arg)) for arg in args_results])
+        try:
+            doc_id = unwrap_val(Reference('id').eval(env))
+        except:
+            doc_id = 'unknown'
 
-            message = e.args[0] + (
-                f": Error processing document '{doc_id}'. Failure to "
-                f"evaluating expression '{self!r}' with arguments '{args}'"
-            )
+        message = e.args[0] + (
+            f": Error processing document '{doc_id}'. Failure to "
+            f"evaluating expression '{self!r}' with arguments '{args}'"
+        )
 
-            e.args = (message,) + e.args[1:]
-            raise
-        return result
+        e.args = (message,) + e.args[1:]
 
     def __eq__(self, other):
         return (
@@ -444,6 +746,11 @@ class Apply(MiniLinq):
             and self.args == other.args
         )
 
+    __hash__ = MiniLinq.__hash__
+
+    def _hash_key(self):
+        return (Apply, self.fn, _freeze(self.args))
+
     @classmethod
     def from_jvalue(cls, jvalue):
         fields = jvalue['Apply']
@@ -466,6 +773,71 @@ class Apply(MiniLinq):
         return f'{self.__class__.__name__}({self.fn!r}, *{self.args!r})'
 
 
+class Memo(MiniLinq):
+    """
+    Evaluates ``body`` once per environment. One instance is shared by
+    every occurrence of the same expression in a row, so that it is only
+    evaluated once for the row, by the first occurrence to be evaluated.
+    See ``commcare_export.optimizer``.
+
+    Only the result for the last environment is kept. A result that can
+    only be iterated once is not kept.
+    """
+
+    __slots__ = ('body', '_last', '_last_batch')
+
+    def __init__(self, body):
+        self.body = body
+        self._last = (None, None)
+        self._last_batch = (None, None)
+
+    def eval(self, env):
+        return self._eval(env, self.body.eval)
+
+    def compile(self, static_env=None):
+        body = _compile(self.body, static_env)
+        return lambda env: self._eval(env, body)
+
+    def compile_batch(self, static_env=None):
+        body = _compile_batch(self.body, static_env)
+
+        def memo_batch(envs):
+            last_envs, last_results = self._last_batch
+            if envs is last_envs:
+                return last_results
+            results = body(envs)
+            if any(isinstance(result, Iterator) for result in results):
+                return results
+            self._last_batch = (envs, results)
+            return results
+
+        return memo_batch
+
+    def _eval(self, env, evaluate):
+        last_env, last_result = self._last
+        if env is last_env:
+            return last_result
+        result = evaluate(env)
+        if isinstance(result, Iterator):
+            return result
+        self._last = (env, result)
+        return result
+
+    def __eq__(self, other):
+        return isinstance(other, Memo) and self.body == other.body
+
+    __hash__ = MiniLinq.__hash__
+
+    def _hash_key(self):
+        return (Memo, self.body)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.body!r})'
+
+    def to_jvalue(self):
+        return self.body.to_jvalue()
+
+
 class Emit(MiniLinq):
     """
     This MiniLinq writes a whole table to whatever writer is registered
@@ -477,6 +849,10 @@ class Emit(MiniLinq):
     actually lists - it is just crashy instead.
     """
 
+    __slots__ = (
+        'table', 'headings', 'source', 'missing_value', 'data_types'
+    )
+
     def __init__(
         self,
         table: str,
@@ -533,6 +909,28 @@ class Emit(MiniLinq):
             )
         )
 
+    def compile(self, static_env=None):
+        if hasattr(self.source, 'compile_batched'):
+            # The rows of a table are evaluated a batch at a time, if
+            # the source is a ``Map``, or a profiled ``Map``
+            source = self.source.compile_batched(static_env)
+        else:
+            source = _compile(self.source, static_env)
+        headings = [_compile(heading, static_env) for heading in self.headings]
+
+        def emit(env):
+            rows = source(env)
+            env.emit_table(
+                TableSpec(
+                    name=self.table,
+                    headings=[heading(env) for heading in headings],
+                    rows=map(self.coerce_row, rows),
+                    data_types=[lit.v for lit in self.data_types]
+                )
+            )
+
+        return emit
+
     @classmethod
     def from_jvalue(cls, jvalue):
         fields = jvalue['Emit']
@@ -570,6 +968,14 @@ class Emit(MiniLinq):
             and self.data_types == other.data_types
         )
 
+    __hash__ = MiniLinq.__hash__
+
+    def _hash_key(self):
+        return (
+            Emit, self.table, _freeze(self.headings), self.source,
+            _freeze(self.missing_value), _freeze(self.data_types)
+        )
+
     def __repr__(self):
         return (
             f'{self.__class__.__name__}'
@@ -580,6 +986,121 @@ class Emit(MiniLinq):
         )
 
 
+def map_children(node, fn, new_scope_fn=None):
+    """
+    Returns a copy of ``node`` with ``fn`` applied to each of its child
+    expressions. If ``new_scope_fn`` is given, it is applied instead to
+    the children that are evaluated in other environments than
+    ``node``: the expressions for the items of a ``Map``, ``FlatMap`` or
+    ``Filter``, and the body of a ``Bind``.
+    """
+    new_scope_fn = new_scope_fn or fn
+    if isinstance(node, Reference):
+        return Reference(fn(node.ref)) if node.nested else node
+    if isinstance(node, Apply):
+        return Apply(fn(node.fn), *[fn(arg) for arg in node.args])
+    if isinstance(node, List):
+        return List([fn(item) for item in node.items])
+    if isinstance(node, Bind):
+        return Bind(node.name, fn(node.value), new_scope_fn(node.body))
+    if isinstance(node, (Map, FlatMap)):
+        return type(node)(
+            source=fn(node.source),
+            body=new_scope_fn(node.body),
+            name=node.name,
+        )
+    if isinstance(node, Filter):
+        return Filter(
+            source=fn(node.source),
+            predicate=new_scope_fn(node.predicate),
+            name=node.name,
+        )
+    if isinstance(node, Memo):
+        return Memo(fn(node.body))
+    if isinstance(node, Emit):
+        return Emit(
+            table=node.table,
+            headings=[fn(heading) for heading in node.headings],
+            source=fn(node.source),
+            missing_value=node.missing_value,
+            data_types=node.data_types,
+        )
+    return node
+
+
+def get_references(node):
+    """
+    Returns the names that the references in ``node`` look up, except
+    those that are computed when ``node`` is evaluated.
+    """
+    references = set()
+
+    def visit(child):
+        if isinstance(child, Reference) and not child.nested:
+            if isinstance(child.ref, str):
+                references.add(child.ref)
+        elif isinstance(child, list):
+            for item in child:
+                visit(item)
+        elif isinstance(child, MiniLinq):
+            map_children(child, visit)
+        return child
+
+    visit(node)
+    return references
+
+
+def _contains(node, node_type):
+    found = []
+
+    def visit(child):
+        if isinstance(child, node_type):
+            found.append(child)
+        elif isinstance(child, MiniLinq) and not found:
+            map_children(child, visit)
+        return child
+
+    visit(node)
+    return bool(found)
+
+
+def _freeze(value):
+    """
+    Returns a hashable value that is equal for values that are equal,
+    for hashing the fields of MiniLinq nodes.
+    """
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        pass
+    if isinstance(value, dict):
+        return frozenset(
+            (_freeze(key), _freeze(val)) for key, val in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, set):
+        return frozenset(_freeze(item) for item in value)
+    # Unhashable values of other types only need equal hashes when they
+    # are equal
+    return type(value).__name__
+
+
+def _compile(minilinq, static_env):
+    if isinstance(minilinq, MiniLinq):
+        return minilinq.compile(static_env)
+    # e.g. a missing expression in an incomplete query, which fails
+    # when it is evaluated, like it would with ``eval``
+    return lambda env: minilinq.eval(env)
+
+
+def _compile_batch(minilinq, static_env):
+    if isinstance(minilinq, MiniLinq):
+        return minilinq.compile_batch(static_env)
+    return lambda envs: [minilinq.eval(env) for env in envs]
+
+
 ### Register everything with the root parser ###
 
 MiniLinq.register(Reference, slug='Ref')
@@ -1,7 +1,13 @@
+import collections
 import functools
 import hashlib
 import inspect
 import io
+import pickle
+import queue
+import tempfile
+import threading
+from typing import IO, Any, Optional
 
 from commcare_export.repeatable_iterator import RepeatableIterator
 from jsonpath_ng import jsonpath
@@ -81,3 +87,179 @@ def default_to_json(obj):
         return obj.toJSON()
     else:
         return RepeatableIterator.to_jvalue(obj)
+
+
+_END_OF_ITERATION = object()
+
+
+class BackgroundIterator:
+    """
+    Consumes an iterable in a background thread, which starts as soon
+    as the ``BackgroundIterator`` is created, keeping up to
+    ``max_buffered`` items ready for the caller. An exception raised
+    while producing an item is re-raised in the consuming thread.
+
+    Call ``close()`` if iteration is abandoned early, so that the
+    background thread can finish.
+    """
+
+    def __init__(self, iterable, max_buffered):
+        self._buffer: queue.Queue[tuple[Any, Any]] = queue.Queue(
+            maxsize=max_buffered
+        )
+        self._stopped = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(
+            target=self._produce, args=(iterable,), daemon=True
+        )
+        self._thread.start()
+
+    def _put(self, item):
+        # Poll so that the thread can finish if the consumer stops
+        # iterating before the buffer is drained.
+        while not self._stopped.is_set():
+            try:
+                self._buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put((item, None)):
+                    return
+        except BaseException as err:
+            self._put((_END_OF_ITERATION, err))
+        else:
+            self._put((_END_OF_ITERATION, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        item, error = self._buffer.get()
+        if item is _END_OF_ITERATION:
+            self._finished = True
+            self.close()
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    def close(self):
+        self._stopped.set()
+
+
+class SpillingBackgroundIterator:
+    """
+    Consumes an iterable in a background thread, like
+    ``BackgroundIterator``, but without waiting for the caller: up to
+    ``max_items_in_memory`` items are kept in memory, and items after
+    them are pickled to a temporary file until the caller gets to them.
+
+    Call ``close()`` when done, to stop the thread and delete the file.
+    """
+
+    def __init__(self, iterable, max_items_in_memory):
+        self.max_items_in_memory = max_items_in_memory
+        # Items, and ``_Spilled`` markers of the items in the file
+        self._buffer: collections.deque[Any] = collections.deque()
+        self._items_in_memory = 0
+        self._spill_file: Optional[IO[bytes]] = None
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._finished = False
+        self._thread = threading.Thread(
+            target=self._produce, args=(iterable,), daemon=True
+        )
+        self._thread.start()
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                with self._condition:
+                    if self._stopped:
+                        return
+                    self._add(item)
+                    self._condition.notify()
+        except BaseException as err:
+            error: Optional[BaseException] = err
+        else:
+            error = None
+        with self._condition:
+            self._buffer.append((_END_OF_ITERATION, error))
+            self._condition.notify()
+
+    def _add(self, item):
+        if self._items_in_memory < self.max_items_in_memory:
+            self._buffer.append((item, None))
+            self._items_in_memory += 1
+            return
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile()
+        self._spill_file.seek(0, io.SEEK_END)
+        offset = self._spill_file.tell()
+        pickle.dump(item, self._spill_file, pickle.HIGHEST_PROTOCOL)
+        self._buffer.append((_Spilled(offset), None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        with self._condition:
+            while not self._buffer and not self._stopped:
+                self._condition.wait()
+            if self._stopped:
+                raise StopIteration
+            item, error = self._buffer.popleft()
+            if isinstance(item, _Spilled):
+                assert self._spill_file is not None
+                self._spill_file.seek(item.offset)
+                item = pickle.load(self._spill_file)
+            elif item is not _END_OF_ITERATION:
+                self._items_in_memory -= 1
+        if item is _END_OF_ITERATION:
+            self._finished = True
+            self.close()
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    def close(self):
+        with self._condition:
+            self._stopped = True
+            self._buffer.clear()
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+
+
+class _Spilled:
+
+    def __init__(self, offset):
+        self.offset = offset
+
+
+def iterate_in_background(iterable, max_buffered):
+    """
+    Yields the items of ``iterable``, which is consumed in a background
+    thread. See ``BackgroundIterator``.
+
+    e.g.
+
+    >>> list(iterate_in_background(range(5), 2))
+    [0, 1, 2, 3, 4]
+
+    """
+    iterator = BackgroundIterator(iterable, max_buffered)
+    try:
+        yield from iterator
+    finally:
+        iterator.close()
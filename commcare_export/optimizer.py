@@ -0,0 +1,343 @@
+"""
+Rewrites MiniLinq queries into equivalent queries that are cheaper to
+evaluate, for an environment in which ``BuiltInEnv`` comes first, as it
+does in the CLI.
+
+The rewrites are:
+
+* References to built-in functions are replaced with the functions.
+* Applications of pure built-in functions to literals are replaced with
+  their results, e.g. ``template`` with a literal format and arguments.
+* ``Bind`` nodes with a literal value that the body never refers to are
+  removed.
+* ``form_url`` and ``case_url``, which do not depend on their argument,
+  are replaced with the expressions that they return.
+* A ``Filter`` on the documents returned by ``api_data``, that tests a
+  field that the API can filter on for equality with a literal, also
+  adds the filter to the API request, so that HQ only sends documents
+  that can match. The ``Filter`` itself is kept.
+* Expressions that occur more than once in the expression for an item
+  of a ``Map``, ``FlatMap`` or ``Filter``, e.g. a field that is also an
+  alternate source field of another, are only evaluated once per item.
+
+Values that are bound by ``Bind`` are not substituted for references to
+them, because a reference to a bound name evaluates to the results of a
+JSONPath lookup, not to the bound value itself.
+"""
+import json
+from collections import Counter
+
+from jsonpath_ng import jsonpath
+from jsonpath_ng.parser import parse as parse_jsonpath
+
+from commcare_export.env import ROOT_ONLY, BuiltInEnv, NotFound
+from commcare_export.jsonpath_utils import split_leftmost
+from commcare_export.minilinq import (
+    Apply,
+    Bind,
+    Emit,
+    Filter,
+    FlatMap,
+    List,
+    Literal,
+    Map,
+    Memo,
+    MiniLinq,
+    Reference,
+    map_children,
+)
+
+# Built-in functions without side effects, whose result only depends on
+# their arguments
+PURE_BUILTINS = {
+    '+', '-', '*', '//', '/', '>', '>=', '<', '<=', '==', '!=',
+    'len', 'bool', 'str2bool', 'bool2int', 'str2num', 'str2date',
+    'json2str', 'format-uuid', 'selected', 'selected-at',
+    'count-selected', 'join', 'default', 'template', 'filter_empty',
+    'or', 'sha1', 'substr', 'unique',
+}
+# Built-in functions that return an expression that does not depend on
+# their argument
+URL_BUILTINS = {'form_url', 'case_url'}
+# For each resource, the fields of its documents that the API can filter
+# on, and the filter parameter for each
+API_FILTER_FIELDS = {
+    'form': {
+        'app_id': 'app_id',
+        'xmlns': 'xmlns.exact',
+        'form.@xmlns': 'xmlns.exact',
+    },
+    'case': {
+        'owner_id': 'owner_id',
+        'properties.owner_id': 'owner_id',
+        'type': 'type',
+        'properties.case_type': 'type',
+    },
+}
+
+def optimize(query):
+    """
+    Returns an optimized copy of ``query``. ``query`` is not changed.
+    """
+    return _eliminate_common_subexpressions(_Optimizer().optimize(query))
+
+
+class _Optimizer:
+
+    def __init__(self):
+        self.builtins = BuiltInEnv()
+        self.builtin_names = {
+            self.builtins.lookup(name): name for name in PURE_BUILTINS
+        }
+        self.url_builtins = {
+            self.builtins.lookup(name) for name in URL_BUILTINS
+        }
+        self.equals = self.builtins.lookup('==')
+
+    def optimize(self, node):
+        if isinstance(node, list):
+            return [self.optimize(item) for item in node]
+        if not isinstance(node, MiniLinq):
+            return node
+
+        method = getattr(self, f'_optimize_{type(node).__name__}', None)
+        if method is None:
+            return node
+        return method(node)
+
+    def _optimize_Reference(self, node):
+        if node.nested:
+            return Reference(self.optimize(node.ref))
+        try:
+            return Literal(self.builtins.lookup(node.ref))
+        except (NotFound, TypeError):
+            return node
+
+    def _optimize_Literal(self, node):
+        return node
+
+    def _optimize_Apply(self, node):
+        fn = self.optimize(node.fn)
+        args = [self.optimize(arg) for arg in node.args]
+        if (
+            isinstance(fn, Literal)
+            and self._is_builtin_in(fn.v, self.url_builtins)
+            and len(args) == 1
+        ):
+            return self.optimize(fn.v(None))
+        folded = self._fold(fn, args)
+        if folded is not None:
+            return folded
+        return Apply(fn, *args)
+
+    def _fold(self, fn, args):
+        if not (
+            isinstance(fn, Literal)
+            and self._is_pure(fn.v)
+            and all(isinstance(arg, Literal) for arg in args)
+        ):
+            return None
+        try:
+            result = fn.v(*[arg.v for arg in args])
+        except Exception:
+            # Leave it to fail when it is evaluated, with the context of
+            # the document being processed
+            return None
+        if isinstance(result, MiniLinq):
+            return None
+        return Literal(result)
+
+    def _is_pure(self, fn):
+        return self._is_builtin_in(fn, self.builtin_names)
+
+    @staticmethod
+    def _is_builtin_in(fn, builtins):
+        try:
+            return fn in builtins
+        except TypeError:
+            return False
+
+    def _optimize_Bind(self, node):
+        value = self.optimize(node.value)
+        body = self.optimize(node.body)
+        if (
+            isinstance(value, Literal)
+            and node.name != ROOT_ONLY
+            and not _may_refer_to(body, node.name)
+        ):
+            return body
+        return Bind(node.name, value, body)
+
+    def _optimize_Filter(self, node):
+        source = self.optimize(node.source)
+        predicate = self.optimize(node.predicate)
+        return Filter(
+            source=self._push_down(source, predicate, node.name) or source,
+            predicate=predicate,
+            name=node.name,
+        )
+
+    def _push_down(self, source, predicate, name):
+        """
+        Returns ``source`` with the filters of its API request narrowed
+        by ``predicate``, or None if it cannot be.
+        """
+        if not (
+            isinstance(source, Apply)
+            and source.fn == Reference('api_data')
+            and len(source.args) >= 2
+            and isinstance(source.args[0], Literal)
+            and all(isinstance(arg, Literal) for arg in source.args[2:])
+        ):
+            return None
+        field_value = self._get_field_equality(predicate)
+        if field_value is None:
+            return None
+        field, value = field_value
+        if name:
+            if not field.startswith(f'{name}.'):
+                return None
+            field = field[len(name) + 1:]
+        param = API_FILTER_FIELDS.get(source.args[0].v, {}).get(field)
+        if param is None:
+            return None
+
+        resource, checkpoint_manager, *rest = source.args
+        payload = dict(rest[0].v or {}) if rest else {}
+        if param in payload:
+            values = payload[param]
+            if not isinstance(values, list):
+                values = [values]
+            if value not in values:
+                # An OR of other values. Leave it to the Filter.
+                return None
+        payload[param] = [value]
+        return Apply(
+            source.fn,
+            resource,
+            checkpoint_manager,
+            Literal(payload),
+            *rest[1:],
+        )
+
+    def _get_field_equality(self, predicate):
+        if not (
+            isinstance(predicate, Apply)
+            and predicate.fn == Literal(self.equals)
+            and len(predicate.args) == 2
+        ):
+            return None
+        for ref, value in [predicate.args, reversed(predicate.args)]:
+            if (
+                isinstance(ref, Reference)
+                and isinstance(ref.ref, str)
+                and isinstance(value, Literal)
+                and isinstance(value.v, str)
+            ):
+                return ref.ref, value.v
+        return None
+
+    def _optimize_List(self, node):
+        return List([self.optimize(item) for item in node.items])
+
+    def _optimize_Map(self, node):
+        return Map(
+            source=self.optimize(node.source),
+            body=self.optimize(node.body),
+            name=node.name,
+        )
+
+    def _optimize_FlatMap(self, node):
+        return FlatMap(
+            source=self.optimize(node.source),
+            body=self.optimize(node.body),
+            name=node.name,
+        )
+
+    def _optimize_Emit(self, node):
+        return Emit(
+            table=node.table,
+            headings=[self.optimize(heading) for heading in node.headings],
+            source=self.optimize(node.source),
+            missing_value=node.missing_value,
+            data_types=node.data_types,
+        )
+
+
+def _eliminate_common_subexpressions(node, memoize=False):
+    """
+    Replaces every expression that occurs more than once in ``node``,
+    and is evaluated in the same environment as ``node``, with a
+    ``Memo`` shared by its occurrences. Expressions for items of a
+    ``Map``, ``FlatMap`` or ``Filter``, and the bodies of ``Bind``
+    nodes, are evaluated in environments of their own, and are handled
+    separately.
+    """
+    counts: Counter[str] = Counter()
+    if memoize:
+        def count(child):
+            key = _memo_key(child)
+            if key is not None:
+                counts[key] += 1
+            map_children(child, count, lambda scope: scope)
+            return child
+
+        count(node)
+
+    memos = {}
+
+    def rewrite(child):
+        key = _memo_key(child)
+        if key is not None and counts[key] > 1:
+            if key not in memos:
+                memos[key] = Memo(map_children(child, rewrite, new_scope))
+            return memos[key]
+        return map_children(child, rewrite, new_scope)
+
+    def new_scope(scope):
+        return _eliminate_common_subexpressions(scope, memoize=True)
+
+    return rewrite(node)
+
+
+def _memo_key(node):
+    if not isinstance(node, (Apply, Reference)):
+        return None
+    try:
+        return json.dumps(node.to_jvalue(), sort_keys=True, default=repr)
+    except (AttributeError, TypeError):
+        # e.g. a missing expression in an incomplete query
+        return None
+
+
+def _may_refer_to(node, name):
+    """
+    Returns True unless ``node`` certainly does not look up ``name``.
+    """
+    if isinstance(node, list):
+        return any(_may_refer_to(item, name) for item in node)
+    if isinstance(node, Reference):
+        if node.nested or not isinstance(node.ref, str):
+            return True
+        return _jsonpath_may_refer_to(node.ref, name)
+    if isinstance(node, Literal) or not isinstance(node, MiniLinq):
+        return False
+    children = []
+
+    def collect(child):
+        children.append(child)
+        return child
+
+    map_children(node, collect)
+    return any(_may_refer_to(child, name) for child in children)
+
+
+def _jsonpath_may_refer_to(ref, name):
+    try:
+        leftmost, _ = split_leftmost(parse_jsonpath(ref))
+    except Exception:
+        return True
+    if not isinstance(leftmost, jsonpath.Fields):
+        # e.g. `$`, `this` or `*`, which include every bound name
+        return True
+    return any(field in (name, '*') for field in leftmost.fields)
@@ -0,0 +1,288 @@
+"""
+Profiling of MiniLinq queries: how often every expression is evaluated,
+how long it takes, and how many rows it produces, to tell whether an
+export is slow because of CommCare HQ, JSONPath lookups, built-in
+functions or the writer.
+
+Usage::
+
+    profiled_query, profile = profile_query(query)
+    profiled_query.eval(env)
+    print(profile.format())
+
+"""
+import threading
+import time
+from typing import Any
+
+from commcare_export.minilinq import (
+    BATCH_SIZE,
+    Apply,
+    Emit,
+    Filter,
+    FlatMap,
+    Literal,
+    Map,
+    MiniLinq,
+    Reference,
+    map_children,
+)
+from commcare_export.repeatable_iterator import RepeatableIterator
+
+PROFILED_TYPES = (Apply, Emit, Filter, FlatMap, Map, Reference)
+
+
+def profile_query(query):
+    """
+    Returns a copy of ``query`` that records a profile of its
+    evaluation, and the ``QueryProfile`` that it records to.
+    """
+    profile = QueryProfile()
+    return profile.wrap(query), profile
+
+
+class NodeProfile:
+    """
+    The calls, time and rows of one expression.
+
+    Time is wall time, including the time taken to iterate over lazy
+    results. ``total`` includes the time of the expressions evaluated
+    while it is being evaluated, and ``self_time`` does not.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.children = []
+        self.calls = 0
+        self.total = 0.0
+        self.children_total = 0.0
+        self.rows_out = None
+
+    @property
+    def self_time(self):
+        return self.total - self.children_total
+
+    @property
+    def rows_in(self):
+        if isinstance(self.node, (Emit, Filter, FlatMap, Map)):
+            for child in self.children:
+                if child.node is self.node.source:
+                    return child.rows_out
+        return None
+
+    @property
+    def label(self):
+        node = self.node
+        if isinstance(node, Emit):
+            return f'Emit {node.table!r}'
+        if isinstance(node, Apply):
+            return f'Apply {_describe_fn(node.fn)}'
+        if isinstance(node, Reference):
+            if node.nested:
+                return 'Ref (nested)'
+            return f'Ref {node.ref}'
+        if node.name:
+            return f'{type(node).__name__} {node.name}'
+        return type(node).__name__
+
+    def to_jvalue(self):
+        return {
+            'node': self.label,
+            'calls': self.calls,
+            'total_seconds': self.total,
+            'self_seconds': self.self_time,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'children': [child.to_jvalue() for child in self.children],
+        }
+
+
+class QueryProfile:
+    """
+    The profiles of the expressions of a query, as a tree in which every
+    profiled expression is a child of the closest profiled expression
+    that contains it.
+    """
+
+    def __init__(self):
+        self.roots = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def wrap(self, query):
+        # Keyed by the ``id`` of the nodes of ``query``
+        wrapped: dict[int, Any] = {}
+
+        def wrap_node(node, parent):
+            if not isinstance(node, MiniLinq):
+                return node
+            # Nodes shared by several expressions, like those created by
+            # the optimizer, stay shared
+            if id(node) in wrapped:
+                return wrapped[id(node)]
+            if isinstance(node, PROFILED_TYPES):
+                node_profile = NodeProfile(node)
+                if parent is None:
+                    self.roots.append(node_profile)
+                else:
+                    parent.children.append(node_profile)
+                result = Profiled(
+                    map_children(
+                        node, lambda child: wrap_node(child, node_profile)
+                    ),
+                    node_profile,
+                    self,
+                )
+            else:
+                result = map_children(
+                    node, lambda child: wrap_node(child, parent)
+                )
+            wrapped[id(node)] = result
+            return result
+
+        if isinstance(query, list):
+            return [wrap_node(node, None) for node in query]
+        return wrap_node(query, None)
+
+    def timed(self, node_profile, fn, *args):
+        stack = self._get_stack()
+        # The total time of the expressions evaluated by ``fn``
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            children_total = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                node_profile.total += elapsed
+                node_profile.children_total += children_total
+
+    def count(self, node_profile, calls=0, rows=0):
+        with self._lock:
+            node_profile.calls += calls
+            if rows:
+                node_profile.rows_out = (node_profile.rows_out or 0) + rows
+
+    def _get_stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def format(self):
+        """
+        Returns the profile as an indented tree, one expression per line.
+        """
+        lines = []
+
+        def add_lines(node_profile, depth):
+            line = (
+                f'{"  " * depth}{node_profile.label}'
+                f'  calls={node_profile.calls}'
+                f'  total={node_profile.total:.3f}s'
+                f'  self={node_profile.self_time:.3f}s'
+            )
+            if node_profile.rows_in is not None:
+                line += f'  rows_in={node_profile.rows_in}'
+            if node_profile.rows_out is not None:
+                line += f'  rows_out={node_profile.rows_out}'
+            lines.append(line)
+            for child in node_profile.children:
+                add_lines(child, depth + 1)
+
+        for root in self.roots:
+            add_lines(root, 0)
+        return '\n'.join(lines)
+
+    def to_jvalue(self):
+        return [root.to_jvalue() for root in self.roots]
+
+
+class Profiled(MiniLinq):
+    """
+    Evaluates ``body``, and records the calls, time and rows of the
+    evaluation in ``node_profile``.
+    """
+
+    __slots__ = ('body', 'node_profile', 'query_profile')
+
+    def __init__(self, body, node_profile, query_profile):
+        self.body = body
+        self.node_profile = node_profile
+        self.query_profile = query_profile
+
+    def eval(self, env):
+        return self._eval(env, self.body.eval)
+
+    def compile(self, static_env=None):
+        body = self.body.compile(static_env)
+        return lambda env: self._eval(env, body)
+
+    def compile_batch(self, static_env=None):
+        body = self.body.compile_batch(static_env)
+
+        def eval_batch(envs):
+            self.query_profile.count(self.node_profile, calls=len(envs))
+            results = self.query_profile.timed(self.node_profile, body, envs)
+            return [self._wrap_result(result) for result in results]
+
+        return eval_batch
+
+    def compile_batched(self, static_env=None, batch_size=BATCH_SIZE):
+        """
+        Like ``Map.compile_batched``, so that profiling a query does not
+        stop the rows of an ``Emit`` being evaluated in batches.
+        """
+        if not isinstance(self.body, Map):
+            return self.compile(static_env)
+        body = self.body.compile_batched(static_env, batch_size)
+        return lambda env: self._eval(env, body)
+
+    def _eval(self, env, evaluate):
+        self.query_profile.count(self.node_profile, calls=1)
+        result = self.query_profile.timed(self.node_profile, evaluate, env)
+        return self._wrap_result(result)
+
+    def _wrap_result(self, result):
+        if isinstance(result, RepeatableIterator):
+            return RepeatableIterator(lambda: self._iterate(result))
+        return result
+
+    def _iterate(self, result):
+        timed = self.query_profile.timed
+        iterator = timed(self.node_profile, iter, result)
+        while True:
+            try:
+                item = timed(self.node_profile, next, iterator)
+            except StopIteration:
+                return
+            self.query_profile.count(self.node_profile, rows=1)
+            yield item
+
+    def __eq__(self, other):
+        return isinstance(other, Profiled) and self.body == other.body
+
+    __hash__ = MiniLinq.__hash__
+
+    def _hash_key(self):
+        return (Profiled, self.body)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.body!r})'
+
+    def to_jvalue(self):
+        return self.body.to_jvalue()
+
+
+def _describe_fn(fn):
+    if isinstance(fn, Profiled):
+        fn = fn.body
+    if isinstance(fn, Reference) and not fn.nested:
+        return fn.ref
+    if isinstance(fn, Literal):
+        return getattr(fn.v, '__name__', repr(fn.v))
+    return '(expression)'
@@ -0,0 +1,124 @@
+"""
+Client-side rate limiting of requests to CommCare HQ, so that exports
+stay below the rate at which HQ starts responding with 429 (Too Many
+Requests), instead of only backing off after it does.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# The rate is multiplied by this each time HQ asks us to slow down
+RATE_DECREASE_FACTOR = 0.9
+# After this many seconds without being asked to slow down, the rate is
+# raised by RATE_INCREASE_FRACTION of the rate it started at
+RATE_INCREASE_SECONDS = 60
+RATE_INCREASE_FRACTION = 0.1
+
+
+class TokenBucket:
+    """
+    A token bucket that allows ``rate`` requests per second on average,
+    and bursts of up to ``burst`` requests.
+
+    When HQ responds with a Retry-After header, ``penalize`` stops all
+    requests until that time has passed, and lowers the rate, down to
+    at least ``min_rate``, so that the limit is not hit again. Once HQ
+    has not asked us to slow down for a while, the rate is raised in
+    steps back up to ``rate``.
+
+    A bucket is thread-safe, and can be shared by any number of clients.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=None):
+        if rate <= 0:
+            raise ValueError('The rate must be greater than 0')
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.min_rate = min_rate or rate / 10
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._rate_changed = self._updated
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Waits until a request may be made. Returns the number of seconds
+        waited.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._raise_rate(now)
+            # Take the token now, even if it is not available yet, so
+            # that waiting requests are let through in order
+            self._tokens -= 1
+            wait = max(
+                -self._tokens / self.rate if self._tokens < 0 else 0,
+                self._blocked_until - now,
+            )
+        if wait > 0:
+            logger.debug('Waiting %.2fs before the next request', wait)
+            time.sleep(wait)
+        return wait
+
+    def penalize(self, retry_after):
+        """
+        Blocks requests for ``retry_after`` seconds, and lowers the rate.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+            self._tokens = min(self._tokens, 0)
+            new_rate = max(self.rate * RATE_DECREASE_FACTOR, self.min_rate)
+            if new_rate < self.rate:
+                logger.info(
+                    'Lowering the request rate from %.2f to %.2f requests '
+                    'per second',
+                    self.rate,
+                    new_rate,
+                )
+                self.rate = new_rate
+            self._rate_changed = now
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def _raise_rate(self, now):
+        increase = self.max_rate * RATE_INCREASE_FRACTION
+        while (
+            self.rate < self.max_rate
+            and now - self._rate_changed >= RATE_INCREASE_SECONDS
+        ):
+            new_rate = min(self.rate + increase, self.max_rate)
+            logger.info(
+                'Raising the request rate from %.2f to %.2f requests per '
+                'second',
+                self.rate,
+                new_rate,
+            )
+            self.rate = new_rate
+            self._rate_changed += RATE_INCREASE_SECONDS
+
+
+_shared_buckets: dict[str, TokenBucket] = {}
+_shared_buckets_lock = threading.Lock()
+
+
+def get_shared_token_bucket(key, rate, burst=None):
+    """
+    Returns the token bucket shared by every caller in this process
+    that uses the same ``key``, e.g. the URL of a CommCare HQ server.
+    It is created with ``rate`` and ``burst`` by the first caller.
+    """
+    with _shared_buckets_lock:
+        if key not in _shared_buckets:
+            _shared_buckets[key] = TokenBucket(rate, burst)
+        return _shared_buckets[key]
@@ -1,3 +1,12 @@
+import pickle
+import tempfile
+from typing import IO, Optional
+
+# The number of items that a CachingRepeatableIterator keeps in memory
+# before it spills items to a temporary file
+DEFAULT_MAX_ITEMS_IN_MEMORY = 10000
+
+
 class RepeatableIterator:
     """
     Pass something iterable into this and, unless it has crufty issues,
@@ -25,3 +34,76 @@ class RepeatableIterator:
         if isinstance(obj, cls):
             return list(obj)
         raise TypeError(repr(obj) + 'is not JSON serializable')
+
+
+class CachingRepeatableIterator(RepeatableIterator):
+    """
+    A RepeatableIterator that only iterates over ``generator()`` once.
+    Later iterations, including the one started by ``bool()`` to check
+    whether there are any items, replay the items from a cache.
+
+    The first ``max_items_in_memory`` items are kept in memory. Later
+    items are pickled to a temporary file, which is deleted with the
+    iterator, unless they cannot be pickled.
+    """
+
+    def __init__(
+        self, generator, max_items_in_memory=DEFAULT_MAX_ITEMS_IN_MEMORY
+    ):
+        super().__init__(generator)
+        self.max_items_in_memory = max_items_in_memory
+        self._items = []
+        self._spill_file: Optional[IO[bytes]] = None
+        self._source = None
+        self._exhausted = False
+
+    def __iter__(self):
+        index = 0
+        while True:
+            if index < len(self._items):
+                item = self._get(index)
+            elif self._exhausted:
+                return
+            else:
+                if self._source is None:
+                    self._source = iter(self.generator())
+                try:
+                    item = next(self._source)
+                except StopIteration:
+                    self._exhausted = True
+                    self._source = None
+                    return
+                self._add(item)
+            index += 1
+            yield item
+
+    def _add(self, item):
+        if len(self._items) < self.max_items_in_memory:
+            self._items.append(item)
+            return
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile()
+        self._spill_file.seek(0, 2)
+        offset = self._spill_file.tell()
+        try:
+            pickle.dump(item, self._spill_file, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            self._spill_file.truncate(offset)
+            self._items.append(item)
+        else:
+            self._items.append(_Spilled(offset))
+
+    def _get(self, index):
+        item = self._items[index]
+        if isinstance(item, _Spilled):
+            # Items are only spilled once the file is created
+            assert self._spill_file is not None
+            self._spill_file.seek(item.offset)
+            return pickle.load(self._spill_file)
+        return item
+
+
+class _Spilled:
+
+    def __init__(self, offset):
+        self.offset = offset
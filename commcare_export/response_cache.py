@@ -0,0 +1,190 @@
+"""
+An on-disk cache of the raw responses of the CommCare HQ API, so that
+an export can be re-run, or benchmarked, without fetching its data
+again.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MODE_RECORD = 'record'
+MODE_REPLAY = 'replay'
+MODE_READ_THROUGH = 'read-through'
+MODES = [MODE_RECORD, MODE_REPLAY, MODE_READ_THROUGH]
+
+CHUNK_SIZE = 64 * 1024
+COMPRESS_LEVEL = 5
+
+
+class ResponseCacheMiss(Exception):
+
+    def __init__(self, resource, query):
+        self.resource = resource
+        self.query = query
+
+    def __str__(self):
+        return (
+            f'No cached response for "{self.resource}" with parameters '
+            f'"{self.query}"'
+        )
+
+
+class ResponseCache:
+    """
+    Stores gzip-compressed response bodies in files named by a hash of
+    the resource and query string. ``CommCareHqClient`` uses the URL of
+    the resource, which includes the project and API version, so that
+    exports of different projects can share a cache.
+
+    In "record" mode every response is fetched and stored. In "replay"
+    mode responses are only read from the cache, and a missing response
+    raises ``ResponseCacheMiss``. In "read-through" mode responses are
+    read from the cache, or fetched and stored if they are missing.
+
+    If ``max_size`` (in bytes) is given, the least recently used
+    responses are removed when the cache grows larger. The sizes of the
+    responses, in the order they were used, are read from the cache
+    directory once, and then kept up to date in memory, so responses
+    stored by another process at the same time are not counted.
+    """
+
+    def __init__(self, path, mode=MODE_READ_THROUGH, max_size=None):
+        if mode not in MODES:
+            raise ValueError(f'Unknown response cache mode: {mode}')
+        self.path = path
+        self.mode = mode
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        # The size of every cached response, least recently used first
+        self._files: OrderedDict[str, int] = OrderedDict(
+            (file_path, size) for file_path, _, size in sorted(
+                self._iter_files(), key=lambda file: file[1]
+            )
+        )
+        self._size = sum(self._files.values())
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, resource, query):
+        """
+        Returns the cached response, or ``None`` if it should be
+        fetched.
+        """
+        if self.mode == MODE_RECORD:
+            return None
+        file_path = self._get_file_path(resource, query)
+        try:
+            with gzip.open(file_path, 'rb') as fh:
+                content = fh.read()
+        except FileNotFoundError:
+            return self._miss(resource, query)
+        self._touch(file_path)
+        logger.debug('Using cached response for %s: %s', resource, query)
+        return content
+
+    def get_chunks(self, resource, query):
+        """
+        Like ``get``, but returns an iterator of chunks of the cached
+        response.
+        """
+        if self.mode == MODE_RECORD:
+            return None
+        file_path = self._get_file_path(resource, query)
+        try:
+            fh = gzip.open(file_path, 'rb')
+        except FileNotFoundError:
+            return self._miss(resource, query)
+        self._touch(file_path)
+        logger.debug('Using cached response for %s: %s', resource, query)
+        return self._iter_file(fh)
+
+    def put(self, resource, query, content):
+        self._write(resource, query, [content])
+
+    def tee(self, resource, query, chunks):
+        """
+        Yields ``chunks``, and stores them once they have all been
+        read.
+        """
+        received = []
+        for chunk in chunks:
+            received.append(chunk)
+            yield chunk
+        self._write(resource, query, received)
+
+    def _miss(self, resource, query):
+        if self.mode == MODE_REPLAY:
+            raise ResponseCacheMiss(resource, query)
+        return None
+
+    @staticmethod
+    def _iter_file(fh):
+        with fh:
+            while True:
+                chunk = fh.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _get_file_path(self, resource, query):
+        key = hashlib.sha256(f'{resource}?{query}'.encode('utf-8'))
+        digest = key.hexdigest()
+        return os.path.join(self.path, digest[:2], f'{digest}.json.gz')
+
+    def _write(self, resource, query, chunks):
+        file_path = self._get_file_path(resource, query)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # Write to a temporary file first so that a response is never
+        # read while it is partly written
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path))
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(
+                fileobj=raw, mode='wb', compresslevel=COMPRESS_LEVEL
+            ) as fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+        with self._lock:
+            os.replace(tmp_path, file_path)
+            self._size -= self._files.pop(file_path, 0)
+            self._files[file_path] = os.path.getsize(file_path)
+            self._size += self._files[file_path]
+            self._evict()
+
+    def _touch(self, file_path):
+        try:
+            os.utime(file_path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            if file_path in self._files:
+                self._files.move_to_end(file_path)
+
+    def _iter_files(self):
+        for entry in os.scandir(self.path):
+            if not entry.is_dir():
+                continue
+            for file_entry in os.scandir(entry.path):
+                if file_entry.name.endswith('.json.gz'):
+                    stat = file_entry.stat()
+                    yield file_entry.path, stat.st_mtime, stat.st_size
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        while self._size > self.max_size and self._files:
+            file_path, size = self._files.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                continue
+            logger.debug('Evicted cached response %s', file_path)
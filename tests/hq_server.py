@@ -0,0 +1,377 @@
+"""
+A local stand-in for the CommCare HQ API, serving synthetic documents,
+for end-to-end tests and benchmarks of ``CommCareHqClient``.
+
+It follows the pagination of the real API: date-indexed resources are
+ordered by, and filtered on, their date field, other resources are
+paginated with ``limit`` and ``offset``, and UCRs with a cursor. It can
+add latency to every response, and answer a share of requests with 429
+(Too Many Requests) or 500 errors.
+
+Usage::
+
+    python -m tests.hq_server [--port 8000] [--num-docs 10000]
+
+and then e.g. ::
+
+    commcare-export --commcare-hq http://localhost:8000 \\
+        --project test-project --auth-mode apikey \\
+        --username user --password key ...
+
+"""
+import argparse
+import base64
+import gzip
+import json
+import random
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from dateutil.parser import parse
+
+FIRST_DATE = datetime(2024, 1, 1)
+
+# The date field that each date-indexed resource is ordered by, and the
+# parameters that filter on it
+DATE_FIELDS = {
+    'form': ('indexed_on', 'indexed_on_start', 'indexed_on_end'),
+    'case': ('indexed_on', 'indexed_on_start', 'indexed_on_end'),
+    'messaging-event': (
+        'date_last_activity',
+        'date_last_activity.gte',
+        'date_last_activity.lt',
+    ),
+}
+RESOURCES = [
+    'form',
+    'case',
+    'user',
+    'location',
+    'location_type',
+    'ucr',
+    'messaging-event',
+]
+
+
+class HqApiStub:
+    """
+    Serves ``num_docs`` documents of every resource, each padded to
+    about ``doc_size`` bytes.
+
+    :param latency: Seconds to wait before every response
+    :param too_many_requests_rate: Share of requests answered with 429
+    :param retry_after: The Retry-After header of 429 responses
+    :param error_rate: Share of requests answered with 500
+    :param seed: Seed for choosing which requests fail
+
+    e.g. ::
+
+        with HqApiStub(num_docs=100) as stub:
+            client = CommCareHqClient(stub.url, stub.project, 'u', 'key')
+
+    """
+
+    def __init__(
+        self,
+        num_docs=1000,
+        doc_size=500,
+        latency=0,
+        too_many_requests_rate=0,
+        retry_after=1,
+        error_rate=0,
+        seed=0,
+        project='test-project',
+        host='127.0.0.1',
+        port=0,
+    ):
+        self.num_docs = num_docs
+        self.doc_size = doc_size
+        self.latency = latency
+        self.too_many_requests_rate = too_many_requests_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.project = project
+        self.requests = []
+        self.responses = []
+        self._host = host
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._documents = {}
+        self._dates = {}
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self):
+        return f'http://{self._host}:{self._server.server_address[1]}'
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            kwargs={'poll_interval': 0.05},
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def get_documents(self, resource):
+        with self._lock:
+            if resource not in self._documents:
+                self._documents[resource] = [
+                    self._make_document(resource, i)
+                    for i in range(self.num_docs)
+                ]
+                if resource in DATE_FIELDS:
+                    field = DATE_FIELDS[resource][0]
+                    self._dates[resource] = [
+                        doc[field] for doc in self._documents[resource]
+                    ]
+            return self._documents[resource]
+
+    def handle(self, resource, params):
+        """
+        Returns the status, headers and body of the response to a
+        request for ``resource``.
+        """
+        with self._lock:
+            self.requests.append((resource, params))
+            fail = self._random.random()
+        if self.latency:
+            time.sleep(self.latency)
+
+        if fail < self.too_many_requests_rate:
+            return self._respond(
+                429, {'Retry-After': str(self.retry_after)}, b''
+            )
+        if fail < self.too_many_requests_rate + self.error_rate:
+            return self._respond(500, {}, b'Internal Server Error')
+        if resource not in RESOURCES:
+            return self._respond(404, {}, b'Not Found')
+
+        documents = self.get_documents(resource)
+        limit = int(params.get('limit', 20))
+        if resource in DATE_FIELDS:
+            page = self._get_date_page(resource, documents, params, limit)
+        elif resource == 'ucr':
+            page = self._get_cursor_page(documents, params, limit)
+        else:
+            page = self._get_offset_page(documents, params, limit)
+        body = json.dumps(page).encode('utf-8')
+        return self._respond(200, {'Content-Type': 'application/json'}, body)
+
+    def _respond(self, status, headers, body):
+        with self._lock:
+            self.responses.append(status)
+        return status, headers, body
+
+    def _get_date_page(self, resource, documents, params, limit):
+        _, start_param, end_param = DATE_FIELDS[resource]
+        dates = self._dates[resource]
+        start = bisect_left(dates, _parse_date(params.get(start_param)))
+        end = len(documents)
+        if params.get(end_param):
+            end_date = _parse_date(params[end_param])
+            if end_param.endswith('.lt'):
+                end = bisect_left(dates, end_date)
+            else:
+                end = bisect_right(dates, end_date)
+        matching = documents[start:end]
+        has_next = len(matching) > limit
+        return _page(
+            matching[:limit],
+            limit,
+            next_params=dict(params, offset=limit) if has_next else None,
+            total_count=len(matching),
+        )
+
+    def _get_offset_page(self, documents, params, limit):
+        offset = int(params.get('offset', 0))
+        has_next = offset + limit < len(documents)
+        return _page(
+            documents[offset:offset + limit],
+            limit,
+            offset=offset,
+            next_params=(
+                dict(params, offset=offset + limit) if has_next else None
+            ),
+            total_count=len(documents),
+        )
+
+    def _get_cursor_page(self, documents, params, limit):
+        # Like the UCR API, every page has a next cursor, and the end is
+        # reached with an empty page
+        offset = _decode_cursor(params.get('cursor'))
+        return _page(
+            documents[offset:offset + limit],
+            limit,
+            next_params=dict(params, cursor=_encode_cursor(offset + limit)),
+        )
+
+    def _make_document(self, resource, i):
+        date = FIRST_DATE + timedelta(minutes=i)
+        doc: dict[str, Any] = {'id': f'{resource}-{i}'}
+        if resource in DATE_FIELDS:
+            doc[DATE_FIELDS[resource][0]] = date.isoformat()
+        if resource == 'form':
+            doc.update({
+                'received_on': date.isoformat(),
+                'server_modified_on': date.isoformat(),
+                'form': {'@name': 'Registration', 'number': i},
+            })
+        elif resource == 'case':
+            doc.update({
+                'case_id': doc['id'],
+                'server_date_modified': date.isoformat(),
+                'properties': {'case_type': 'person', 'number': i},
+            })
+        elif resource == 'user':
+            doc.update({'username': f'user{i}', 'groups': []})
+        elif resource == 'location_type':
+            doc.update({
+                'code': f'type{i}',
+                'resource_uri': f'/api/v0.5/location_type/{i}/',
+            })
+        elif resource == 'location':
+            doc.update({
+                'location_id': doc['id'],
+                'location_type': '/api/v0.5/location_type/0/',
+                'resource_uri': f'/api/v0.5/location/{i}/',
+            })
+        doc['padding'] = _make_padding(
+            random.Random(doc['id']), self.doc_size - len(json.dumps(doc))
+        )
+        return doc
+
+
+# Padding made of these words compresses about as well as form data
+WORDS = [
+    'yes', 'no', 'unknown', 'male', 'female', 'village', 'district',
+    'household', 'visit', 'referral', 'pregnant', 'child', 'vaccine',
+    'malaria', 'fever', 'cough', 'clinic', 'water', 'latrine', 'follow_up',
+]
+
+
+def _make_padding(rand, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rand.choice(WORDS) + str(rand.randrange(100))
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:max(size, 0)]
+
+
+def _page(objects, limit, offset=0, next_params=None, total_count=None):
+    return {
+        'meta': {
+            'limit': limit,
+            'offset': offset,
+            'next': f'?{urlencode(next_params)}' if next_params else None,
+            'previous': None,
+            'total_count': total_count,
+        },
+        'objects': objects,
+    }
+
+
+def _parse_date(value):
+    if not value:
+        return ''
+    return parse(value, ignoretz=True).isoformat()
+
+
+def _encode_cursor(offset):
+    return base64.urlsafe_b64encode(str(offset).encode('ascii')).decode()
+
+
+def _decode_cursor(cursor):
+    if not cursor:
+        return 0
+    return int(base64.urlsafe_b64decode(cursor.encode('ascii')))
+
+
+def _make_handler(stub):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            prefix = f'/a/{stub.project}/api/'
+            if not url.path.startswith(prefix):
+                self._send(404, {}, b'Not Found')
+                return
+            resource = url.path[len(prefix):].strip('/').split('/', 1)[-1]
+            params = {
+                key: values[-1]
+                for key, values in parse_qs(url.query).items()
+            }
+            self._send(*stub.handle(resource, params))
+
+        def _send(self, status, headers, body):
+            if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                headers = dict(headers, **{'Content-Encoding': 'gzip'})
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--project', default='test-project')
+    parser.add_argument('--num-docs', type=int, default=10000)
+    parser.add_argument('--doc-size', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--too-many-requests-rate', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    stub = HqApiStub(
+        num_docs=args.num_docs,
+        doc_size=args.doc_size,
+        latency=args.latency,
+        too_many_requests_rate=args.too_many_requests_rate,
+        error_rate=args.error_rate,
+        project=args.project,
+        host='localhost',
+        port=args.port,
+    )
+    print(f'Serving {args.project} at {stub.url}')
+    with stub:
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
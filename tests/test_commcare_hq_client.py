@@ -1,4 +1,10 @@
+import asyncio
+import gzip
+import io
+import threading
+import time
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch
 
 import requests
@@ -8,6 +14,7 @@ from requests.structures import CaseInsensitiveDict
 import pytest
 from commcare_export.checkpoint import CheckpointManagerWithDetails
 from commcare_export.commcare_hq_client import (
+    AsyncCommCareHqClient,
     CommCareHqClient,
     ResourceRepeatException,
 )
@@ -22,11 +29,14 @@ from commcare_export.commcare_minilinq import (
 
 class FakeSession:
 
-    def get(self, resource_url, params=None, auth=None, timeout=None):
+    def get(
+        self, resource_url, params=None, auth=None, timeout=None, stream=False
+    ):
         result = self._get_results(params)
-        # Mutatey construction method required by requests.Response
+        # The body is read from ``raw``, like that of a real response,
+        # so it can be streamed too
         response = requests.Response()
-        response._content = simplejson.dumps(result).encode('utf-8')
+        response.raw = io.BytesIO(simplejson.dumps(result).encode('utf-8'))
         response.status_code = 200
         return response
 
@@ -243,9 +253,41 @@ class FakeDateFormSession(FakeSession):
                 raise Exception(indexed_on)
 
 
-def _iterate_with_paginator(session, paginator, expected_count, expected_vals):
+class FakeFailingSession(FakeSession):
+
+    def _get_results(self, params):
+        if params:
+            raise ValueError('Bad page')
+        return super()._get_results(params)
+
+
+class RecordingCheckpointManager(CheckpointManagerWithDetails):
+
+    def __init__(self):
+        super().__init__(None, None, PaginationMode.date_indexed)
+        self.checkpoints = []
+
+    def set_checkpoint(
+        self, checkpoint_time, is_final=False, doc_id=None, cursor=None
+    ):
+        self.checkpoints.append((checkpoint_time, is_final, doc_id))
+
+
+def _iterate_with_paginator(
+    session,
+    paginator,
+    expected_count,
+    expected_vals,
+    prefetch_pages=0,
+    stream_pages=False,
+):
     client = CommCareHqClient(
-        '/fake/commcare-hq/url', 'fake-project', None, None
+        '/fake/commcare-hq/url',
+        'fake-project',
+        None,
+        None,
+        prefetch_pages=prefetch_pages,
+        stream_pages=stream_pages,
     )
     client.session = session
 
@@ -293,6 +335,99 @@ class TestCommCareHqClient:
             [1, 2, 3]
         )
 
+    @pytest.mark.parametrize('prefetch_pages', [1, 3])
+    def test_iterate_prefetch(self, prefetch_pages):
+        _iterate_with_paginator(
+            FakeSession(), SimplePaginator('fake'), 2, [1, 2],
+            prefetch_pages=prefetch_pages,
+        )
+        _iterate_with_paginator(
+            FakeDateFormSession(), get_paginator('form'), 3, [1, 2, 3],
+            prefetch_pages=prefetch_pages,
+        )
+        _iterate_with_paginator(
+            FakeMessageLogSession(), get_paginator('messaging-event', 2), 3,
+            [1, 2, 3],
+            prefetch_pages=prefetch_pages,
+        )
+
+    def test_iterate_streamed(self):
+        _iterate_with_paginator(
+            FakeSession(), SimplePaginator('fake'), 2, [1, 2],
+            stream_pages=True,
+        )
+        _iterate_with_paginator(
+            FakeDateFormSession(), get_paginator('form'), 3, [1, 2, 3],
+            stream_pages=True,
+        )
+        _iterate_with_paginator(
+            FakeDateCaseSession(), get_paginator('case'), 2, [1, 2],
+            stream_pages=True,
+        )
+        _iterate_with_paginator(
+            FakeMessageLogSession(), get_paginator('messaging-event', 2), 3,
+            [1, 2, 3],
+            stream_pages=True,
+        )
+
+    def test_iterate_streamed_repeat_limit(self):
+        with pytest.raises(ResourceRepeatException):
+            _iterate_with_paginator(
+                FakeRepeatedDateCaseSession(), get_paginator('case', 2), 2,
+                [1, 2],
+                stream_pages=True,
+            )
+
+    def test_iterate_streamed_checkpoints(self):
+        client = CommCareHqClient(
+            '/fake/commcare-hq/url', 'fake-project', None, None,
+            stream_pages=True,
+        )
+        client.session = FakeDateFormSession()
+        paginator = get_paginator('form')
+        paginator.init()
+        checkpoint_manager = RecordingCheckpointManager()
+
+        results = list(client.iterate(
+            '/fake/uri', paginator, checkpoint_manager=checkpoint_manager
+        ))
+        assert [result['id'] for result in results] == [1, 2, 3]
+        assert checkpoint_manager.checkpoints == [
+            (datetime(2017, 1, 1, 15, 36, 22), False, 1),
+            (datetime(2017, 1, 1, 16, 0), False, 2),
+        ]
+
+    def test_iterate_prefetch_checkpoints(self):
+        client = CommCareHqClient(
+            '/fake/commcare-hq/url', 'fake-project', None, None,
+            prefetch_pages=2,
+        )
+        client.session = FakeDateFormSession()
+        paginator = get_paginator('form')
+        paginator.init()
+        checkpoint_manager = RecordingCheckpointManager()
+
+        results = client.iterate(
+            '/fake/uri', paginator, checkpoint_manager=checkpoint_manager
+        )
+        seen = []
+        for result in results:
+            # Checkpoints trail the objects given to the consumer
+            seen.append((result['id'], len(checkpoint_manager.checkpoints)))
+
+        assert seen == [(1, 0), (2, 1), (3, 2)]
+        assert checkpoint_manager.checkpoints == [
+            (datetime(2017, 1, 1, 15, 36, 22), False, 1),
+            (datetime(2017, 1, 1, 16, 0), False, 2),
+        ]
+
+    def test_iterate_prefetch_error(self):
+        with pytest.raises(ValueError, match='Bad page'):
+            _iterate_with_paginator(
+                FakeFailingSession(), SimplePaginator('fake'), 2, [1, 2],
+                prefetch_pages=1,
+            )
+
     @pytest.mark.parametrize(
         "headers,expected",
         [
@@ -362,6 +497,204 @@ class TestCommCareHqClient:
                 '/fake/commcare-hq/url', 'fake-project', None, None
             ).get("location")
 
+    @patch('backoff._sync.time.sleep')
+    def test_rate_limiter_penalized_by_retry_after(self, sleep_mock):
+        class FakeRateLimitedSession(FakeSession):
+            calls = 0
+
+            def get(self, *args, **kwargs):
+                self.calls += 1
+                if self.calls == 1:
+                    response = requests.Response()
+                    response.status_code = 429
+                    response.headers['Retry-After'] = '3'
+                    return response
+                return super().get(*args, **kwargs)
+
+        class RecordingLimiter:
+
+            def __init__(self):
+                self.acquired = 0
+                self.penalties = []
+
+            def acquire(self):
+                self.acquired += 1
+
+            def penalize(self, retry_after):
+                self.penalties.append(retry_after)
+
+        limiter = RecordingLimiter()
+        client = CommCareHqClient(
+            '/fake/commcare-hq/url', 'fake-project', None, None,
+            rate_limiter=limiter,
+        )
+        client.session = FakeRateLimitedSession()
+        assert client.get('form')['objects'] == [{'id': 2, 'foo': 1}]
+        assert limiter.acquired == 2
+        assert limiter.penalties == [3.0]
+
+    @pytest.mark.parametrize('stream_pages', [False, True])
+    def test_page_time_excludes_retry_wait(self, stream_pages):
+        clock = [0.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        class FakeRateLimitedSession(FakeSession):
+            calls = 0
+
+            def get(self, *args, **kwargs):
+                self.calls += 1
+                clock[0] += 0.5
+                if self.calls == 1:
+                    response = requests.Response()
+                    response.status_code = 429
+                    response.headers['Retry-After'] = '3'
+                    return response
+                return super().get(*args, **kwargs)
+
+        class RecordingPaginator(SimplePaginator):
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.elapsed: list[float] = []
+
+            def record_page(self, elapsed, num_bytes, num_objects):
+                self.elapsed.append(elapsed)
+
+        client = CommCareHqClient(
+            '/fake/commcare-hq/url', 'fake-project', None, None,
+            stream_pages=stream_pages,
+        )
+        client.session = FakeRateLimitedSession()
+        paginator = RecordingPaginator('fake')
+        paginator.init()
+        with (
+            patch('backoff._sync.time.sleep', sleep),
+            patch('time.monotonic', lambda: clock[0]),
+        ):
+            assert len(list(client.iterate('form', paginator))) == 2
+        assert paginator.elapsed == [0.5, 0.5]
+
+    def test_session(self):
+        client = CommCareHqClient(
+            '/fake/commcare-hq/url', 'fake-project', None, None,
+            pool_size=20,
+        )
+        session = client.session
+        assert 'gzip' in session.headers['Accept-Encoding']
+        assert session.get_adapter('https://example.com')._pool_maxsize == 20
+
+    def test_compressed_transfer_stats(self):
+        page = {
+            'meta': {'next': None, 'limit': 100},
+            'objects': [{'id': i, 'form': 'x' * 100} for i in range(100)],
+        }
+        body = simplejson.dumps(page).encode('utf-8')
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    content = gzip.compress(body)
+                    self.send_header('Content-Encoding', 'gzip')
+                else:
+                    content = body
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = f'http://127.0.0.1:{server.server_address[1]}'
+            client = CommCareHqClient(url, 'fake-project', None, None)
+            assert client.get('form') == page
+            with client.get_streamed('form') as streamed:
+                assert list(streamed.objects()) == page['objects']
+
+            identity_client = CommCareHqClient(
+                url, 'fake-project', None, None, accept_encoding='identity'
+            )
+            assert identity_client.get('form') == page
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        stats = client.transfer_stats
+        assert stats.responses == 2
+        assert stats.decoded_bytes == 2 * len(body)
+        assert stats.wire_bytes == 2 * len(gzip.compress(body))
+        assert identity_client.transfer_stats.wire_bytes == len(body)
+
+
+class FakeSlowSession(FakeSession):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get(self, *args, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight -= 1
+        return super().get(*args, **kwargs)
+
+
+class TestAsyncCommCareHqClient:
+
+    def _get_client(self, session):
+        client = CommCareHqClient(
+            '/fake/commcare-hq/url', 'fake-project', None, None
+        )
+        client.session = session
+        return client
+
+    def test_iterate(self):
+        async_client = AsyncCommCareHqClient(
+            self._get_client(FakeDateFormSession())
+        )
+        paginator = get_paginator('form')
+        paginator.init()
+        checkpoint_manager = CheckpointManagerWithDetails(
+            None, None, PaginationMode.date_indexed
+        )
+        results = asyncio.run(
+            async_client.get_all(
+                '/fake/uri', paginator, checkpoint_manager=checkpoint_manager
+            )
+        )
+        assert [result['foo'] for result in results] == [1, 2, 3]
+
+    def test_get(self):
+        async_client = AsyncCommCareHqClient(self._get_client(FakeSession()))
+        result = asyncio.run(async_client.get('/fake/uri'))
+        assert result['objects'] == [{'id': 2, 'foo': 1}]
+
+    def test_max_concurrent_requests(self):
+        session = FakeSlowSession()
+        async_client = AsyncCommCareHqClient(
+            self._get_client(session), max_concurrent_requests=2
+        )
+
+        async def get_many():
+            return await asyncio.gather(
+                *[async_client.get('/fake/uri') for _ in range(6)]
+            )
+
+        assert len(asyncio.run(get_many())) == 6
+        assert session.max_in_flight == 2
+
 
 class TestDatePaginator:
     def test_empty_batch(self):
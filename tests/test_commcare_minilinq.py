@@ -1,16 +1,32 @@
+import threading
+from datetime import datetime, timedelta, timezone
 from itertools import islice
 
+import requests
+import simplejson
 from jsonpath_ng import jsonpath
 
-from commcare_export.checkpoint import CheckpointManagerWithDetails
-from commcare_export.commcare_hq_client import MockCommCareHqClient
+from commcare_export.checkpoint import (
+    Checkpoint,
+    CheckpointManager,
+    CheckpointManagerWithDetails,
+    session_scope,
+)
+from commcare_export.commcare_hq_client import (
+    CommCareHqClient,
+    MockCommCareHqClient,
+)
 from commcare_export.commcare_minilinq import (
+    AdaptivePaging,
     CommCareHqEnv,
+    SHARD_BUFFER_PAGES,
     PaginationMode,
+    ShardedApiData,
     get_paginator,
 )
 from commcare_export.env import BuiltInEnv, JsonPathEnv
 from commcare_export.minilinq import Apply, FlatMap, Literal, Reference
+from commcare_export.repeatable_iterator import RepeatableIterator
 
 
 class TestCommCareMiniLinq:
@@ -22,6 +38,326 @@ class TestCommCareMiniLinq:
         _run_eval(PaginationMode.date_modified)
 
 
+FIRST_INDEXED_ON = datetime(2024, 1, 1)
+INDEXED_ON_DOCS = [
+    {
+        'id': f'doc{i}',
+        'indexed_on': (FIRST_INDEXED_ON + timedelta(hours=i)).isoformat(),
+    } for i in range(20)
+]
+
+
+class FakeIndexedOnSession:
+
+    def __init__(self, docs=INDEXED_ON_DOCS):
+        self.docs = docs
+        self.requests = []
+
+    def get(self, resource_url, params=None, auth=None, timeout=None):
+        self.requests.append(dict(params))
+        start = params.get('indexed_on_start', '')
+        end = params.get('indexed_on_end', '9999')
+        docs = [
+            doc for doc in self.docs
+            if start <= doc['indexed_on'] <= end
+        ]
+        limit = int(params['limit'])
+        result = {
+            'meta': {
+                'next': '?page=next' if len(docs) > limit else None,
+                'limit': limit,
+            },
+            'objects': docs[:limit],
+        }
+        response = requests.Response()
+        response._content = simplejson.dumps(result).encode('utf-8')
+        response.status_code = 200
+        return response
+
+
+class RecordingCheckpointManager(CheckpointManagerWithDetails):
+
+    def __init__(self, since_param=None):
+        super().__init__(None, since_param, PaginationMode.date_indexed)
+        self.checkpoints = []
+
+    def set_checkpoint(
+        self, checkpoint_time, is_final=False, doc_id=None, cursor=None
+    ):
+        self.checkpoints.append((checkpoint_time, is_final, doc_id))
+
+
+class TestShardedApiData:
+
+    def _get_client(self):
+        client = CommCareHqClient(
+            '/fake/commcare-hq/url', 'fake-project', None, None
+        )
+        client.session = FakeIndexedOnSession()
+        return client
+
+    def test_ranges(self):
+        checkpoint_manager = RecordingCheckpointManager(FIRST_INDEXED_ON)
+        until = FIRST_INDEXED_ON + timedelta(hours=30)
+        sharded = ShardedApiData(
+            self._get_client(), 'form', checkpoint_manager,
+            until=until, shards=3,
+        )
+        assert sharded.get_ranges() == [
+            (
+                FIRST_INDEXED_ON,
+                FIRST_INDEXED_ON + timedelta(hours=10, microseconds=-1),
+            ),
+            (
+                FIRST_INDEXED_ON + timedelta(hours=10),
+                FIRST_INDEXED_ON + timedelta(hours=20, microseconds=-1),
+            ),
+            (FIRST_INDEXED_ON + timedelta(hours=20), until),
+        ]
+
+    def test_ranges_start_from_first_doc(self):
+        sharded = ShardedApiData(
+            self._get_client(), 'form', RecordingCheckpointManager(),
+            until=FIRST_INDEXED_ON + timedelta(hours=20), shards=2,
+        )
+        assert sharded.get_ranges()[0][0] == FIRST_INDEXED_ON
+
+    def test_iterate(self):
+        checkpoint_manager = RecordingCheckpointManager()
+        env = CommCareHqEnv(
+            self._get_client(),
+            page_size=3,
+            until=FIRST_INDEXED_ON + timedelta(hours=25),
+            shards=4,
+        )
+        results = env.api_data('form', checkpoint_manager)
+        assert [doc['id'] for doc in results] == [
+            doc['id'] for doc in INDEXED_ON_DOCS
+        ]
+
+        checkpoint_times = [cp[0] for cp in checkpoint_manager.checkpoints]
+        assert checkpoint_times == sorted(checkpoint_times)
+        assert [cp[1] for cp in checkpoint_manager.checkpoints].count(
+            True
+        ) == 1
+        assert checkpoint_manager.checkpoints[-1] == (
+            FIRST_INDEXED_ON + timedelta(hours=19), True, 'doc19'
+        )
+
+    def test_last_shard_empty(self, tmp_path):
+        manager = CheckpointManager(
+            f'sqlite:///{tmp_path}/checkpoints.db',
+            'query.xlsx',
+            'md5',
+            'fake-project',
+            'https://www.commcarehq.org',
+            table_names=['forms'],
+            data_source='form',
+        )
+        manager.create_checkpoint_table()
+        env = CommCareHqEnv(
+            self._get_client(),
+            page_size=3,
+            until=FIRST_INDEXED_ON + timedelta(hours=40),
+            shards=2,
+        )
+        results = env.api_data(
+            'form',
+            CheckpointManagerWithDetails(
+                manager, None, PaginationMode.date_indexed
+            ),
+        )
+        assert len(list(results)) == len(INDEXED_ON_DOCS)
+
+        # The non-final checkpoints are removed with the final one
+        with session_scope(manager.Session) as session:
+            checkpoints = [
+                (checkpoint.since_param, checkpoint.final)
+                for checkpoint in session.query(Checkpoint)
+            ]
+        assert checkpoints == [
+            ((FIRST_INDEXED_ON + timedelta(hours=19)).isoformat(), True)
+        ]
+
+    def test_ranges_with_timezone(self):
+        checkpoint_manager = RecordingCheckpointManager(
+            datetime(2024, 1, 1, 2, tzinfo=timezone(timedelta(hours=2)))
+        )
+        sharded = ShardedApiData(
+            self._get_client(), 'form', checkpoint_manager,
+            until=FIRST_INDEXED_ON + timedelta(hours=10), shards=2,
+        )
+        assert sharded.get_ranges() == [
+            (
+                FIRST_INDEXED_ON,
+                FIRST_INDEXED_ON + timedelta(hours=5, microseconds=-1),
+            ),
+            (
+                FIRST_INDEXED_ON + timedelta(hours=5),
+                FIRST_INDEXED_ON + timedelta(hours=10),
+            ),
+        ]
+
+    def test_later_shards_keep_fetching(self):
+        # The first shard is stuck until the second one has fetched more
+        # pages than it can buffer in memory
+        docs = [{
+            'id': f'doc{i}',
+            'indexed_on': (FIRST_INDEXED_ON + timedelta(hours=i)).isoformat(),
+        } for i in range(60)]
+        second_shard_start = FIRST_INDEXED_ON + timedelta(hours=30)
+        second_shard_requests = []
+        unblocked = threading.Event()
+        timed_out = []
+
+        class BlockingSession(FakeIndexedOnSession):
+
+            def get(
+                self, resource_url, params=None, auth=None, timeout=None
+            ):
+                end = params.get('indexed_on_end', '9999')
+                if end < second_shard_start.isoformat():
+                    if not unblocked.wait(timeout=5):
+                        timed_out.append(True)
+                        unblocked.set()
+                else:
+                    second_shard_requests.append(params)
+                    if len(second_shard_requests) > SHARD_BUFFER_PAGES * 2:
+                        unblocked.set()
+                return super().get(resource_url, params, auth, timeout)
+
+        client = self._get_client()
+        client.session = BlockingSession(docs)
+        env = CommCareHqEnv(
+            client,
+            page_size=2,
+            until=FIRST_INDEXED_ON + timedelta(hours=60),
+            shards=2,
+        )
+        results = env.api_data(
+            'form', RecordingCheckpointManager(FIRST_INDEXED_ON)
+        )
+        assert [doc['id'] for doc in results] == [doc['id'] for doc in docs]
+        assert not timed_out
+
+    def test_unsharded_resource(self):
+        client = MockCommCareHqClient({
+            'user': [({'limit': 1000}, [{'id': 1}])],
+        })
+        env = CommCareHqEnv(client, shards=4)
+        assert list(
+            env.api_data('user', RecordingCheckpointManager())
+        ) == [{'id': 1}]
+
+
+def test_cache_results():
+    fetches = []
+
+    class CountingClient(MockCommCareHqClient):
+
+        def iterate(self, *args, **kwargs):
+            results = super().iterate(*args, **kwargs)
+
+            def fetch():
+                fetches.append(1)
+                return iter(results)
+
+            return RepeatableIterator(fetch)
+
+    client = CountingClient({
+        'user': [({'limit': 1000}, [{'id': 1}, {'id': 2}])],
+    })
+    for cache_results, expected_fetches in [(False, 3), (True, 1)]:
+        del fetches[:]
+        env = CommCareHqEnv(client, cache_results=cache_results)
+        users = env.api_data('user', RecordingCheckpointManager())
+        assert users
+        assert list(users) == [{'id': 1}, {'id': 2}]
+        assert list(users) == [{'id': 1}, {'id': 2}]
+        assert len(fetches) == expected_fetches
+
+
+class TestAdaptivePageSize:
+
+    def test_grows_when_fast(self):
+        page_size = AdaptivePaging(target_seconds=10).get_page_size(
+            'form', 100
+        )
+        page_size.record_page(1, 1000, 100)
+        # Limited to doubling per page
+        assert page_size.page_size == 200
+
+    def test_shrinks_when_slow(self):
+        page_size = AdaptivePaging(target_seconds=10).get_page_size(
+            'form', 1000
+        )
+        page_size.record_page(12.5, None, 1000)
+        assert page_size.page_size == 800
+
+    def test_shrinks_when_large(self):
+        paging = AdaptivePaging(target_seconds=10, target_bytes=1000)
+        page_size = paging.get_page_size('form', 100)
+        page_size.record_page(1, 4000, 100)
+        assert page_size.page_size == 50
+
+    def test_small_change_ignored(self):
+        page_size = AdaptivePaging(target_seconds=10).get_page_size(
+            'form', 100
+        )
+        page_size.record_page(9, None, 100)
+        assert page_size.page_size == 100
+
+    def test_bounds(self):
+        paging = AdaptivePaging(min_page_size=80, max_page_size=150)
+        assert paging.get_page_size('form', 1000).page_size == 150
+        page_size = paging.get_page_size('case', 100)
+        page_size.record_page(100, None, 100)
+        assert page_size.page_size == 80
+
+    def test_resources_are_separate(self):
+        paging = AdaptivePaging(target_seconds=10)
+        form_page_size = paging.get_page_size('form', 100)
+        case_page_size = paging.get_page_size('case', 100)
+        assert paging.get_page_size('form', 100) is form_page_size
+        form_page_size.record_page(1, None, 100)
+        assert form_page_size.page_size == 200
+        assert case_page_size.page_size == 100
+
+    def test_paginator_uses_page_size(self):
+        paging = AdaptivePaging(min_page_size=1, target_seconds=10)
+        paginator = get_paginator('case', 2, adaptive_paging=paging)
+        paginator.init()
+        assert paginator.next_page_params_since()['limit'] == 2
+        paginator.record_page(1, None, 2)
+        assert paginator.next_page_params_since()['limit'] == 4
+
+        paginator = get_paginator('user', 2, adaptive_paging=paging)
+        paginator.init()
+        paginator.record_page(1, None, 2)
+        batch = {'meta': {'next': '?limit=2&offset=2'}}
+        assert paginator.next_page_params_from_batch(batch) == {
+            'limit': ['4'],
+            'offset': ['2'],
+        }
+
+    def test_iterate(self):
+        client = CommCareHqClient(
+            '/fake/commcare-hq/url', 'fake-project', None, None
+        )
+        client.session = FakeIndexedOnSession()
+        env = CommCareHqEnv(
+            client,
+            page_size=2,
+            adaptive_paging=AdaptivePaging(min_page_size=1),
+        )
+        results = env.api_data('form', RecordingCheckpointManager())
+        assert [doc['id'] for doc in results] == [
+            doc['id'] for doc in INDEXED_ON_DOCS
+        ]
+        limits = [int(params['limit']) for params in client.session.requests]
+        assert limits[:3] == [2, 4, 8]
+
+
 def _check_case(val, result):
     if isinstance(result, list):
         assert [
@@ -1,8 +1,150 @@
 import doctest
 
+import pytest
+
 import commcare_export.env
+from commcare_export.env import (
+    BuiltInEnv,
+    CannotBind,
+    CompositeEnv,
+    DictEnv,
+    EmitterEnv,
+    JsonPathCache,
+    JsonPathEnv,
+    NotFound,
+)
+from commcare_export.minilinq import (
+    Apply,
+    List,
+    Literal,
+    Map,
+    Reference,
+    get_references,
+)
+from commcare_export.writers import JValueTableWriter
+from jsonpath_ng import jsonpath
 
 
 def test_doctests():
     results = doctest.testmod(commcare_export.env)
     assert results.failed == 0
+
+
+def test_jsonpath_cache():
+    cache = JsonPathCache(maxsize=2)
+    cache.get('a')
+    cache.get('b')
+    cache.get('a')
+    cache.get('c')
+    assert cache.stats() == {
+        'size': 2,
+        'maxsize': 2,
+        'hits': 1,
+        'misses': 3,
+        'evictions': 1,
+    }
+    # 'b' was the least recently used
+    cache.get('a')
+    cache.get('b')
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 4
+
+
+def test_jsonpath_cache_prewarm():
+    query = Map(
+        source=Reference('form.case.[*]'),
+        body=List([
+            Reference('id'),
+            Apply(Reference('str2num'), Reference('properties.age')),
+            Reference(Literal('computed')),
+        ]),
+    )
+    assert get_references(query) == {
+        'form.case.[*]', 'id', 'str2num', 'properties.age'
+    }
+    cache = JsonPathCache()
+    cache.prewarm(get_references(query) | {'=='})
+    assert cache.stats()['size'] == 4
+    cache.get('properties.age')
+    assert cache.stats()['hits'] == 1
+
+
+def _values(env, path):
+    return [datum.value for datum in env.lookup(path)]
+
+
+@pytest.mark.parametrize('path', ['a', 'b.c', 'd', '$', '$.a', '*', 'id'])
+def test_chained_bindings(path):
+    chained = JsonPathEnv({'a': 1, 'b': {'c': 2}}).bind('a', 3).bind('d', 4)
+    copied = JsonPathEnv({'a': 3, 'b': {'c': 2}, 'd': 4})
+    assert _values(chained, path) == _values(copied, path)
+
+
+def test_chained_bindings_scope():
+    env = JsonPathEnv({'a': 1})
+    env.bind('a', 2)
+    assert _values(env, 'a') == [1]
+
+    restricted = env.bind('__root_only', True).bind('b', 3)
+    assert _values(restricted, 'a') == []
+    assert _values(restricted, '$.b') == [3]
+
+    dict_env = DictEnv({'a': 1}).bind('b', 2).bind('a', 3)
+    assert dict_env.lookup('a') == 3
+    assert dict_env.lookup('b') == 2
+
+
+def test_composite_env():
+    builtin_env = BuiltInEnv({'a': 1})
+    static_env = builtin_env | DictEnv({'b': 2})
+    env = static_env | JsonPathEnv({'a': 3, 'c': 4}) | EmitterEnv(
+        JValueTableWriter()
+    )
+    assert isinstance(env, CompositeEnv)
+    assert len(env.envs) == 4
+    assert env.lookup('a') == 1
+    assert env.lookup('b') == 2
+    assert _values(env, 'c') == [4]
+    skipped = env.lookup_skipping(static_env, 'a')
+    assert [datum.value for datum in skipped] == [3]
+    with pytest.raises(NotFound):
+        env.lookup(1)
+
+    # The DictEnv binds and replaces with dicts, before the JsonPathEnv
+    bound = env.bind('c', 5)
+    assert bound.lookup('c') == 5
+    assert _values(env, 'c') == [4]
+    replaced = env.replace([{'c': 6}])
+    assert _values(replaced, '[0].c') == [6]
+    assert replaced.lookup('b') == 2
+
+
+def test_composite_env_bind():
+    static_env = BuiltInEnv()
+    env = static_env | JsonPathEnv({})
+    bound = env.bind('x', 1).bind('y', 2)
+    assert _values(bound, 'x') == [1]
+    skipped = bound.lookup_skipping(static_env, 'y')
+    assert [datum.value for datum in skipped] == [2]
+    assert bound.lookup('str2num')('1') == 1
+    with pytest.raises(CannotBind):
+        (static_env | EmitterEnv(JValueTableWriter())).bind('x', 1)
+
+
+@pytest.mark.parametrize('env, restricted', [
+    (JsonPathEnv({'__root_only': True}), True),
+    (JsonPathEnv({'__root_only': False}), True),
+    (JsonPathEnv({'a': 1}), False),
+    (JsonPathEnv({'a': 1}).bind('__root_only', True), True),
+    (JsonPathEnv({'a': 1}).bind({'__root_only': True}), True),
+    (JsonPathEnv({'__root_only': True}).bind('b', 2), True),
+    (JsonPathEnv({'__root_only': True}).replace({'a': 1}), False),
+    (
+        JsonPathEnv({}).replace(
+            jsonpath.DatumInContext({'__root_only': True, 'a': 1})
+        ),
+        True,
+    ),
+])
+def test_root_only(env, restricted):
+    assert _values(env, 'a') == ([] if restricted else [1])
@@ -0,0 +1,140 @@
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+from commcare_export.checkpoint import CheckpointManagerWithDetails
+from commcare_export.commcare_hq_client import (
+    AUTH_MODE_APIKEY,
+    CommCareHqClient,
+)
+from commcare_export.commcare_minilinq import (
+    CommCareHqEnv,
+    PaginationMode,
+    get_paginator,
+)
+from commcare_export.location_info_provider import LocationInfoProvider
+from tests.hq_server import HqApiStub
+
+
+class RecordingCheckpointManager(CheckpointManagerWithDetails):
+
+    def __init__(self, pagination_mode=PaginationMode.date_indexed):
+        super().__init__(None, None, pagination_mode)
+        self.checkpoints = []
+
+    def set_checkpoint(
+        self, checkpoint_time, is_final=False, doc_id=None, cursor=None
+    ):
+        self.checkpoints.append((checkpoint_time, is_final, doc_id, cursor))
+
+
+@pytest.fixture
+def stub():
+    with HqApiStub(num_docs=25, doc_size=200) as stub:
+        yield stub
+
+
+def _get_client(stub, **kwargs):
+    return CommCareHqClient(
+        stub.url, stub.project, 'user', 'key', AUTH_MODE_APIKEY, **kwargs
+    )
+
+
+def _ids(stub, resource):
+    return [doc['id'] for doc in stub.get_documents(resource)]
+
+
+@pytest.mark.parametrize('resource', ['form', 'case', 'messaging-event'])
+def test_date_indexed(stub, resource):
+    checkpoint_manager = RecordingCheckpointManager()
+    env = CommCareHqEnv(_get_client(stub), page_size=10)
+    results = env.api_data(resource, checkpoint_manager)
+    assert [doc['id'] for doc in results] == _ids(stub, resource)
+    assert checkpoint_manager.checkpoints[-1] == (
+        datetime(2024, 1, 1, 0, 24), True, f'{resource}-24', None
+    )
+
+
+@pytest.mark.parametrize('client_options', [
+    {'prefetch_pages': 2},
+    {'stream_pages': True},
+])
+def test_client_options(stub, client_options):
+    env = CommCareHqEnv(_get_client(stub, **client_options), page_size=7)
+    results = env.api_data('form', RecordingCheckpointManager())
+    assert [doc['id'] for doc in results] == _ids(stub, 'form')
+
+
+def test_shards(stub):
+    env = CommCareHqEnv(
+        _get_client(stub), page_size=4, until=datetime(2024, 1, 2), shards=3
+    )
+    results = env.api_data('case', RecordingCheckpointManager())
+    assert [doc['id'] for doc in results] == _ids(stub, 'case')
+
+
+def test_offset_pagination(stub):
+    env = CommCareHqEnv(_get_client(stub), page_size=10)
+    results = env.api_data('user', RecordingCheckpointManager())
+    assert [doc['id'] for doc in results] == _ids(stub, 'user')
+    assert [params.get('offset') for _, params in stub.requests] == [
+        None, '10', '20'
+    ]
+
+
+def test_cursor_pagination(stub):
+    checkpoint_manager = RecordingCheckpointManager(PaginationMode.cursor)
+    env = CommCareHqEnv(_get_client(stub), page_size=10)
+    results = env.api_data('ucr', checkpoint_manager, {'id': 'report'})
+    assert [doc['id'] for doc in results] == _ids(stub, 'ucr')
+    assert len(stub.requests) == 4
+    assert all(
+        params['id'] == 'report' for _, params in stub.requests
+    )
+
+
+def test_locations(stub):
+    provider = LocationInfoProvider(_get_client(stub), page_size=10)
+    assert provider.get_location_info(
+        '/api/v0.5/location_type/3/', 'code'
+    ) == 'type3'
+
+
+def test_locations_fetched_once(stub):
+    provider = LocationInfoProvider(_get_client(stub), page_size=10)
+    provider.fetch()
+    num_responses = len(stub.responses)
+    assert provider.get_location_info(
+        '/api/v0.5/location_type/3/', 'code'
+    ) == 'type3'
+    provider.get_location_ancestor('/api/v0.5/location/1/', 'type1')
+    assert len(stub.responses) == num_responses
+
+
+@patch('backoff._sync.time.sleep')
+def test_retries(sleep_mock):
+    with HqApiStub(
+        num_docs=50,
+        too_many_requests_rate=0.3,
+        retry_after=0,
+        error_rate=0.3,
+    ) as stub:
+        env = CommCareHqEnv(_get_client(stub), page_size=5)
+        results = env.api_data('form', RecordingCheckpointManager())
+        assert [doc['id'] for doc in results] == _ids(stub, 'form')
+    assert 429 in stub.responses
+    assert 500 in stub.responses
+
+
+def test_paginator_params(stub):
+    paginator = get_paginator('form', 10)
+    paginator.init()
+    page = _get_client(stub).get(
+        'form', paginator.next_page_params_since(datetime(2024, 1, 1, 0, 20))
+    )
+    assert [doc['id'] for doc in page['objects']] == [
+        f'form-{i}' for i in range(20, 25)
+    ]
+    assert page['meta']['next'] is None
+    assert page['meta']['total_count'] == 5
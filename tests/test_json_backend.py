@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from commcare_export import json_backend
+
+DOCUMENT = {
+    'meta': {'limit': 2, 'next': None, 'total_count': 2},
+    'objects': [
+        {'id': 'a', 'form': {'name': 'Miércoles', 'n': 1.5, 'ok': True}},
+        {'id': 'b', 'form': {'list': [1, None, -2e10]}},
+    ],
+}
+
+
+@pytest.fixture(params=[
+    backend.name for backend in json_backend.get_available_backends()
+])
+def backend(request):
+    previous = json_backend.get_backend().name
+    json_backend.set_backend(request.param)
+    yield json_backend.get_backend()
+    json_backend.set_backend(previous)
+
+
+def test_loads(backend):
+    data = json.dumps(DOCUMENT)
+    assert json_backend.loads(data) == DOCUMENT
+    assert json_backend.loads(data.encode('utf-8')) == DOCUMENT
+
+
+def test_loads_large_integer(backend):
+    assert json_backend.loads('[123456789012345678901234567890]') == [
+        123456789012345678901234567890
+    ]
+    assert json_backend.loads('{"n": -18446744073709551616}') == {
+        'n': -18446744073709551616
+    }
+    assert json_backend.loads('18446744073709551616') == 18446744073709551616
+
+
+def test_orjson_long_digits_in_string():
+    try:
+        backend = json_backend.OrjsonBackend()
+    except ImportError:
+        pytest.skip('orjson is not installed')
+    data = json.dumps({'id': '12345678901234567890', 'n': 1}).encode()
+    assert not backend._has_long_integer(data)
+    assert backend.loads(data) == {'id': '12345678901234567890', 'n': 1}
+    assert backend._has_long_integer(b'{"n": 12345678901234567890}')
+
+
+def test_loads_infinity(backend):
+    assert json_backend.loads('[Infinity]') == [float('inf')]
+
+
+def test_dumps(backend):
+    assert json_backend.dumps(DOCUMENT, indent=4) == json.dumps(
+        DOCUMENT, indent=4
+    )
+
+
+def test_dumps_compact(backend):
+    assert json.loads(json_backend.dumps(DOCUMENT)) == DOCUMENT
+
+
+def test_fallback():
+    assert json_backend.get_available_backends()[-1].name == 'json'
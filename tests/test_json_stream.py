@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from commcare_export.json_stream import StreamedPage
+
+
+def _chunks(data, size):
+    encoded = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    return [encoded[i:i + size] for i in range(0, len(encoded), size)]
+
+
+PAGE = {
+    'meta': {'limit': 3, 'next': '?cursor=abc', 'total_count': 12345},
+    'objects': [
+        {'id': 1, 'value': 1234567890, 'text': 'Miércoles'},
+        {'id': 2, 'nested': {'list': [1.5, -2e10, None, True]}},
+        {'id': 3, 'text': '{"not": ["json"]}', 'emoji': '\U0001F600'},
+    ],
+}
+
+
+class TestStreamedPage:
+
+    @pytest.mark.parametrize('chunk_size', [1, 2, 7, 64, 100000])
+    def test_decode(self, chunk_size):
+        page = StreamedPage(_chunks(PAGE, chunk_size))
+        assert page.meta == PAGE['meta']
+        assert list(page.objects()) == PAGE['objects']
+
+    @pytest.mark.parametrize('chunk_size', [1, 5, 100000])
+    def test_objects_before_meta(self, chunk_size):
+        data = {'objects': PAGE['objects'], 'meta': PAGE['meta']}
+        page = StreamedPage(_chunks(data, chunk_size))
+        assert page.meta == PAGE['meta']
+        assert list(page.objects()) == PAGE['objects']
+
+    def test_objects_without_reading_meta(self):
+        page = StreamedPage(_chunks(PAGE, 3))
+        assert list(page.objects()) == PAGE['objects']
+        assert page.meta == PAGE['meta']
+
+    def test_empty_objects(self):
+        page = StreamedPage(_chunks({'meta': {'next': None}, 'objects': []}, 4))
+        assert page.meta == {'next': None}
+        assert list(page.objects()) == []
+
+    def test_number_split_across_chunks(self):
+        page = StreamedPage([b'{"meta": {"limit": 12', b'34}, "objects": []}'])
+        assert page.meta == {'limit': 1234}
+
+    def test_objects_are_decoded_lazily(self):
+
+        def chunks():
+            yield b'{"meta": {}, "objects": [{"id": 1}, '
+            raise AssertionError('Read too far')
+
+        objects = StreamedPage(chunks()).objects()
+        assert next(objects) == {'id': 1}
+
+    def test_invalid(self):
+        page = StreamedPage([b'{"meta": {}, "objects": [{"id": 1} {"id": 2}]}'])
+        with pytest.raises(ValueError):
+            list(page.objects())
+
+    def test_close(self):
+        closed = []
+        with StreamedPage(_chunks(PAGE, 10), close=lambda: closed.append(1)):
+            pass
+        assert closed == [1]
@@ -0,0 +1,71 @@
+import pytest
+
+from commcare_export.env import JsonPathEnv
+from commcare_export.jsonpath_utils import compile_find
+from jsonpath_ng import jsonpath
+from jsonpath_ng.parser import parse as parse_jsonpath
+
+DOC = {
+    'id': 'form-1',
+    'form': {
+        'meta': {'userID': 'user-1'},
+        'case': [{'@case_id': 'case-1', 'name': 'a'}, {'name': 'b'}],
+        'a b': 1,
+        'empty': None,
+    },
+}
+
+
+@pytest.mark.parametrize('path', [
+    'form.meta.userID',
+    'form.meta',
+    '$.form.meta.userID',
+    '`this`.form.meta',
+    'form."a b"',
+    'form.case[0].name',
+    'form.case[1]',
+    'form.case[2]',
+    'form.missing.userID',
+    'form.empty.x',
+    'form.meta.userID.x',
+])
+def test_compile_find(path):
+    JsonPathEnv()  # Sets the auto id field
+    jsonpath_expr = parse_jsonpath(path)
+    find = compile_find(jsonpath_expr)
+    assert find is not None
+    assert find(DOC) == jsonpath_expr.find(DOC)
+    datum = jsonpath.DatumInContext(
+        DOC, path=jsonpath.Fields('docs'), context={'docs': DOC}
+    )
+    assert find(datum) == jsonpath_expr.find(datum)
+    for found, expected in zip(find(datum), jsonpath_expr.find(datum)):
+        assert str(found.full_path) == str(expected.full_path)
+
+
+@pytest.mark.parametrize('path', [
+    'form.*',
+    'form.case[*]',
+    'form..name',
+    'form.meta.id',
+    'id',
+    'form.case[0:1]',
+    '$',
+    '`this`',
+])
+def test_compile_find_unsupported(path):
+    JsonPathEnv()
+    assert compile_find(parse_jsonpath(path)) is None
+
+
+def test_auto_ids():
+    def get_case_id(path):
+        env = JsonPathEnv({'form': {'case': {'name': 'a'}}})
+        [case] = env.lookup(path)
+        [case_id] = env.replace(case).lookup('id')
+        return case_id.value
+
+    # A parsed expression is looked up without the quicker ``find``
+    assert get_case_id('form.case') == get_case_id(
+        parse_jsonpath('form.case')
+    )
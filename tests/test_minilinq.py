@@ -7,12 +7,14 @@ from commcare_export.env import BuiltInEnv, DictEnv, EmitterEnv, JsonPathEnv
 from commcare_export.excel_query import get_value_or_root_expression
 from commcare_export.minilinq import (
     Apply,
+    Bind,
     Emit,
     Filter,
     FlatMap,
     List,
     Literal,
     Map,
+    Memo,
     MiniLinq,
     Reference,
 )
@@ -429,6 +431,14 @@ class TestMiniLinq:
             Reference('b')
         ).eval(env) == '1.2'
 
+    def test_equals(self):
+        env = BuiltInEnv() | JsonPathEnv({'a': '1', 'b': '2'})
+        assert Apply(Reference('=='), Reference('a'), Literal('1')).eval(env)
+        assert not Apply(
+            Reference('=='), Reference('a'), Reference('b')
+        ).eval(env)
+        assert Apply(Reference('!='), Reference('a'), Reference('b')).eval(env)
+
     def test_substr(self):
         env = BuiltInEnv({
             'single_byte_chars': u'abcdefghijklmnopqrstuvwxyz',
@@ -765,6 +775,37 @@ class TestMiniLinq:
             "Ref": "form.log_subreport"
         }]) == [Reference("form.log_subreport")]
 
+    def test_hash(self):
+        def make_query(filters):
+            return Bind(
+                'checkpoint_manager',
+                Literal(None),
+                Emit(
+                    table='t',
+                    headings=[Literal('id')],
+                    source=Map(
+                        source=Apply(
+                            Reference('api_data'), Literal('form'),
+                            Reference('checkpoint_manager'), Literal(filters)
+                        ),
+                        body=List([Reference('id')]),
+                    ),
+                    data_types=[Literal('text')],
+                ),
+            )
+
+        query = make_query({'app_id': ['a'], 'xmlns': ['x']})
+        same = make_query({'xmlns': ['x'], 'app_id': ['a']})
+        other = make_query({'app_id': ['b']})
+        assert query == same
+        assert hash(query) == hash(same)
+        assert {query: 1, other: 2}[same] == 1
+
+        # The hash is cached, and nodes have no per-instance ``__dict__``
+        assert query._hash == hash(query)
+        assert not hasattr(query, '__dict__')
+        assert not hasattr(query.body.source, '__dict__')
+
     def test_filter(self):
         env = BuiltInEnv() | DictEnv({})
         named = [{'n': n} for n in range(1, 5)]
@@ -816,3 +857,168 @@ class TestMiniLinq:
         )
 
         writer.tables['t1'].rows = [['hi'], ['test_text'], [''], [{'t': 123}]]
+
+
+class CountingBuiltInEnv(BuiltInEnv):
+
+    def __init__(self, d=None):
+        super().__init__(d)
+        self.lookups = []
+
+    def lookup(self, name):
+        self.lookups.append(name)
+        return super().lookup(name)
+
+
+class TestCompile:
+
+    docs = [
+        {'id': 'a', 'n': 1, 'name': 'x', 'tags': [{'t': 'p'}, {'t': 'q'}]},
+        {'id': 'b', 'n': 3, 'name': 'y', 'tags': []},
+        {'id': 'c', 'n': 5, 'tags': [{'t': 'r'}]},
+    ]
+
+    @pytest.mark.parametrize('query', [
+        Literal(1),
+        Reference('docs'),
+        Reference(Literal('docs')),
+        Map(
+            source=Reference('docs.[*]'),
+            body=List([
+                Reference('id'),
+                Apply(Reference('str2num'), Reference('n')),
+                Apply(Reference('default'), Reference('name'), Literal('-')),
+            ]),
+        ),
+        Map(
+            source=Reference('docs.[*]'),
+            name='doc',
+            body=Apply(Reference('str2num'), Reference('doc.n')),
+        ),
+        FlatMap(source=Reference('docs.[*]'), body=Reference('tags.[*]')),
+        FlatMap(
+            source=Reference('docs.[*]'),
+            name='doc',
+            body=Reference('doc.tags.[*].t'),
+        ),
+        Filter(
+            source=Reference('docs.[*]'),
+            predicate=Apply(Reference('bool'), Reference('tags.[*]')),
+        ),
+        Filter(
+            source=Reference('docs.[*]'),
+            name='doc',
+            predicate=Apply(Reference('bool'), Reference('doc.name')),
+        ),
+        Bind(
+            'first',
+            Literal({'n': 7}),
+            Apply(Reference('str2num'), Reference('first.n')),
+        ),
+    ])
+    def test_matches_eval(self, query):
+        def get_env():
+            return BuiltInEnv() | JsonPathEnv({'docs': self.docs})
+
+        expected = query.eval(get_env())
+        result = query.compile(BuiltInEnv())(get_env())
+        if isinstance(expected, RepeatableIterator):
+            assert isinstance(result, RepeatableIterator)
+            expected = [unwrap_val(v) for v in expected]
+            result = [unwrap_val(v) for v in result]
+        else:
+            expected = unwrap_val(expected)
+            result = unwrap_val(result)
+        assert result == expected
+
+    def test_static_names_resolved_once(self):
+        builtin_env = CountingBuiltInEnv()
+        env = builtin_env | JsonPathEnv({'docs': self.docs})
+        query = Map(
+            source=Reference('docs.[*]'),
+            body=Apply(Reference('str2num'), Reference('n')),
+        )
+        compiled = query.compile(builtin_env)
+        assert builtin_env.lookups == ['docs.[*]', 'str2num', 'n']
+
+        assert list(compiled(env)) == [1, 3, 5]
+        # Names that are not built in are not looked up in the built-in
+        # environment again
+        assert builtin_env.lookups == ['docs.[*]', 'str2num', 'n']
+
+    def test_emit(self):
+        writers = []
+        for compile_query in [False, True]:
+            writer = JValueTableWriter()
+            env = BuiltInEnv() | JsonPathEnv({}) | EmitterEnv(writer)
+            query = Emit(
+                table='t',
+                headings=[Literal('id'), Literal('tags')],
+                source=Map(
+                    source=Literal(self.docs),
+                    body=List([Reference('id'), Reference('tags.[*].t')]),
+                ),
+                missing_value='---',
+            )
+            if compile_query:
+                query.compile(BuiltInEnv())(env)
+            else:
+                query.eval(env)
+            writers.append(writer)
+        assert writers[0].tables['t'].rows == writers[1].tables['t'].rows
+        assert writers[1].tables['t'].rows == [
+            ['a', 'p,q'], ['b', '---'], ['c', 'r']
+        ]
+
+    def test_error_message(self):
+        query = Map(
+            source=Literal(self.docs),
+            body=Apply(Reference('+'), Literal('n'), Literal(1)),
+        )
+        messages = []
+        for compiled in [False, True]:
+            env = BuiltInEnv() | JsonPathEnv({})
+            with pytest.raises(Exception) as exc_info:
+                if compiled:
+                    list(query.compile(BuiltInEnv())(env))
+                else:
+                    list(query.eval(env))
+            messages.append(str(exc_info.value))
+        assert messages[0] == messages[1]
+        assert "Error processing document 'a'" in messages[1]
+
+    @pytest.mark.parametrize('batch_size', [1, 2, 1000])
+    def test_batched_map(self, batch_size):
+        counted = Memo(Apply(Reference('str2num'), Reference('doc.n')))
+        query = Map(
+            source=Literal(self.docs),
+            name='doc',
+            body=List([
+                Reference('doc.id'),
+                Literal('x'),
+                counted,
+                Apply(Reference('+'), counted, Literal(1)),
+                List([]),
+                Reference(Literal('doc.name')),
+            ]),
+        )
+        env = BuiltInEnv() | JsonPathEnv({'docs': self.docs})
+        expected = [
+            [unwrap_val(v) for v in row]
+            for row in query.compile(BuiltInEnv())(env)
+        ]
+        compiled = query.compile_batched(BuiltInEnv(), batch_size)
+        assert [
+            [unwrap_val(v) for v in row] for row in compiled(env)
+        ] == expected
+        assert expected[0] == ['a', 'x', 1, 2, [], 'x']
+
+    def test_batched_error_message(self):
+        query = Map(
+            source=Literal(self.docs),
+            body=List([Apply(Reference('+'), Literal('n'), Literal(1))]),
+        )
+        env = BuiltInEnv() | JsonPathEnv({})
+        with pytest.raises(Exception) as exc_info:
+            list(query.compile_batched(BuiltInEnv())(env))
+        assert "Error processing document 'a'" in str(exc_info.value)
@@ -2,6 +2,7 @@ import doctest
 import hashlib
 import struct
 import tempfile
+import threading
 
 import pytest
 from jsonpath_ng import jsonpath
@@ -168,3 +169,28 @@ class TestUnwrap:
 def test_doctests():
     results = doctest.testmod(misc)
     assert results.failed == 0
+
+
+def test_spilling_background_iterator():
+    finished = threading.Event()
+
+    def produce():
+        yield from ({'n': n} for n in range(100))
+        finished.set()
+
+    iterator = misc.SpillingBackgroundIterator(produce(), 10)
+    # The producer does not wait for the consumer
+    assert finished.wait(timeout=5)
+    assert list(iterator) == [{'n': n} for n in range(100)]
+
+
+def test_spilling_background_iterator_error():
+
+    def produce():
+        yield 1
+        raise ValueError('boom')
+
+    iterator = misc.SpillingBackgroundIterator(produce(), 10)
+    assert next(iterator) == 1
+    with pytest.raises(ValueError):
+        next(iterator)
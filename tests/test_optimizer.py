@@ -0,0 +1,256 @@
+import openpyxl
+import pytest
+
+from commcare_export.cli import force_lazy_result
+from commcare_export.env import BuiltInEnv, EmitterEnv, JsonPathEnv
+from commcare_export.excel_query import get_queries_from_excel
+from commcare_export.minilinq import (
+    Apply,
+    Bind,
+    Filter,
+    List,
+    Literal,
+    Map,
+    Memo,
+    Reference,
+)
+from commcare_export.misc import unwrap_val
+from commcare_export.optimizer import optimize
+from commcare_export.writers import JValueTableWriter
+
+
+def test_builtin_reference():
+    assert optimize(Reference('str2num')) == Literal(BuiltInEnv().lookup(
+        'str2num'
+    ))
+    assert optimize(Reference('form.str2num')) == Reference('form.str2num')
+    assert optimize(Reference('api_data')) == Reference('api_data')
+
+
+def test_constant_folding():
+    query = Apply(
+        Reference('template'),
+        Literal('{}-{}'),
+        Apply(Reference('+'), Literal(1), Literal(2)),
+        Literal('x'),
+    )
+    assert optimize(query) == Literal('3-x')
+
+
+def test_no_folding_of_references():
+    query = Apply(Reference('str2num'), Reference('form.age'))
+    optimized = optimize(query)
+    assert optimized == Apply(
+        Literal(BuiltInEnv().lookup('str2num')), Reference('form.age')
+    )
+    assert query == Apply(Reference('str2num'), Reference('form.age'))
+
+
+def test_no_folding_of_errors():
+    query = Apply(Reference('/'), Literal(1), Literal(0))
+    assert isinstance(optimize(query), Apply)
+
+
+def test_no_folding_of_impure_functions():
+    # form_url depends on commcarehq_base_url
+    query = Apply(Reference('form_url'), Literal('abc'))
+    assert isinstance(optimize(query), Apply)
+
+
+@pytest.mark.parametrize('body, removed', [
+    (Reference('form.id'), True),
+    (Reference('id'), True),
+    (Reference('checkpoint.id'), False),
+    (Reference('$'), False),
+    (Reference('`this`.checkpoint'), False),
+    (Reference('*'), False),
+    (Reference(Literal('checkpoint')), False),
+    (Apply(Reference('len'), Reference('checkpoint')), False),
+])
+def test_unused_bind(body, removed):
+    query = Bind('checkpoint', Literal({'id': 1}), body)
+    expected = body if removed else query
+    assert optimize(query) == optimize(expected)
+
+
+def test_root_only_bind_is_kept():
+    query = Bind('__root_only', Literal(True), Reference('$'))
+    assert optimize(query) == query
+
+
+def test_map_over_this_is_kept():
+    # `this` may be a list, which ``Map`` iterates over
+    query = Map(source=Reference('`this`'), body=List([Reference('id')]))
+    assert optimize(query) == query
+
+
+def test_url_builtins():
+    query = Apply(Reference('form_url'), Reference('id'))
+    optimized = optimize(query)
+    assert isinstance(optimized, Apply)
+    assert optimized.args[-1] == Reference('$.id')
+
+
+def test_common_subexpressions():
+    calls = []
+
+    def count(value):
+        calls.append(value)
+        return value
+
+    counted = Apply(Literal(count), Reference('n'))
+    query = Map(
+        source=Reference('docs.[*]'),
+        body=List([
+            counted,
+            Apply(Reference('str2num'), counted),
+            Reference('n'),
+            Map(source=Reference('items.[*]'), body=List([counted, counted])),
+        ]),
+    )
+    optimized = optimize(query)
+    first, second, _, inner = optimized.body.items
+    assert isinstance(first, Memo)
+    assert second.args[0] is first
+    inner_first, inner_second = inner.body.items
+    assert inner_first is inner_second
+    assert inner_first is not first
+
+    docs = [{'n': '1', 'items': []}, {'n': '2', 'items': []}]
+    env = BuiltInEnv() | JsonPathEnv({'docs': docs})
+    result = [
+        [unwrap_val(value) for value in row[:3]]
+        for row in optimized.eval(env)
+    ]
+    assert result == [['1', 1, '1'], ['2', 2, '2']]
+    assert len(calls) == 2
+
+    del calls[:]
+    list(optimized.compile(BuiltInEnv())(env))
+    assert len(calls) == 2
+
+
+def _api_data(*args):
+    return Apply(
+        Reference('api_data'), Literal('form'),
+        Reference('checkpoint_manager'), *args
+    )
+
+
+@pytest.mark.parametrize('source, predicate, name, expected', [
+    (
+        _api_data(),
+        Apply(Reference('=='), Reference('xmlns'), Literal('http://x')),
+        None,
+        _api_data(Literal({'xmlns.exact': ['http://x']})),
+    ),
+    (
+        _api_data(Literal({'app_id': ['a']}), Literal(['cases'])),
+        Apply(Reference('=='), Literal('http://x'), Reference('form.@xmlns')),
+        None,
+        _api_data(
+            Literal({'app_id': ['a'], 'xmlns.exact': ['http://x']}),
+            Literal(['cases']),
+        ),
+    ),
+    (
+        _api_data(Literal(None)),
+        Apply(Reference('=='), Reference('form.app_id'), Literal('a')),
+        'form',
+        _api_data(Literal({'app_id': ['a']})),
+    ),
+    (
+        _api_data(Literal({'app_id': ['a', 'b']})),
+        Apply(Reference('=='), Reference('app_id'), Literal('b')),
+        None,
+        _api_data(Literal({'app_id': ['b']})),
+    ),
+])
+def test_filter_push_down(source, predicate, name, expected):
+    query = Filter(source=source, predicate=predicate, name=name)
+    optimized = optimize(query)
+    assert optimized.source == optimize(expected)
+    assert optimized.predicate == optimize(predicate)
+
+
+@pytest.mark.parametrize('source, predicate', [
+    (
+        _api_data(Literal({'app_id': ['a']})),
+        Apply(Reference('=='), Reference('app_id'), Literal('b')),
+    ),
+    (_api_data(), Apply(Reference('!='), Reference('app_id'), Literal('b'))),
+    (_api_data(), Apply(Reference('=='), Reference('id'), Literal('b'))),
+    (
+        _api_data(),
+        Apply(Reference('=='), Reference('app_id'), Reference('other')),
+    ),
+    (
+        Reference('forms'),
+        Apply(Reference('=='), Reference('app_id'), Literal('b')),
+    ),
+])
+def test_no_filter_push_down(source, predicate):
+    query = Filter(source=source, predicate=predicate)
+    assert optimize(query).source == optimize(source)
+
+
+def test_filter_push_down_results():
+    docs = [
+        {'id': 'a', 'xmlns': 'http://x'},
+        {'id': 'b', 'xmlns': 'http://y'},
+    ]
+    payloads = []
+
+    def api_data(resource, checkpoint_manager, payload=None):
+        payloads.append(payload)
+        return docs
+
+    query = Map(
+        source=Filter(
+            source=_api_data(),
+            predicate=Apply(
+                Reference('=='), Reference('xmlns'), Literal('http://x')
+            ),
+        ),
+        body=Reference('id'),
+    )
+    env = BuiltInEnv({
+        'api_data': api_data, 'checkpoint_manager': None
+    }) | JsonPathEnv({})
+    assert [unwrap_val(id_) for id_ in optimize(query).eval(env)] == ['a']
+    assert payloads == [{'xmlns.exact': ['http://x']}]
+
+
+def _run(query, docs):
+    writer = JValueTableWriter()
+    env = (
+        BuiltInEnv({
+            'api_data': lambda *args: docs,
+            'get_checkpoint_manager': lambda *args: None,
+        })
+        | JsonPathEnv({})
+        | EmitterEnv(writer)
+    )
+    with env:
+        force_lazy_result(query.eval(env))
+    return {
+        name: list(table.rows) for name, table in writer.tables.items()
+    }
+
+
+def test_excel_query_results():
+    workbook = openpyxl.load_workbook('tests/008_multiple-tables.xlsx')
+    query = get_queries_from_excel(workbook, combine_emits=True)
+    docs = [{
+        'id': f'form-{i}',
+        'form': {
+            'name': f'Name {i}',
+            'case': [{'@case_id': f'case-{i}-{j}'} for j in range(i)],
+        },
+    } for i in range(3)]
+
+    optimized = optimize(query)
+    assert optimized != query
+    expected = _run(query, docs)
+    assert expected['Cases']
+    assert _run(optimized, docs) == expected
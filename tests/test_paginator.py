@@ -28,3 +28,25 @@ def test_ucr_paginator_page_size():
         checkpoint_manager.since_param
     )
     assert initial_params["limit"] == 1
+
+
+def test_paginator_params_do_not_change_payload():
+    # With prefetching, the params of the next page are made in another
+    # thread than the one that sets checkpoints from the payload
+    paginator = get_paginator(
+        resource='ucr', pagination_mode=PaginationMode.cursor
+    )
+    paginator.init({'format': 'json'})
+    params = paginator.next_page_params_since('abc')
+    assert params['cursor'] == 'abc'
+    assert paginator.payload == {'format': 'json'}
+
+    paginator = get_paginator(
+        resource='form', pagination_mode=PaginationMode.date_indexed
+    )
+    paginator.init({'app_id': ['a']})
+    paginator.next_page_params_from_batch({
+        'objects': [{'indexed_on': '2026-01-01T00:00:00'}],
+        'meta': {'next': '?offset=1'},
+    })
+    assert paginator.payload == {'app_id': ['a']}
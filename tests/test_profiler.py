@@ -0,0 +1,104 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from commcare_export.env import BuiltInEnv, EmitterEnv, JsonPathEnv
+from commcare_export.minilinq import (
+    Apply,
+    Emit,
+    Filter,
+    List,
+    Literal,
+    Map,
+    Reference,
+)
+from commcare_export.profiler import profile_query
+from commcare_export.writers import JValueTableWriter
+
+DOCS = [{'id': str(i), 'n': str(i)} for i in range(5)]
+
+QUERY = Emit(
+    table='t',
+    headings=[Literal('id'), Literal('n')],
+    source=Map(
+        source=Filter(
+            source=Reference('docs.[*]'),
+            predicate=Apply(
+                Reference('>'),
+                Apply(Reference('str2num'), Reference('n')),
+                Literal(1),
+            ),
+        ),
+        body=List([
+            Reference('id'),
+            Apply(Reference('str2num'), Reference('n')),
+        ]),
+    ),
+)
+
+
+def _run(query, compiled):
+    writer = JValueTableWriter()
+    env = BuiltInEnv() | JsonPathEnv({'docs': DOCS}) | EmitterEnv(writer)
+    with env:
+        if compiled:
+            query.compile(BuiltInEnv())(env)
+        else:
+            query.eval(env)
+    return writer.tables['t'].rows
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_profile(compiled):
+    profiled, profile = profile_query(QUERY)
+    assert _run(profiled, compiled) == _run(QUERY, compiled)
+
+    [emit] = profile.roots
+    assert emit.label == "Emit 't'"
+    assert emit.calls == 1
+    [map_] = emit.children
+    assert map_.calls == 1
+    assert map_.rows_in == 3
+    assert map_.rows_out == 3
+    filter_, ref_id, str2num = map_.children
+    assert filter_.rows_in == 5
+    assert filter_.rows_out == 3
+    assert ref_id.label == 'Ref id'
+    assert ref_id.calls == 3
+    assert str2num.label == 'Apply str2num'
+    assert str2num.calls == 3
+    [_, predicate] = filter_.children
+    assert predicate.calls == 5
+
+    assert emit.total >= map_.total >= filter_.total
+    assert emit.self_time >= 0
+    assert emit.self_time <= emit.total
+
+
+def test_profile_compiled_in_batches():
+    expected = _run(QUERY, compiled=True)
+    profiled, profile = profile_query(QUERY)
+    with patch.object(
+        Map, 'compile_batched', autospec=True,
+        side_effect=Map.compile_batched,
+    ) as compile_batched:
+        assert _run(profiled, compiled=True) == expected
+    compile_batched.assert_called_once()
+    [emit] = profile.roots
+    [map_] = emit.children
+    assert map_.rows_out == 3
+    _, ref_id, str2num = map_.children
+    assert ref_id.calls == 3
+    assert str2num.calls == 3
+
+
+def test_format():
+    profiled, profile = profile_query(QUERY)
+    _run(profiled, compiled=True)
+    lines = profile.format().splitlines()
+    assert lines[0].startswith("Emit 't'  calls=1  total=")
+    assert lines[1].startswith('  Map  calls=1')
+    assert lines[1].endswith('rows_in=3  rows_out=3')
+    jvalue = json.loads(json.dumps(profile.to_jvalue()))
+    assert jvalue[0]['children'][0]['rows_out'] == 3
@@ -0,0 +1,86 @@
+import pytest
+
+from commcare_export import rate_limit
+from commcare_export.rate_limit import TokenBucket, get_shared_token_bucket
+
+
+class FakeTime:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(rate_limit, 'time', fake)
+    return fake
+
+
+class TestTokenBucket:
+
+    def test_burst(self, fake_time):
+        bucket = TokenBucket(2, burst=3)
+        assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+        assert bucket.acquire() == pytest.approx(0.5)
+        assert bucket.acquire() == pytest.approx(0.5)
+
+    def test_refills(self, fake_time):
+        bucket = TokenBucket(2, burst=2)
+        bucket.acquire()
+        bucket.acquire()
+        fake_time.now += 10
+        # Never more tokens than the burst size
+        assert [bucket.acquire() for _ in range(2)] == [0, 0]
+        assert bucket.acquire() == pytest.approx(0.5)
+
+    def test_penalize(self, fake_time):
+        bucket = TokenBucket(10, burst=10)
+        bucket.penalize(5)
+        assert bucket.rate == pytest.approx(9)
+        assert bucket.acquire() == pytest.approx(5)
+        assert fake_time.sleeps == [pytest.approx(5)]
+
+    def test_min_rate(self, fake_time):
+        bucket = TokenBucket(10, min_rate=8)
+        for _ in range(5):
+            bucket.penalize(0)
+        assert bucket.rate == 8
+
+    def test_rate_recovers(self, fake_time):
+        bucket = TokenBucket(10, burst=10)
+        bucket.penalize(0)
+        bucket.penalize(0)
+        assert bucket.rate == pytest.approx(8.1)
+        fake_time.now += rate_limit.RATE_INCREASE_SECONDS - 1
+        bucket.acquire()
+        assert bucket.rate == pytest.approx(8.1)
+        fake_time.now += 1
+        bucket.acquire()
+        assert bucket.rate == pytest.approx(9.1)
+        # A penalty restarts the quiet period
+        bucket.penalize(0)
+        fake_time.now += rate_limit.RATE_INCREASE_SECONDS - 1
+        bucket.acquire()
+        assert bucket.rate == pytest.approx(8.19)
+        # Never above the configured rate
+        fake_time.now += rate_limit.RATE_INCREASE_SECONDS * 10
+        bucket.acquire()
+        assert bucket.rate == 10
+
+    def test_invalid_rate(self):
+        with pytest.raises(ValueError):
+            TokenBucket(0)
+
+    def test_shared(self):
+        bucket = get_shared_token_bucket('https://example.com/test', 5)
+        assert get_shared_token_bucket('https://example.com/test', 1) is bucket
+        assert bucket.rate == 5
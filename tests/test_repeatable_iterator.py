@@ -2,7 +2,10 @@ from itertools import islice
 
 import pytest
 
-from commcare_export.repeatable_iterator import RepeatableIterator
+from commcare_export.repeatable_iterator import (
+    CachingRepeatableIterator,
+    RepeatableIterator,
+)
 
 
 def test_iteration():
@@ -42,3 +45,39 @@ def test_iteration():
 
     with pytest.raises(LazinessException):
         list(islice(iterator, 15))
+
+
+@pytest.mark.parametrize('max_items_in_memory', [0, 3, 100])
+def test_caching_iteration(max_items_in_memory):
+    calls = []
+
+    def generate():
+        calls.append(1)
+        for i in range(10):
+            yield {'i': i}
+
+    iterator = CachingRepeatableIterator(generate, max_items_in_memory)
+    assert bool(iterator) is True
+    assert list(islice(iterator, 4)) == [{'i': i} for i in range(4)]
+    assert list(iterator) == [{'i': i} for i in range(10)]
+    assert list(iterator) == [{'i': i} for i in range(10)]
+    assert len(calls) == 1
+
+    empty = CachingRepeatableIterator(lambda: iter([]))
+    assert bool(empty) is False
+    assert list(empty) == []
+
+
+def test_caching_interleaved_iteration():
+    iterator = CachingRepeatableIterator(lambda: iter(range(6)), 2)
+    first, second = iter(iterator), iter(iterator)
+    assert [next(first), next(first), next(first)] == [0, 1, 2]
+    assert list(zip(first, second)) == [(3, 0), (4, 1), (5, 2)]
+    assert list(second) == [3, 4, 5]
+
+
+def test_caching_unpicklable_items():
+    items = [lambda i=i: i for i in range(4)]
+    iterator = CachingRepeatableIterator(lambda: iter(items), 1)
+    assert list(iterator) == items
+    assert list(iterator) == items
@@ -0,0 +1,149 @@
+import gzip
+import os
+from unittest.mock import patch
+
+import pytest
+
+from commcare_export.commcare_hq_client import CommCareHqClient
+from commcare_export.commcare_minilinq import SimplePaginator
+from commcare_export.response_cache import (
+    MODE_READ_THROUGH,
+    MODE_RECORD,
+    MODE_REPLAY,
+    ResponseCache,
+    ResponseCacheMiss,
+)
+from tests.test_commcare_hq_client import FakeSession
+
+
+class CountingSession(FakeSession):
+
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, *args, **kwargs):
+        self.calls += 1
+        return super().get(*args, **kwargs)
+
+
+def _get_client(cache, stream_pages=False, project='fake-project'):
+    client = CommCareHqClient(
+        '/fake/commcare-hq/url',
+        project,
+        None,
+        None,
+        stream_pages=stream_pages,
+        response_cache=cache,
+    )
+    client.session = CountingSession()
+    return client
+
+
+def _iterate(client):
+    paginator = SimplePaginator('fake')
+    paginator.init()
+    return [obj['foo'] for obj in client.iterate('form', paginator)]
+
+
+class TestResponseCache:
+
+    def test_read_through(self, tmp_path):
+        cache = ResponseCache(str(tmp_path), MODE_READ_THROUGH)
+        assert cache.get('form', 'limit=1') is None
+        cache.put('form', 'limit=1', b'{"objects": []}')
+        assert cache.get('form', 'limit=1') == b'{"objects": []}'
+        assert cache.get('form', 'limit=2') is None
+        assert cache.get('case', 'limit=1') is None
+
+    def test_stored_compressed(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        content = b'{"objects": [' + b'{"id": 1}, ' * 1000 + b'{"id": 2}]}'
+        cache.put('form', '', content)
+        [file_path] = [
+            os.path.join(dirpath, name)
+            for dirpath, _, names in os.walk(tmp_path) for name in names
+        ]
+        assert os.path.getsize(file_path) < len(content) / 10
+        with gzip.open(file_path) as fh:
+            assert fh.read() == content
+
+    def test_replay_miss(self, tmp_path):
+        cache = ResponseCache(str(tmp_path), MODE_REPLAY)
+        with pytest.raises(ResponseCacheMiss):
+            cache.get('form', 'limit=1')
+        with pytest.raises(ResponseCacheMiss):
+            cache.get_chunks('form', 'limit=1')
+
+    def test_record_does_not_read(self, tmp_path):
+        cache = ResponseCache(str(tmp_path), MODE_RECORD)
+        cache.put('form', 'limit=1', b'{}')
+        assert cache.get('form', 'limit=1') is None
+        assert ResponseCache(str(tmp_path)).get('form', 'limit=1') == b'{}'
+
+    def test_tee(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        chunks = cache.tee('form', '', [b'{"a"', b': 1}'])
+        assert cache.get('form', '') is None
+        assert list(chunks) == [b'{"a"', b': 1}']
+        assert b''.join(cache.get_chunks('form', '')) == b'{"a": 1}'
+
+    def test_eviction(self, tmp_path):
+        cache = ResponseCache(str(tmp_path), max_size=None)
+        cache.put('form', 'page=1', os.urandom(1000))
+        one_page_size = cache.size
+
+        cache = ResponseCache(str(tmp_path), max_size=one_page_size * 2)
+        assert cache.size == one_page_size
+        cache.put('form', 'page=2', os.urandom(1000))
+        # Now page 2 is the least recently used
+        assert cache.get('form', 'page=1') is not None
+        # Evicting does not read the cache directory again
+        with patch.object(cache, '_iter_files', side_effect=AssertionError):
+            cache.put('form', 'page=3', os.urandom(1000))
+
+        assert cache.size <= one_page_size * 2
+        assert cache.get('form', 'page=1') is not None
+        assert cache.get('form', 'page=2') is None
+        assert cache.get('form', 'page=3') is not None
+        assert ResponseCache(str(tmp_path)).size == cache.size
+
+    @pytest.mark.parametrize('stream_pages', [False, True])
+    def test_client_record_and_replay(self, tmp_path, stream_pages):
+        client = _get_client(
+            ResponseCache(str(tmp_path), MODE_RECORD), stream_pages
+        )
+        assert _iterate(client) == [1, 2]
+        assert client.session.calls == 2
+
+        client = _get_client(
+            ResponseCache(str(tmp_path), MODE_REPLAY), stream_pages
+        )
+        assert _iterate(client) == [1, 2]
+        assert client.session.calls == 0
+
+    @pytest.mark.parametrize('stream_pages', [False, True])
+    def test_client_projects_share_cache(self, tmp_path, stream_pages):
+        client = _get_client(ResponseCache(str(tmp_path)), stream_pages)
+        assert _iterate(client) == [1, 2]
+
+        client = _get_client(
+            ResponseCache(str(tmp_path), MODE_REPLAY),
+            stream_pages,
+            project='other-project',
+        )
+        with pytest.raises(ResponseCacheMiss):
+            _iterate(client)
+
+        client = _get_client(
+            ResponseCache(str(tmp_path)),
+            stream_pages,
+            project='other-project',
+        )
+        assert _iterate(client) == [1, 2]
+        assert client.session.calls == 2
+
+    def test_client_read_through(self, tmp_path):
+        client = _get_client(ResponseCache(str(tmp_path)))
+        assert _iterate(client) == [1, 2]
+        assert _iterate(client) == [1, 2]
+        assert client.session.calls == 2